@@ -0,0 +1,119 @@
+# *=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=
+# Copyright UCAR (c) 2020
+# University Corporation for Atmospheric Research(UCAR)
+# National Center for Atmospheric Research(NCAR)
+# Research Applications Laboratory(RAL)
+# P.O.Box 3000, Boulder, Colorado, 80307-3000, USA
+#
+# Name:        Add_Lakes_to_Routing_Stack.py
+# Purpose:
+# Author:      $ Kevin Sampson(ksampson)
+# Created:     2020
+# Licence:     <your licence>
+# *=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=
+
+descText = "This tool adds new lakes to an existing WRF-Hydro routing stack without " +\
+            "re-running the full pre-processing. The new lakes are rasterized only within " +\
+            "their own extent, and LAKEGRID and CHANNELGRID in the Fulldom_hires.nc file " +\
+            "are updated in place. The new lakes are appended to the existing LAKEPARM.nc " +\
+            "file. If a Route_Link.nc file is provided, reach-based lake routing is assumed, " +\
+            "and the flowline:lake associations are evaluated only for the new lakes. " +\
+            "The input files are modified in place, so make a copy first if needed."
+
+# --- Import Modules --- #
+
+# Import Python core modules
+import sys
+sys.dont_write_bytecode = True
+import os
+import time
+from argparse import ArgumentParser
+
+# Import Additional Modules
+import netCDF4
+import numpy
+
+# Import function library into namespace. Must exist in same directory as this script.
+import wrfhydro_functions as wrfh                                               # Function script packaged with this toolbox
+
+# --- End Import Modules --- #
+
+# --- Global Variables --- #
+
+# Default values
+defaultFulldom = 'Fulldom_hires.nc'
+defaultLakeparm = 'LAKEPARM.nc'
+
+# --- End Global Variables --- #
+
+# --- Main Codeblock --- #
+if __name__ == '__main__':
+    print('Script initiated at {0}'.format(time.ctime()))
+    tic = time.time()
+
+    # Setup the input arguments
+    parser = ArgumentParser(description=descText, add_help=True)
+    parser.add_argument("-i",
+                        dest="in_fulldom",
+                        default='./{0}'.format(defaultFulldom),
+                        help="Path to existing WRF-Hydro Fulldom_hires.nc file.")
+    parser.add_argument("-l",
+                        dest="in_lakes",
+                        required=True,
+                        help="Path to polygon shapefile or feature class of the lakes to add.")
+    parser.add_argument("-k",
+                        dest="in_lakeparm",
+                        default='./{0}'.format(defaultLakeparm),
+                        help="Path to existing LAKEPARM.nc file.")
+    parser.add_argument("-r",
+                        dest="in_RL",
+                        default='',
+                        help="Path to existing Route_Link.nc file. If provided, reach-based routing is assumed.")
+    parser.add_argument("-f",
+                        dest="lake_id",
+                        default='',
+                        help="Field in the lake polygon file to use for lake IDs. Default is to number lakes from the largest existing lake ID.")
+    parser.add_argument("-o",
+                        dest="out_dir",
+                        required=True,
+                        help="Output directory for the new lakes vector and lake diagnostic files.")
+
+    # If no arguments are supplied, print help message
+    if len(sys.argv) == 1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+    args = parser.parse_args()
+    lakeIDfield = args.lake_id if args.lake_id else None
+    gridded = not args.in_RL
+
+    # Print information to screen
+    print('  Values that will be used in building the lakes:')
+    print('    Input Fulldom file: {0}'.format(args.in_fulldom))
+    print('    Input lakes file: {0}'.format(args.in_lakes))
+    print('    Input LAKEPARM file: {0}'.format(args.in_lakeparm))
+    print('    Input Route_Link file: {0}'.format(args.in_RL))
+    print('    Lake ID field: {0}'.format(lakeIDfield))
+    print('    Output directory: {0}\n'.format(args.out_dir))
+
+    projdir = os.path.abspath(args.out_dir)
+    if not os.path.exists(projdir):
+        os.makedirs(projdir)
+
+    # Update the Fulldom and LAKEPARM files with the new lakes
+    rootgrp = netCDF4.Dataset(args.in_fulldom, 'r+')
+    rootgrp.set_auto_mask(False)
+    fine_grid = wrfh.WRF_Hydro_Grid(rootgrp)                                     # Fulldom carries the routing grid spacing
+    rootgrp, lakeID, new_lakes = wrfh.add_reservoirs_incremental(rootgrp, projdir, args.in_lakes, fine_grid,
+                                                                  args.in_lakeparm, lakeIDfield=lakeIDfield, Gridded=gridded)
+    rootgrp.close()
+    del rootgrp, fine_grid
+
+    # Evaluate the flowline:lake associations for the new lakes only
+    if not gridded and len(new_lakes) > 0:
+        out_lakes, lakes_lyr_name, driver_name = wrfh.vector_output(projdir, wrfh.LakesSHP)
+        Subset_arr = numpy.array(new_lakes, dtype=[(wrfh.FLID, 'i4')])
+        wrfh.LK_main(projdir, args.in_RL, out_lakes, 'link', lakeID, Subset_arr=Subset_arr,
+                    Waterbody_layer=lakes_lyr_name, incremental=True, LakeNC=args.in_lakeparm)
+        del Subset_arr
+    print('Process completed in {0:3.2f} seconds.'.format(time.time()-tic))
+# --- End Main Codeblock --- #
@@ -108,9 +108,12 @@ nclist = [wrfh.LDASFile,
             wrfh.LK_nc,
             'streams.shp', 'streams.shx', 'streams.shp.xml', 'streams.sbx', 'streams.sbn', 'streams.prj', 'streams.dbf',
             'lakes.shp', 'lakes.shx', 'lakes.shp.xml', 'lakes.sbx', 'lakes.sbn', 'lakes.prj', 'lakes.dbf',
+            wrfh.VectorGPKG,
             wrfh.GW_nc,
             wrfh.GWGRID_nc,
             wrfh.minDepthCSV,
+            wrfh.gageHierCSV,
+            wrfh.gageBasinCSV,
             'Lake_Problems.csv',
             'Old_New_LakeComIDs.csv',
             'Lake_Link_Types.csv',
@@ -203,6 +206,13 @@ def GEOGRID_STANDALONE(inGeogrid,
     else:
         print('    Reach-based routing files will not be created.')
 
+    # Groundwater basin method, needed to declare the groundwater stages below
+    if GW_with_Stack:
+        if in_GWPolys is not None:
+            if os.path.exists(in_GWPolys):
+                print('    Groundwater basin boundary polygons provided. Delineating groundwater basins from these polygons.')
+                defaultGWmethod = 'Polygon Shapefile or Feature Class'
+
     # Step 1 - Georeference geogrid file
     rootgrp = netCDF4.Dataset(inGeogrid, 'r')                                   # Establish an object for reading the input NetCDF files
     globalAtts = rootgrp.__dict__                                               # Read all global attributes into a dictionary
@@ -217,166 +227,231 @@ def GEOGRID_STANDALONE(inGeogrid,
     print('    Coarse grid extent [Xmin, Ymin, Xmax, Ymax]: {0}'.format(coarse_grid.grid_extent()))      # Print extent to screen.
     print('    Fine grid extent [Xmin, Ymin, Xmax, Ymax]:   {0}'.format(fine_grid.grid_extent()))      # Print extent to screen.
 
-    # Build output raster from numpy array of the GEOGRID variable requested. This will be used as a template later on
-    LU_INDEX = coarse_grid.numpy_to_Raster(wrfh.flip_grid(rootgrp.variables['LU_INDEX'][:]))
-
-    # Create spatial metadata file for GEOGRID/LDASOUT grids
-    out_nc1 = os.path.join(projdir, wrfh.LDASFile)
-    rootgrp1 = netCDF4.Dataset(out_nc1, 'w', format=outNCType)                  # wrf_hydro_functions.outNCType)
-    rootgrp1, grid_mapping = wrfh.create_CF_NetCDF(coarse_grid, rootgrp1, projdir,
-            notes=processing_notes_SM) # addLatLon=True, latArr=latArr, lonArr=lonArr)
-    for item in wrfh.Geogrid_MapVars + ['DX', 'DY']:
-        if item in globalAtts:
-            rootgrp1.setncattr(item, globalAtts[item])
-    rootgrp1.close()
-    del rootgrp1
-
-    # Step 3 - Create high resolution topography layers
-    in_DEM = gdal.Open(inDEM, 0)                                                # Open with read-only mode
-    outDEM = os.path.join(projdir, mosprj_name)
-    mosprj = fine_grid.project_to_model_grid(in_DEM, saveRaster=True, OutGTiff=outDEM, resampling=gdal.GRA_Bilinear)
-    in_DEM = mosprj = None
-
-    # Build latitude and longitude arrays for Fulldom_hires netCDF file
+    # Read the GEOGRID arrays needed by the stages below, so that the GEOGRID file can be closed before they run
+    LU_INDEX_arr = wrfh.flip_grid(rootgrp.variables['LU_INDEX'][:])
     if coordMethod1:
-        print('    Deriving geocentric coordinates on routing grid from bilinear interpolation of geogrid coordinates.')
-        # Build latitude and longitude arrays for GEOGRID_LDASOUT spatial metadata file
         latArr = wrfh.flip_grid(rootgrp.variables['XLAT_M'][:])                 # Extract array of GEOGRID latitude values
         lonArr = wrfh.flip_grid(rootgrp.variables['XLONG_M'][:])                # Extract array of GEOGRID longitude values
+    rootgrp.close()                                                             # Close input GEOGRID file
+    del rootgrp
 
-        # Resolve any remaining issues with masked arrays. Happens in the ArcGIS pre-processing tools for python 2.7.
-        if numpy.ma.isMA(lonArr):
-            lonArr = lonArr.data
-        if numpy.ma.isMA(latArr):
-            latArr = latArr.data
-
-        # Method 1: Use GEOGRID latitude and longitude fields and resample to routing grid
-        latRaster1 = coarse_grid.numpy_to_Raster(latArr)                        # Build raster out of GEOGRID latitude array
-        lonRaster1 = coarse_grid.numpy_to_Raster(lonArr)                        # Build raster out of GEOGRID longitude array
-
-        latRaster2 = fine_grid.project_to_model_grid(latRaster1)                # Regrid from GEOGRID resolution to routing grid resolution
-        lonRaster2 = fine_grid.project_to_model_grid(lonRaster1)                # Regrid from GEOGRID resolution to routing grid resolution
-        latRaster1 = lonRaster1 = None                                          # Destroy rater objects
-        latArr2 = BandReadAsArray(latRaster2.GetRasterBand(1))                  # Read into numpy array
-        lonArr2 = BandReadAsArray(lonRaster2.GetRasterBand(1))                  # Read into numpy array
-        latRaster2 = lonRaster2 = None                                          # Destroy raster objects
-        del latArr, lonArr, latRaster1, lonRaster1, latRaster2, lonRaster2
-
-    elif coordMethod2:
-        print('    Deriving geocentric coordinates on routing grid from direct transformation geogrid coordinates.')
-        # Method 2: Transform each point from projected coordinates to geocentric coordinates
-        wgs84_proj = osr.SpatialReference()                                     # Build empty spatial reference object
-        wgs84_proj.ImportFromProj4(wrfh.wgs84_proj4)                            # Imprort from proj4 to avoid EPSG errors (4326)
-        xmap, ymap = fine_grid.getxy()                                          # Get x and y coordinates as numpy array
-        latArr2, lonArr2 = wrfh.ReprojectCoords(xmap, ymap, coarse_grid.proj, wgs84_proj)  # Transform coordinate arrays
-        del xmap, ymap, wgs84_proj
-
-    # Create FULLDOM file
+    '''
+    The remaining steps are declared as stages of a dependency graph, and are run
+    in a pool of wrfh.StageWorkers threads. Stages that do not depend on each other
+    (for example the LDASOUT file, the DEM warp, the lat/lon and landuse regridding,
+    and the groundwater basins and reach-based routing) may run at the same time.
+    The netCDF library is not thread-safe, so every stage that reads or writes a
+    netCDF file (including the staged Fulldom file) holds the 'netCDF' resource,
+    so that no two of these stages run at the same time. With one worker, the
+    stages run one at a time in the order they are added below.
+    '''
+    graph = wrfh.StageGraph()
+    state = {}                                                                  # Outputs passed from one stage to the next
+    nc_res = ['netCDF']
+
+    def LDASOUT_stage():
+        # Create spatial metadata file for GEOGRID/LDASOUT grids
+        out_nc1 = os.path.join(projdir, wrfh.LDASFile)
+        rootgrp1 = netCDF4.Dataset(out_nc1, 'w', format=outNCType)              # wrf_hydro_functions.outNCType)
+        rootgrp1, grid_mapping = wrfh.create_CF_NetCDF(coarse_grid, rootgrp1, projdir,
+                notes=processing_notes_SM) # addLatLon=True, latArr=latArr, lonArr=lonArr)
+        for item in wrfh.Geogrid_MapVars + ['DX', 'DY']:
+            if item in globalAtts:
+                rootgrp1.setncattr(item, globalAtts[item])
+        rootgrp1.close()
+        del rootgrp1
+    graph.add('LDASOUT', LDASOUT_stage, resources=nc_res)
+
+    def DEM_stage():
+        # Step 3 - Create high resolution topography layers
+        in_DEM = gdal.Open(inDEM, 0)                                            # Open with read-only mode
+        mosprj = fine_grid.project_to_model_grid(in_DEM, saveRaster=True, OutGTiff=outDEM, resampling=gdal.GRA_Bilinear)
+        in_DEM = mosprj = None
+    outDEM = os.path.join(projdir, mosprj_name)
+    graph.add('DEM', DEM_stage)
+
+    def latlon_stage():
+        # Build latitude and longitude arrays for Fulldom_hires netCDF file
+        if coordMethod1:
+            print('    Deriving geocentric coordinates on routing grid from bilinear interpolation of geogrid coordinates.')
+            # Resolve any remaining issues with masked arrays. Happens in the ArcGIS pre-processing tools for python 2.7.
+            lat_in = latArr.data if numpy.ma.isMA(latArr) else latArr
+            lon_in = lonArr.data if numpy.ma.isMA(lonArr) else lonArr
+
+            # Method 1: Use GEOGRID latitude and longitude fields and resample to routing grid
+            latRaster1 = coarse_grid.numpy_to_Raster(lat_in)                    # Build raster out of GEOGRID latitude array
+            lonRaster1 = coarse_grid.numpy_to_Raster(lon_in)                    # Build raster out of GEOGRID longitude array
+
+            latRaster2 = fine_grid.project_to_model_grid(latRaster1)            # Regrid from GEOGRID resolution to routing grid resolution
+            lonRaster2 = fine_grid.project_to_model_grid(lonRaster1)            # Regrid from GEOGRID resolution to routing grid resolution
+            latRaster1 = lonRaster1 = None                                      # Destroy rater objects
+            state['latArr2'] = BandReadAsArray(latRaster2.GetRasterBand(1))     # Read into numpy array
+            state['lonArr2'] = BandReadAsArray(lonRaster2.GetRasterBand(1))     # Read into numpy array
+            latRaster2 = lonRaster2 = None                                      # Destroy raster objects
+            del lat_in, lon_in, latRaster1, lonRaster1, latRaster2, lonRaster2
+
+        elif coordMethod2:
+            print('    Deriving geocentric coordinates on routing grid from direct transformation geogrid coordinates.')
+            # Method 2: Transform each point from projected coordinates to geocentric coordinates
+            wgs84_proj = osr.SpatialReference()                                 # Build empty spatial reference object
+            wgs84_proj.ImportFromProj4(wrfh.wgs84_proj4)                        # Imprort from proj4 to avoid EPSG errors (4326)
+            xmap, ymap = fine_grid.getxy()                                      # Get x and y coordinates as numpy array
+            state['latArr2'], state['lonArr2'] = wrfh.ReprojectCoords(xmap, ymap, coarse_grid.proj, wgs84_proj)  # Transform coordinate arrays
+            del xmap, ymap, wgs84_proj
+    graph.add('latlon', latlon_stage)
+
+    def landuse_regrid_stage():
+        # Process: Resample LU_INDEX grid to a higher resolution
+        LU_INDEX = coarse_grid.numpy_to_Raster(LU_INDEX_arr)                    # Build output raster from numpy array of the GEOGRID variable
+        LU_INDEX2 = fine_grid.project_to_model_grid(LU_INDEX, fine_grid.DX, fine_grid.DY, resampling=gdal.GRA_NearestNeighbour)
+        state['landuse'] = BandReadAsArray(LU_INDEX2.GetRasterBand(1))          # Read into numpy array
+        LU_INDEX = LU_INDEX2 = None                                             # Destroy raster objects
+    graph.add('landuse_regrid', landuse_regrid_stage)
+
+    def Fulldom_stage():
+        # Create FULLDOM file
+        rootgrp2 = netCDF4.Dataset(out_nc2, 'w', format=outNCType)              # wrf_hydro_functions.outNCType)
+        rootgrp2, grid_mapping = wrfh.create_CF_NetCDF(fine_grid, rootgrp2, projdir,
+                notes=processing_notesFD, addVars=varList2D, addLatLon=True,
+                latArr=state.pop('latArr2'), lonArr=state.pop('lonArr2'))
+
+        # Add some global attribute metadata to the Fulldom file, including relevant WPS attributes for defining the model coordinate system
+        rootgrp2.geogrid_used = inGeogrid                                       # Paste path of geogrid file to the Fulldom global attributes
+        rootgrp2.DX = fine_grid.DX                                              # Add X resolution as a global attribute
+        rootgrp2.DY = -fine_grid.DY                                             # Add Y resolution as a global attribute
+        for item in wrfh.Geogrid_MapVars:
+            if item in globalAtts:
+                rootgrp2.setncattr(item, globalAtts[item])
+
+        # Stage the Fulldom layers in memory, to be written to disk once when the file is closed
+        memmap_dir = projdir if wrfh.useFulldomMemmap else None
+        state['rootgrp2'] = wrfh.FulldomStore(rootgrp2, memmap_dir=memmap_dir, compact=wrfh.useCompactLayers)
     out_nc2 = os.path.join(projdir, wrfh.FullDom)
-    rootgrp2 = netCDF4.Dataset(out_nc2, 'w', format=outNCType)                  # wrf_hydro_functions.outNCType)
-    rootgrp2, grid_mapping = wrfh.create_CF_NetCDF(fine_grid, rootgrp2, projdir,
-            notes=processing_notesFD, addVars=varList2D, addLatLon=True,
-            latArr=latArr2, lonArr=lonArr2)
-    del latArr2, lonArr2
-
-    # Add some global attribute metadata to the Fulldom file, including relevant WPS attributes for defining the model coordinate system
-    rootgrp2.geogrid_used = inGeogrid                                           # Paste path of geogrid file to the Fulldom global attributes
-    rootgrp2.DX = fine_grid.DX                                                  # Add X resolution as a global attribute
-    rootgrp2.DY = -fine_grid.DY                                                 # Add Y resolution as a global attribute
-    for item in wrfh.Geogrid_MapVars:
-        if item in globalAtts:
-            rootgrp2.setncattr(item, globalAtts[item])
-    rootgrp.close()                                                             # Close input GEOGRID file
-    del item, globalAtts, rootgrp
+    graph.add('Fulldom', Fulldom_stage, deps=['latlon'], resources=nc_res)
 
-    # Process: Resample LU_INDEX grid to a higher resolution
-    LU_INDEX2 = fine_grid.project_to_model_grid(LU_INDEX, fine_grid.DX, fine_grid.DY, resampling=gdal.GRA_NearestNeighbour)
-    rootgrp2.variables['landuse'][:] = BandReadAsArray(LU_INDEX2.GetRasterBand(1))          # Read into numpy array
-    LU_INDEX = None                                                             # Destroy raster object
-    print('    Process: landuse written to output netCDF.')
-    del LU_INDEX, LU_INDEX2
+    def landuse_stage():
+        state['rootgrp2'].variables['landuse'][:] = state.pop('landuse')
+        print('    Process: landuse written to output netCDF.')
+    graph.add('landuse', landuse_stage, deps=['Fulldom', 'landuse_regrid'], resources=nc_res)
 
     ##        # Step X(a) - Test to match LANDMASK - Only used for areas surrounded by water (LANDMASK=0)
     ##        mosprj2, loglines = wrfh.adjust_to_landmask(mosprj, LANDMASK, coarse_grid.proj, projdir, 'm')
     ##        outtable.writelines("\n".join(loglines) + "\n")
     ##        del LANDMASK
 
-    # Step 4 - Hyrdo processing functions -- Whitebox
-    rootgrp2, fdir, fac, channelgrid, fill, order = wrfh.WB_functions(rootgrp2, outDEM,
-            projdir, threshold, ovroughrtfac_val, retdeprtfac_val, lksatfac_val, startPts=startPts, chmask=channel_mask)
-    if cleanUp:
-        wrfh.remove_file(outDEM)                                                # Delete output DEM from disk
+    def Whitebox_stage():
+        # Step 4 - Hyrdo processing functions -- Whitebox
+        state['rootgrp2'], fdir, fac, channelgrid, fill, order = wrfh.WB_functions(state['rootgrp2'], outDEM,
+                projdir, threshold, ovroughrtfac_val, retdeprtfac_val, lksatfac_val, startPts=startPts, chmask=channel_mask)
+        state.update(fdir=fdir, fac=fac, channelgrid=channelgrid, fill=fill, order=order)
+        if cleanUp:
+            wrfh.remove_file(outDEM)                                            # Delete output DEM from disk
+    graph.add('Whitebox', Whitebox_stage, deps=['Fulldom', 'DEM'], resources=nc_res)
+    Fulldom_last = 'Whitebox'                                                   # Last stage to alter the staged Fulldom layers
 
     # If the user provides forecast points as a CSV file, alter outputs accordingly
     if AddGages:
-        if os.path.exists(in_csv):
-            rootgrp2 = wrfh.forecast_points(in_csv, rootgrp2, basin_mask, projdir,
-                        fine_grid.DX, fine_grid.WKT, fdir, fac, channelgrid)    # Forecast point processing
+        def gages_stage():
+            if os.path.exists(in_csv):
+                state['rootgrp2'] = wrfh.forecast_points(in_csv, state['rootgrp2'], basin_mask, projdir,
+                            fine_grid, state['channelgrid'])                    # Forecast point processing
+        graph.add('gages', gages_stage, deps=[Fulldom_last], resources=nc_res)
+        Fulldom_last = 'gages'
 
     # Allow masking routing files (LINKID, Route_Link, etc.) to forecast points if requested
     if routing:
-        rootgrp2 = wrfh.Routing_Table(projdir, rootgrp2, fine_grid, fdir, channelgrid, fill, order, gages=AddGages)
-    if cleanUp:
-        wrfh.remove_file(fill)                                                  # Delete fill from disk
-        wrfh.remove_file(order)                                                 # Delete order from disk
+        def routing_stage():
+            state['rootgrp2'] = wrfh.Routing_Table(projdir, state['rootgrp2'], fine_grid, state['fdir'], state['channelgrid'],
+                            state['fill'], state['order'], gages=AddGages)
+        graph.add('routing', routing_stage, deps=[Fulldom_last], resources=nc_res)
+        Fulldom_last = 'routing'
 
     gridded = not routing                                                       # Flag for gridded routing
     if os.path.exists(in_lakes):
-        # Alter Channelgrid for reservoirs and build reservoir inputs
-        print('    Reservoir polygons provided. Lake routing will be activated.')
-        rootgrp2, lake_ID_field = wrfh.add_reservoirs(rootgrp2,
-                                                        projdir,
-                                                        fac,
-                                                        in_lakes,
-                                                        fine_grid,
-                                                        Gridded=gridded,
-                                                        lakeIDfield=None)
-
-        # Attempt to add reservoirs onto reach-based routing configuation after lakes and reaches have been processed
-        # (added by KMS 3/28/2023)
-        if routing:
-            print('    Attempting to resolve reservoirs on reach-based routing network.')
-            in_RL = os.path.join(projdir, wrfh.RT_nc)
-            LakeNC = os.path.join(projdir, wrfh.LK_nc)
-            out_lakes = os.path.join(projdir, wrfh.LakesSHP)
-            if os.path.exists(in_RL) and os.path.exists(out_lakes):
-                # Run lake pre-processor
-                WaterbodyDict, Lake_Link_Type_arr, Old_New_LakeComID = wrfh.LK_main(projdir,
-                                                                                    in_RL,
-                                                                                    out_lakes,
-                                                                                    'link',
-                                                                                    lake_ID_field,
-                                                                                    Subset_arr=None,
-                                                                                    datestr=wrfh.datestr,
-                                                                                    LakeAssociation=wrfh.LakeAssoc,)
-                del WaterbodyDict, Lake_Link_Type_arr, Old_New_LakeComID
-
-    # Check for NLINKS channel connectivity errors (added by KMS 3/27/2023)
-    if check_nlinks:
-        print('    Checking CHANNELGRID layer for NLINKS errors.')
-        rootgrp2 = wrfh.nlinks_checker(rootgrp2, silent=True)
-    rootgrp2.close()                                                            # Close Fulldom_hires.nc file
-    del rootgrp2
-
-    # Build groundwater files
+        def lakes_stage():
+            # Alter Channelgrid for reservoirs and build reservoir inputs
+            print('    Reservoir polygons provided. Lake routing will be activated.')
+            state['rootgrp2'], lake_ID_field = wrfh.add_reservoirs(state['rootgrp2'],
+                                                            projdir,
+                                                            state['fac'],
+                                                            in_lakes,
+                                                            fine_grid,
+                                                            Gridded=gridded,
+                                                            lakeIDfield=None)
+
+            # Attempt to add reservoirs onto reach-based routing configuation after lakes and reaches have been processed
+            # (added by KMS 3/28/2023)
+            if routing:
+                print('    Attempting to resolve reservoirs on reach-based routing network.')
+                in_RL = os.path.join(projdir, wrfh.RT_nc)
+                LakeNC = os.path.join(projdir, wrfh.LK_nc)
+                out_lakes, lakes_lyr_name, driver_name = wrfh.vector_output(projdir, wrfh.LakesSHP)
+                if os.path.exists(in_RL) and os.path.exists(out_lakes):
+                    # Run lake pre-processor
+                    WaterbodyDict, Lake_Link_Type_arr, Old_New_LakeComID = wrfh.LK_main(projdir,
+                                                                                        in_RL,
+                                                                                        out_lakes,
+                                                                                        'link',
+                                                                                        lake_ID_field,
+                                                                                        Subset_arr=None,
+                                                                                        datestr=wrfh.datestr,
+                                                                                        LakeAssociation=wrfh.LakeAssoc,
+                                                                                        Waterbody_layer=lakes_lyr_name)
+                    del WaterbodyDict, Lake_Link_Type_arr, Old_New_LakeComID
+        graph.add('lakes', lakes_stage, deps=[Fulldom_last], resources=nc_res)
+        Fulldom_last = 'lakes'
+
+    def close_Fulldom_stage():
+        # Check for NLINKS channel connectivity errors (added by KMS 3/27/2023)
+        rootgrp2 = state.pop('rootgrp2')
+        if check_nlinks:
+            print('    Checking CHANNELGRID layer for NLINKS errors.')
+            rootgrp2 = wrfh.nlinks_checker(rootgrp2, silent=True)
+        rootgrp2.close()                                                        # Write staged layers and close Fulldom_hires.nc file
+        del rootgrp2
+    graph.add('close_Fulldom', close_Fulldom_stage, deps=[Fulldom_last, 'landuse'], resources=nc_res)
+
+    # Build groundwater files. Basins from the Fulldom basn_msk variable need the finished Fulldom file,
+    # while LINKID local basins only need the Whitebox flow direction and channel rasters, once every
+    # stage that writes the channel raster has finished (forecast points mask it to the basins).
+    cleanup_deps = ['close_Fulldom']
+    zip_deps = ['LDASOUT']
     if GW_with_Stack:
-        if in_GWPolys is not None:
-            if os.path.exists(in_GWPolys):
-                print('    Groundwater basin boundary polygons provided. Delineating groundwater basins from these polygons.')
-                defaultGWmethod = 'Polygon Shapefile or Feature Class'
-        GWBasns = wrfh.build_GW_Basin_Raster(out_nc2, projdir, defaultGWmethod, channelgrid, fdir, fine_grid, in_Polys=in_GWPolys)
-        wrfh.build_GW_buckets(projdir, GWBasns, coarse_grid, Grid=True)
-        GWBasns = None
+        def GW_basins_stage():
+            state['GWBasns'] = wrfh.build_GW_Basin_Raster(out_nc2, projdir, defaultGWmethod, state.get('channelgrid'),
+                            state.get('fdir'), fine_grid, in_Polys=in_GWPolys)
+        if defaultGWmethod == 'FullDom basn_msk variable':
+            graph.add('GW_basins', GW_basins_stage, deps=['close_Fulldom'], resources=nc_res)
+        elif defaultGWmethod == 'FullDom LINKID local basins':
+            graph.add('GW_basins', GW_basins_stage, deps=['Whitebox', 'gages'] if AddGages else ['Whitebox'])
+        else:
+            graph.add('GW_basins', GW_basins_stage)                             # Polygons only need the routing grid definition
+
+        def GW_buckets_stage():
+            wrfh.build_GW_buckets(projdir, state.pop('GWBasns'), coarse_grid, Grid=True)
+        graph.add('GW_buckets', GW_buckets_stage, deps=['GW_basins'], resources=nc_res)
+        cleanup_deps.append('GW_basins')
+        zip_deps.append('GW_buckets')
+
+    def cleanup_stage():
+        if cleanUp:
+            wrfh.remove_file(state['fill'])                                     # Delete fill from disk
+            wrfh.remove_file(state['order'])                                    # Delete order from disk
+            wrfh.remove_file(state['fdir'])                                     # Delete fdir from disk
+            wrfh.remove_file(state['fac'])                                      # Delete fac from disk
+            wrfh.remove_file(state['channelgrid'])                              # Delete channelgrid from disk
+        if routing:
+            wrfh.remove_file(os.path.join(projdir, wrfh.stream_id))
+    graph.add('cleanup', cleanup_stage, deps=cleanup_deps)
 
-    if cleanUp:
-        wrfh.remove_file(fdir)                                                  # Delete fdir from disk
-        wrfh.remove_file(fac)                                                   # Delete fac from disk
-        wrfh.remove_file(channelgrid)                                           # Delete channelgrid from disk
-    if routing:
-        wrfh.remove_file(os.path.join(projdir, wrfh.stream_id))
+    def zip_stage():
+        # Copmress (zip) the output directory
+        zipper = wrfh.zipUpFolder(projdir, out_zip, nclist)
+    graph.add('zip', zip_stage, deps=zip_deps + ['cleanup'])
 
-    # Copmress (zip) the output directory
-    zipper = wrfh.zipUpFolder(projdir, out_zip, nclist)
+    # Run the stages and report the time spent in each
+    graph.run()
+    graph.report()
     print('Built output .zip file in {0: 3.2f} seconds.'.format(time.time()-tic1))  # Diagnotsitc print statement
 
     # Delete all temporary files
@@ -462,6 +537,16 @@ if __name__ == '__main__':
                         type=lambda x: is_valid_file(parser, x),
                         default=None,
                         help="Path to a routing grid raster with which to mask channels and channel-derived grids [OPTIONAL]")
+    parser.add_argument("--gpkg",
+                        dest="use_gpkg",
+                        action='store_true',
+                        default=False,
+                        help="Write streams and lakes vectors to a single GeoPackage with a spatial index instead of shapefiles. default=False")
+    parser.add_argument("--workers",
+                        dest="workers",
+                        type=int,
+                        default=wrfh.StageWorkers,
+                        help="Number of processing stages that may run at the same time. default=1")
 
     # If no arguments are supplied, print help message
     if len(sys.argv)==1:
@@ -487,6 +572,10 @@ if __name__ == '__main__':
         print('    Using default OVROUGHRTFAC parameter value: {0}'.format(all_defaults["ovroughrtfac_val"]))
     if args.retdeprtfac_val == all_defaults["retdeprtfac_val"]:
         print('    Using default RETDEPRTFAC parameter value: {0}'.format(all_defaults["retdeprtfac_val"]))
+    if args.use_gpkg == all_defaults["use_gpkg"]:
+        print('    Using default vector output format: {0}'.format(wrfh.VectorDriver))
+    if args.workers == all_defaults["workers"]:
+        print('    Using default number of concurrent stages: {0}'.format(all_defaults["workers"]))
 
     # Handle unsupported configurations - Currently none
 
@@ -530,7 +619,11 @@ if __name__ == '__main__':
         print('    Input channel initiation start point feature class: {0}'.format(args.channel_starts))
         print('    Input groundwater basin polygons: {0}'.format(args.gw_polys))
         print('    Input channelgrid mask raster: {0}'.format(args.ch_mask))
+        print('    Write vectors to GeoPackage: {0}'.format(args.use_gpkg))
+        print('    Concurrent processing stages: {0}'.format(args.workers))
         print('    Output ZIP file: {0}'.format(args.out_zip_file))
+        wrfh.useGeoPackage = args.use_gpkg
+        wrfh.StageWorkers = args.workers
 
         # Create scratch directory for temporary outputs
         projdir = os.path.join(os.path.dirname(args.out_zip_file), 'scratchdir')
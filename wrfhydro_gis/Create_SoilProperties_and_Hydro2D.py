@@ -94,6 +94,16 @@ hyd2dFile = 'hydro2dtbl.nc'
 # default parameters, set to FALSE. There should be no answer differences either way.
 setUrban = False
 
+#### Chunking and compression of the output netcdf files
+# zlib compression greatly reduces the size of parameter grids that are uniform over large areas.
+# The chunk shape is given as (south_north, west_east), e.g. (256, 256), and None uses the library default.
+# Set ncLeastSignificantDigit to a number of decimal places to quantize (lossy) the values before compression.
+ncZlib = False
+ncComplevel = 4
+ncShuffle = True
+ncChunk = None
+ncLeastSignificantDigit = None
+
 #######################################################
 # Do not update below this line.
 #######################################################
@@ -231,6 +241,22 @@ def is_valid_file(parser, arg):
         return str(arg)
 
 
+def nc_var_options(rootgrp, dims):
+    '''
+    Return the createVariable keyword arguments for chunking, compressing and
+    quantizing a float variable with dimensions 'dims', from the options above.
+    '''
+    options = {}
+    if ncZlib:
+        options.update(zlib=True, complevel=ncComplevel, shuffle=ncShuffle)
+    if ncChunk:
+        sizes = [max(len(rootgrp.dimensions[dim]), 1) for dim in dims]
+        options['chunksizes'] = tuple([1] * (len(sizes) - 2) + [min(size, chunk) for size, chunk in zip(sizes[-2:], ncChunk)])
+    if ncLeastSignificantDigit is not None:
+        options['least_significant_digit'] = ncLeastSignificantDigit
+    return options
+
+
 def array_replace(from_values, to_values, array):
     '''
     This function will perform a fast array replacement based on arrays of
@@ -515,9 +541,9 @@ def main_soilProp(geoFile,
     # Populate initial file with variables to keep from the input GEOGRID file
     for varname in nameLookupSoil:
         if varname in var3d:
-            rootgrp_SP.createVariable(varname, 'f4', dims3D, fill_value=fillValue)
+            rootgrp_SP.createVariable(varname, 'f4', dims3D, fill_value=fillValue, **nc_var_options(rootgrp_SP, dims3D))
         else:
-            rootgrp_SP.createVariable(varname, 'f4', dims2D, fill_value=fillValue)
+            rootgrp_SP.createVariable(varname, 'f4', dims2D, fill_value=fillValue, **nc_var_options(rootgrp_SP, dims2D))
     del varname
 
     # Global Attributes - copy all from GEOGRID file to soil_properties
@@ -533,7 +559,7 @@ def main_soilProp(geoFile,
         if dimname in dims2D_hyd:
             rootgrp_hyd.createDimension(dimname, len(dim))  # Copy dimensions from the GEOGRID file
     for varname in nameLookupHyd.keys():
-        rootgrp_hyd.createVariable(varname, 'f4', dims2D_hyd, fill_value=fillValue)
+        rootgrp_hyd.createVariable(varname, 'f4', dims2D_hyd, fill_value=fillValue, **nc_var_options(rootgrp_hyd, dims2D_hyd))
     rootgrp_hyd.setncatts(ncatts)
     del dimname, dim, varname
 
@@ -682,12 +708,12 @@ def main_soilProp(geoFile,
         if global_mp_dict[add_var] in mpTblDict:
             add_val = mpTblDict.get(global_mp_dict[add_var], fillValue)
             print(f'      Adding global parameter {add_var}={add_val} to grid.')
-            rootgrp_SP.createVariable(add_var, 'f4', dims2D, fill_value=fillValue)
+            rootgrp_SP.createVariable(add_var, 'f4', dims2D, fill_value=fillValue, **nc_var_options(rootgrp_SP, dims2D))
             rootgrp_SP[add_var][:] = add_val
         else:
             print(f'      Could not find parameter {global_mp_dict[add_var]} in {mpParamFile}.')
             print(f'        Using default value of {add_var}={add_var_defaults[add_var]}.')
-            rootgrp_SP.createVariable(add_var, 'f4', dims2D, fill_value=fillValue)
+            rootgrp_SP.createVariable(add_var, 'f4', dims2D, fill_value=fillValue, **nc_var_options(rootgrp_SP, dims2D))
             rootgrp_SP[add_var][:] = add_var_defaults[add_var]
 
     rootgrp_SP.close()
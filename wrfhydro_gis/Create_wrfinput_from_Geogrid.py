@@ -81,6 +81,13 @@ missInt = -9999
 #### Number of soil layers (e.g., 4)
 nsoil = 4
 
+#### Chunking and compression of the output wrfinput file
+ncZlib = False                                                                  # Compress variables with zlib
+ncComplevel = 4                                                                 # zlib compression level (1=fastest, 9=smallest)
+ncShuffle = True                                                                # Apply the shuffle filter before compression
+ncChunk = None                                                                  # Chunk shape (south_north, west_east) of gridded variables, e.g. (256, 256). None = library default
+ncLeastSignificantDigit = None                                                  # Quantize float variables to this many decimal places (None = lossless)
+
 #######################################################
 # Do not update below here.
 #######################################################
@@ -137,6 +144,25 @@ def is_valid_file(parser, arg):
     else:
         return str(arg)
 
+def nc_encoding(dims, shape, dtype):
+    '''
+    Return the chunking, compression and quantization settings (as keyword
+    arguments to createVariable, or as an xarray encoding) for a variable with
+    the given dimension names, shape and data type. Chunking is only applied to
+    variables on the (south_north, west_east) grid.
+    '''
+    encoding = {}
+    if len(dims) == 0:
+        return encoding                                                         # Scalar variables cannot be compressed
+    if ncZlib:
+        encoding.update(zlib=True, complevel=ncComplevel, shuffle=ncShuffle)
+    if ncChunk and tuple(dims[-2:]) == (sndim, wedim):
+        sizes = [max(int(size), 1) for size in shape]
+        encoding['chunksizes'] = tuple([1]*(len(sizes)-2) + [min(size, chunk) for size, chunk in zip(sizes[-2:], ncChunk)])
+    if ncLeastSignificantDigit is not None and numpy.dtype(dtype).kind == 'f':
+        encoding['least_significant_digit'] = ncLeastSignificantDigit
+    return encoding
+
 def fill_wrfinput_ncdfpy(rootgrp_in, rootgrp_out, laimo=8):
     '''
     This function will populate the arrays in the WRFINPUT file based on array and
@@ -252,12 +278,13 @@ def main_wrfinput_ncdfpy(geoFile, wrfinFile, lai=8, outNCType='NETCDF4'):
             varDims = tuple(varDim for varDim in ncvar.dimensions)
             if varname in mapVars:
                 varname = mapVars[varname]                                      # Alter the variable name
-            var = rootgrp_out.createVariable(varname, ncvar.dtype, varDims)
+            var = rootgrp_out.createVariable(varname, ncvar.dtype, varDims, **nc_encoding(varDims, ncvar.shape, ncvar.dtype))
             var.setncatts(varAtts)                                              # Copy variable attributes from GEOGRID file
 
     # Define new variables based on the addVars list
     for (varname, units, varDims, missing_value, dtype) in addVars:
-        var = rootgrp_out.createVariable(varname, dtype, varDims)
+        varShape = [len(rootgrp_out.dimensions[varDim]) for varDim in varDims]
+        var = rootgrp_out.createVariable(varname, dtype, varDims, **nc_encoding(varDims, varShape, dtype))
         var.setncatts({'units':units, 'missing_value':missing_value})
 
     # Global Attributes - copy all from GEOGRID file to WRFINPUT
@@ -415,6 +442,8 @@ def main_wrfinput_xarray(geoFile, wrfinFile, lai=8, outNCType='NETCDF4'):
     # Output file to disk
     #encoding = {varname:ncDS[varname].encoding for varname in list(ncDS.variables.keys())}
     encoding = {varname:{'_FillValue':None} for varname in list(ncDS.variables.keys())}
+    for varname, var in ncDS.variables.items():
+        encoding[varname].update(nc_encoding(var.dims, var.shape, var.dtype))  # Chunking and compression options
     ncDS.to_netcdf(wrfinFile, mode='w', format=outNCType, encoding=encoding)
     ncDS.close()
     del encoding, ncDS
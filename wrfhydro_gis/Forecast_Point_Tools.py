@@ -40,7 +40,8 @@ except:
     sys.exit('ERROR: cannot find GDAL/OGR modules')
 
 # Import function library into namespace. Must exist in same directory as this script.
-from wrfhydro_functions import CSV_to_SHP                                       # Function script packaged with this toolbox
+from wrfhydro_functions import CSV_to_SHP, read_layer_columnar, transform_points    # Function script packaged with this toolbox
+import shapely
 
 # Global Variables
 
@@ -53,22 +54,6 @@ Driver = 'ESRI Shapefile'
 # CSV_to_shape = False                                   # Switch for creating a point shapefile from a forecast point CSV file
 # SHP_to_CSV = True                                  # Switch for creating a CSV file from a point shapefile
 
-# Dictionary to map OGR data types to numpy dtypes - many of these are just a guess,
-# with numpy.object for List, string, and binary objects
-OGRTypes = {ogr.OFTBinary: numpy.object,
-            ogr.OFTDate: numpy.datetime64,
-            ogr.OFTDateTime: numpy.datetime64,
-            ogr.OFTInteger: numpy.int,
-            ogr.OFTInteger64: numpy.int64,
-            ogr.OFTInteger64List: numpy.object,
-            ogr.OFTIntegerList: numpy.object,
-            ogr.OFTReal: numpy.float64,
-            ogr.OFTRealList: numpy.object,
-            ogr.OFTString: numpy.str,
-            ogr.OFTStringList: numpy.object,
-            ogr.OFTTime: numpy.datetime64,
-            ogr.OFTWideString: numpy.object,
-            ogr.OFTWideStringList: numpy.object}
 
 # Main Codeblock
 if __name__ == '__main__':
@@ -145,22 +130,8 @@ if __name__ == '__main__':
         inSR = layer.GetSpatialRef()                                            # Get spatial reference of input
         print('Number of features in {0}: {1}'.format(os.path.basename(args.in_shp), featureCount))
 
-        # Read shapefile fields
-        layerDefinition = layer.GetLayerDefn()
-        npDtypes = []
-        fields = []
-        for i in range(layerDefinition.GetFieldCount()):
-            fieldDef = layerDefinition.GetFieldDefn(i)
-            fieldName = fieldDef.GetName()
-            fieldType = fieldDef.GetType()
-            npDtypes.append((fieldName, OGRTypes[fieldType]))
-            fields.append(fieldName)
-
-        # Read the input CSV file
-        append_dtypes = [('LAT', numpy.float64), ('LON', numpy.float64), ('FID', numpy.int)]
-        addDtypes = [item for item in append_dtypes if item[0] not in [item2[0] for item2 in npDtypes]]    # Eliminate redundancy
-        dtypes = numpy.dtype(npDtypes + addDtypes)                              # Create numpy dtype object, adding in any required fields
-        csv_arr = numpy.empty(featureCount, dtype=dtypes)
+        # Read shapefile fields and geometries in columnar form
+        geoms, columns = read_layer_columnar(layer)
 
         # create the spatial reference for output, WGS84
         outSR = osr.SpatialReference()
@@ -176,18 +147,15 @@ if __name__ == '__main__':
             transform = osr.CoordinateTransformation(inSR, outSR)
 
         # Build the numpy array using info in the fields or geometries of the shapefile
-        for num,feature in enumerate(layer):
-            geom = feature.GetGeometryRef().Clone()
-            if mustTransform:
-                geom.Transform(transform)
-            csv_arr[fields][num] = tuple([feature.GetField(field) for field in fields])
-            if 'LAT' not in npDtypes:
-                csv_arr['LAT'][num] = geom.GetY(0)
-            if 'LON' not in npDtypes:
-                csv_arr['LON'][num] = geom.GetX(0)
-            if 'FID' not in npDtypes:
-                csv_arr['FID'][num] = num
-        layer.ResetReading()
+        x = shapely.get_x(geoms)                                                # Point coordinates
+        y = shapely.get_y(geoms)
+        if mustTransform:
+            x, y = transform_points(transform, x, y)
+        for fieldName, values in [('LAT', y), ('LON', x), ('FID', numpy.arange(featureCount))]:
+            if fieldName not in columns:
+                columns[fieldName] = values                                     # Fill in any required fields that are missing
+        csv_arr = numpy.rec.fromarrays(list(columns.values()), names=list(columns.keys()))
+        del geoms, x, y, columns
 
         numpy.savetxt(outCSV, csv_arr, fmt='%s', delimiter=',', header=','.join(csv_arr.dtype.names), comments='')
 
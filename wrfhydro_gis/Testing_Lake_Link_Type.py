@@ -0,0 +1,145 @@
+# *=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=
+# Copyright UCAR (c) 2020
+# University Corporation for Atmospheric Research(UCAR)
+# National Center for Atmospheric Research(NCAR)
+# Research Applications Laboratory(RAL)
+# P.O.Box 3000, Boulder, Colorado, 80307-3000, USA
+#
+# Name:        Testing_Lake_Link_Type.py
+# Purpose:
+# Author:      $ Kevin Sampson(ksampson)
+# Created:     2020
+# Licence:     <your licence>
+# *=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=
+
+descText = "This tool builds synthetic NHD-like flowline networks with lakes of " +\
+            "varying size, including chained lakes and lakes with secondary outlets, " +\
+            "and times the Lake_Link_Type function on each network. This tool may be " +\
+            "used to test the scaling of the reach-based lake routing pre-processing " +\
+            "with the number of flowlines and lakes in the domain."
+
+# --- Import Modules --- #
+
+# Import Python core modules
+import sys
+sys.dont_write_bytecode = True
+import time
+import io
+import contextlib
+from argparse import ArgumentParser
+
+# Import Additional Modules
+import numpy
+
+# Import function library into namespace. Must exist in same directory as this script.
+import wrfhydro_functions as wrfh                                               # Function script packaged with this toolbox
+
+# --- End Import Modules --- #
+
+# --- Global Variables --- #
+
+# Default values
+default_sizes = '10000,50000,100000'                                            # Default number of flowlines in each synthetic network
+default_lake_ratio = 15                                                         # Default number of flowlines per lake
+default_seed = 1                                                                # Default random seed
+default_processes = 1                                                           # Default number of processes used by Lake_Link_Type
+
+# --- End Global Variables --- #
+
+# --- Functions --- #
+def synthetic_network(nlinks, nlakes, seed=default_seed):
+    '''
+    Build a synthetic flowline network and flowline:lake association array.
+    Flowlines are numbered from upstream to downstream, and each flowline drains
+    to a flowline with a larger ID (or to 0, a terminal flowline). Lakes are grown
+    upstream from a random flowline, and some lakes are given an extra flowline
+    elsewhere in the network to produce secondary outlets.
+    '''
+    rng = numpy.random.default_rng(seed)
+    links = numpy.arange(1, nlinks+1)
+    to = numpy.zeros(nlinks, dtype=int)
+    for i in range(nlinks-1):
+        if rng.random() < 0.97:
+            to[i] = rng.integers(i+2, min(nlinks, i+20)+1)                     # Drain to a nearby downstream flowline
+    FromComIDs = dict(zip(links.tolist(), to.tolist()))
+
+    # Gather upstream flowlines for each flowline
+    FromSegs = {}
+    for key,val in FromComIDs.items():
+        FromSegs.setdefault(val, []).append(key)
+
+    # Grow each lake upstream from a seed flowline
+    WaterbodyDict = {}
+    for lake in range(nlakes):
+        LakeID = 100000 + lake
+        front = [int(rng.integers(1, nlinks+1))]
+        size = int(rng.integers(1, 8))
+        members = []
+        while front and len(members) < size:
+            link = front.pop(0)
+            members.append(link)
+            front += FromSegs.get(link, [])
+        if rng.random() < 0.2:
+            members.append(int(rng.integers(1, nlinks+1)))                     # Disconnected link to create a secondary outlet
+        WaterbodyDict.update({member:LakeID for member in members})
+
+    # Construct the arrays in the same form as LK_main
+    dtype = dict(names=(wrfh.FLID, wrfh.LakeAssoc), formats=('<i4', '<i4'))
+    FLWBarr = numpy.array(list(WaterbodyDict.items()), dtype=dtype)
+    order = numpy.empty(nlinks, dtype=numpy.dtype([(wrfh.FLID, 'i4'), (wrfh.hydroSeq, 'i4')]))
+    order[wrfh.FLID] = links
+    order[wrfh.hydroSeq] = numpy.arange(nlinks)[::-1]
+    return FLWBarr, FromComIDs, order
+
+def benchmark(sizes, lake_ratio, seed, processes=default_processes):
+    for nlinks in sizes:
+        nlakes = max(1, nlinks//lake_ratio)
+        FLWBarr, FromComIDs, order = synthetic_network(nlinks, nlakes, seed=seed)
+        tic1 = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):                         # Silence the per-step messages
+            outputs = wrfh.Lake_Link_Type(FLWBarr, FromComIDs, order, processes=processes)
+        Lake_Link_Type_arr, problem_lakes, seen, ChainedLakes = outputs[:4]
+        print('  {0} flowlines, {1} lakes: {2} lake links, {3} problem lakes, {4} chained lakes in {5:3.2f} seconds.'.format(
+            nlinks, numpy.unique(FLWBarr[wrfh.LakeAssoc]).shape[0], Lake_Link_Type_arr.shape[0],
+            len(problem_lakes), len(ChainedLakes), time.time()-tic1))
+
+# --- End Functions --- #
+
+# --- Main Codeblock --- #
+if __name__ == '__main__':
+    print('Script initiated at {0}'.format(time.ctime()))
+    tic = time.time()
+
+    # Setup the input arguments
+    parser = ArgumentParser(description=descText, add_help=True)
+    parser.add_argument("-n",
+                        dest="sizes",
+                        default=default_sizes,
+                        help="Comma-separated list of the number of flowlines in each synthetic network.")
+    parser.add_argument("-r",
+                        dest="lake_ratio",
+                        type=int,
+                        default=default_lake_ratio,
+                        help="Number of flowlines per lake.")
+    parser.add_argument("-s",
+                        dest="seed",
+                        type=int,
+                        default=default_seed,
+                        help="Random seed for the synthetic networks.")
+    parser.add_argument("-p",
+                        dest="processes",
+                        type=int,
+                        default=default_processes,
+                        help="Number of processes used to classify independent groups of lakes.")
+    args = parser.parse_args()
+
+    # Print information to screen
+    print('  Values that will be used in this benchmark:')
+    print('    Network sizes: {0}'.format(args.sizes))
+    print('    Flowlines per lake: {0}'.format(args.lake_ratio))
+    print('    Random seed: {0}'.format(args.seed))
+    print('    Processes: {0}\n'.format(args.processes))
+
+    benchmark([int(item) for item in args.sizes.split(',')], args.lake_ratio, args.seed, processes=args.processes)
+    print('Process completed in {0:3.2f} seconds.'.format(time.time()-tic))
+# --- End Main Codeblock --- #
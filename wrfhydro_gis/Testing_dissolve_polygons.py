@@ -0,0 +1,108 @@
+# *=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=
+# Copyright UCAR (c) 2020
+# University Corporation for Atmospheric Research(UCAR)
+# National Center for Atmospheric Research(NCAR)
+# Research Applications Laboratory(RAL)
+# P.O.Box 3000, Boulder, Colorado, 80307-3000, USA
+#
+# Name:        Testing_dissolve_polygons.py
+# Purpose:
+# Author:      $ Kevin Sampson(ksampson)
+# Created:     2020
+# Licence:     <your licence>
+# *=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=
+
+descText = "This tool builds an in-memory polygon layer with two IDs, each made " +\
+            "of several polygons, and checks the output of the " +\
+            "dissolve_polygon_to_multipolygon function, with and without the union " +\
+            "option. Each ID must be dissolved to a single feature, with the area and " +\
+            "number of parts of its input polygons."
+
+# --- Import Modules --- #
+
+# Import Python core modules
+import sys
+sys.dont_write_bytecode = True
+import time
+from argparse import ArgumentParser
+
+# Import Additional Modules
+from osgeo import ogr
+from osgeo import osr
+
+# Import function library into namespace. Must exist in same directory as this script.
+import wrfhydro_functions as wrfh                                               # Function script packaged with this toolbox
+
+# --- End Import Modules --- #
+
+# --- Global Variables --- #
+
+# Default values
+default_nparts = 3                                                              # Default number of polygons for each ID
+default_processes = 1                                                           # Default number of processes used for the union option
+
+# --- End Global Variables --- #
+
+# --- Functions --- #
+def synthetic_layer(nparts):
+    '''
+    Build an in-memory layer of square polygons (1 km on a side) with two IDs,
+    each made of 'nparts' squares that do not touch, in interleaved order.
+    '''
+    srs = osr.SpatialReference()
+    srs.ImportFromProj4('+proj=lcc +lat_1=30 +lat_2=60 +lat_0=40.0 +lon_0=-97.0 +x_0=0 +y_0=0 +a=6370000 +b=6370000 +units=m +no_defs')
+    ds = ogr.GetDriverByName('MEMORY').CreateDataSource('')
+    layer = ds.CreateLayer('lakes', srs, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('ID', ogr.OFTInteger))
+    layer.CreateField(ogr.FieldDefn('AREASQKM', ogr.OFTReal))
+    layerDefn = layer.GetLayerDefn()
+    for num in range(nparts*2):
+        x0 = num*2000.
+        y0 = (num % 2)*5000.
+        geom = ogr.CreateGeometryFromWkt('POLYGON (({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(x0, y0, x0+1000., y0+1000.))
+        feature = ogr.Feature(layerDefn)
+        feature.SetField('ID', (num % 2) + 1)
+        feature.SetField('AREASQKM', 1.)
+        feature.SetGeometry(geom)
+        layer.CreateFeature(feature)
+        feature = geom = None
+    return ds, layer
+
+def check_dissolve(nparts, union=False, processes=default_processes):
+    ds, layer = synthetic_layer(nparts)
+    out_ds = wrfh.dissolve_polygon_to_multipolygon(ds, layer, 'ID', union=union, processes=processes)
+    out_layer = out_ds.GetLayer()
+    assert out_layer.GetFeatureCount() == 2, 'Expected 2 dissolved features, found {0}'.format(out_layer.GetFeatureCount())
+    for feature in out_layer:
+        geom = feature.GetGeometryRef()
+        assert geom.GetGeometryCount() == nparts, 'ID {0}: expected {1} parts, found {2}'.format(feature.GetField('ID'), nparts, geom.GetGeometryCount())
+        assert abs(feature.GetField('AREASQKM') - nparts) < 1e-6, 'ID {0}: expected {1} km2, found {2}'.format(feature.GetField('ID'), nparts, feature.GetField('AREASQKM'))
+        feature = geom = None
+    print('  Dissolved {0} polygons to 2 features (union={1}).'.format(nparts*2, union))
+    out_layer = out_ds = layer = ds = None
+
+# --- End Functions --- #
+
+# --- Main Codeblock --- #
+if __name__ == '__main__':
+    print('Script initiated at {0}'.format(time.ctime()))
+    tic = time.time()
+
+    # Setup the input arguments
+    parser = ArgumentParser(description=descText, add_help=True)
+    parser.add_argument("-n",
+                        dest="nparts",
+                        type=int,
+                        default=default_nparts,
+                        help="Number of polygons for each of the two IDs.")
+    parser.add_argument("-p",
+                        dest="processes",
+                        type=int,
+                        default=default_processes,
+                        help="Number of processes used for the union option.")
+    args = parser.parse_args()
+
+    check_dissolve(args.nparts, union=False)
+    check_dissolve(args.nparts, union=True, processes=args.processes)
+    print('Process completed in {0:3.2f} seconds.'.format(time.time()-tic))
+# --- End Main Codeblock --- #
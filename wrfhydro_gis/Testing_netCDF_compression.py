@@ -0,0 +1,171 @@
+# *=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=
+# Copyright UCAR (c) 2020
+# University Corporation for Atmospheric Research(UCAR)
+# National Center for Atmospheric Research(NCAR)
+# Research Applications Laboratory(RAL)
+# P.O.Box 3000, Boulder, Colorado, 80307-3000, USA
+#
+# Name:        Testing_netCDF_compression.py
+# Purpose:
+# Author:      $ Kevin Sampson(ksampson)
+# Created:     2020
+# Licence:     <your licence>
+# *=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=
+
+descText = "This tool writes a synthetic Fulldom_hires.nc-like file (mostly-NoData " +\
+            "integer layers, smooth float layers and constant parameter layers) using " +\
+            "several chunking and compression profiles, and reports the write time, the " +\
+            "time to read every layer back and the file size for each profile. This tool " +\
+            "may be used to choose the ncZlib, ncComplevel, ncShuffle, ncChunk and " +\
+            "ncLeastSignificantDigit settings in wrfhydro_functions.py for a domain."
+
+# --- Import Modules --- #
+
+# Import Python core modules
+import sys
+sys.dont_write_bytecode = True
+import os
+import time
+import tempfile
+from argparse import ArgumentParser
+
+# Import Additional Modules
+import netCDF4
+import numpy
+
+# Import function library into namespace. Must exist in same directory as this script.
+import wrfhydro_functions as wrfh                                               # Function script packaged with this toolbox
+
+# --- End Import Modules --- #
+
+# --- Global Variables --- #
+
+# Default values
+default_rows = 4000                                                             # Default number of rows in the synthetic routing grid
+default_cols = 4000                                                             # Default number of columns in the synthetic routing grid
+default_seed = 1                                                                # Default random seed
+
+# Profiles to compare: (name, zlib, complevel, shuffle, chunk, least_significant_digit)
+profiles = [('contiguous', False, 0, False, None, None),
+            ('zlib1', True, 1, True, None, None),
+            ('zlib4', True, 4, True, None, None),
+            ('zlib4_noshuffle', True, 4, False, None, None),
+            ('zlib4_chunk256', True, 4, True, (256, 256), None),
+            ('zlib4_chunk1024', True, 4, True, (1024, 1024), None),
+            ('zlib9_chunk512', True, 9, True, (512, 512), None),
+            ('zlib4_chunk512_lsd3', True, 4, True, (512, 512), 3)]
+
+# --- End Global Variables --- #
+
+# --- Functions --- #
+def smooth_field(rng, nrows, ncols, block=64):
+    '''
+    Build a smooth random field by bilinear interpolation of a coarse random grid.
+    '''
+    coarse = rng.random((nrows//block+2, ncols//block+2))
+    r = numpy.arange(nrows)/block
+    c = numpy.arange(ncols)/block
+    r0, c0 = r.astype(int), c.astype(int)
+    fr, fc = (r-r0)[:,None], (c-c0)[None,:]
+    return ((1-fr)*(1-fc)*coarse[r0][:,c0] + fr*(1-fc)*coarse[r0+1][:,c0] +
+            (1-fr)*fc*coarse[r0][:,c0+1] + fr*fc*coarse[r0+1][:,c0+1])
+
+def synthetic_layers(nrows, ncols, seed=default_seed):
+    '''
+    Build a dictionary of {name: array} resembling the layers of a Fulldom file.
+    Channel, lake and forecast point layers are NoData outside of a small number
+    of cells, as they are on fine routing grids.
+    '''
+    rng = numpy.random.default_rng(seed)
+    NoData = wrfh.NoDataVal
+    layers = {}
+    layers['TOPOGRAPHY'] = (smooth_field(rng, nrows, ncols)*2000 + rng.random((nrows, ncols))).astype('f4')
+    layers['FLOWDIRECTION'] = rng.choice(numpy.array([1,2,4,8,16,32,64,128], dtype='i2'), size=(nrows, ncols))
+    layers['FLOWACC'] = numpy.floor(rng.lognormal(1, 2, size=(nrows, ncols))).astype('i4')
+    channel = layers['FLOWACC'] > 200
+    layers['CHANNELGRID'] = numpy.where(channel, 0, NoData).astype('i4')
+    layers['STREAMORDER'] = numpy.where(channel, rng.integers(1, 6, size=(nrows, ncols)), NoData).astype('i1')
+    layers['frxst_pts'] = numpy.full((nrows, ncols), NoData, dtype='i4')
+    layers['frxst_pts'].flat[rng.choice(nrows*ncols, 50, replace=False)] = numpy.arange(1, 51)
+    layers['basn_msk'] = numpy.where(smooth_field(rng, nrows, ncols, block=512) > 0.5, rng.integers(1, 50), NoData).astype('i4')
+    layers['LAKEGRID'] = numpy.where(smooth_field(rng, nrows, ncols, block=16) > 0.97, 1000, NoData).astype('i4')
+    layers['landuse'] = numpy.floor(smooth_field(rng, nrows, ncols, block=8)*20).astype('f4')
+    for name in ['RETDEPRTFAC', 'OVROUGHRTFAC', 'LKSATFAC']:
+        layers[name] = numpy.ones((nrows, ncols), dtype='f4')
+    layers['LATITUDE'] = numpy.repeat(numpy.linspace(50, 25, nrows, dtype='f4')[:,None], ncols, axis=1)
+    layers['LONGITUDE'] = numpy.repeat(numpy.linspace(-125, -65, ncols, dtype='f4')[None,:], nrows, axis=0)
+    return layers
+
+def benchmark(layers, out_dir):
+    nrows, ncols = layers['TOPOGRAPHY'].shape
+    print('  {0:<22} {1:>10} {2:>10} {3:>12}'.format('Profile', 'Write (s)', 'Read (s)', 'Size (MB)'))
+    for name, zlib, complevel, shuffle, chunk, lsd in profiles:
+        out_file = os.path.join(out_dir, 'Fulldom_{0}.nc'.format(name))
+
+        # Write
+        tic1 = time.time()
+        rootgrp = netCDF4.Dataset(out_file, 'w', format=wrfh.outNCType)
+        rootgrp.createDimension('y', nrows)
+        rootgrp.createDimension('x', ncols)
+        for varname, arr in layers.items():
+            options = wrfh.nc_var_options(rootgrp, ('y', 'x'), arr.dtype, zlib=zlib, complevel=complevel,
+                                            shuffle=shuffle, chunk=chunk, least_significant_digit=lsd)
+            rootgrp.createVariable(varname, arr.dtype, ('y', 'x'), **options)[:] = arr
+        rootgrp.close()
+        write_time = time.time()-tic1
+
+        # Read every layer back
+        tic1 = time.time()
+        rootgrp = netCDF4.Dataset(out_file, 'r')
+        for varname in layers:
+            arr = rootgrp.variables[varname][:]
+        rootgrp.close()
+        read_time = time.time()-tic1
+
+        print('  {0:<22} {1:>10.2f} {2:>10.2f} {3:>12.1f}'.format(name, write_time, read_time, os.path.getsize(out_file)/1e6))
+        wrfh.remove_file(out_file)
+
+# --- End Functions --- #
+
+# --- Main Codeblock --- #
+if __name__ == '__main__':
+    print('Script initiated at {0}'.format(time.ctime()))
+    tic = time.time()
+
+    # Setup the input arguments
+    parser = ArgumentParser(description=descText, add_help=True)
+    parser.add_argument("-r",
+                        dest="nrows",
+                        type=int,
+                        default=default_rows,
+                        help="Number of rows in the synthetic routing grid.")
+    parser.add_argument("-c",
+                        dest="ncols",
+                        type=int,
+                        default=default_cols,
+                        help="Number of columns in the synthetic routing grid.")
+    parser.add_argument("-s",
+                        dest="seed",
+                        type=int,
+                        default=default_seed,
+                        help="Random seed for the synthetic layers.")
+    parser.add_argument("-o",
+                        dest="out_dir",
+                        default='',
+                        help="Directory to write the test files to (on the file system to be tested). Default is a temporary directory.")
+    args = parser.parse_args()
+
+    # Print information to screen
+    print('  Values that will be used in this benchmark:')
+    print('    Grid size: {0} rows x {1} columns'.format(args.nrows, args.ncols))
+    print('    Random seed: {0}'.format(args.seed))
+    print('    Output directory: {0}\n'.format(args.out_dir if args.out_dir else 'temporary directory'))
+
+    layers = synthetic_layers(args.nrows, args.ncols, seed=args.seed)
+    if args.out_dir:
+        benchmark(layers, args.out_dir)
+    else:
+        with tempfile.TemporaryDirectory() as out_dir:
+            benchmark(layers, out_dir)
+    print('Process completed in {0:3.2f} seconds.'.format(time.time()-tic))
+# --- End Main Codeblock --- #
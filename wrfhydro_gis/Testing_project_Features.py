@@ -0,0 +1,153 @@
+# *=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=
+# Copyright UCAR (c) 2020
+# University Corporation for Atmospheric Research(UCAR)
+# National Center for Atmospheric Research(NCAR)
+# Research Applications Laboratory(RAL)
+# P.O.Box 3000, Boulder, Colorado, 80307-3000, USA
+#
+# Name:        Testing_project_Features.py
+# Purpose:
+# Author:      $ Kevin Sampson(ksampson)
+# Created:     2020
+# Licence:     <your licence>
+# *=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=
+
+descText = "This tool builds a synthetic national-scale lake polygon dataset in " +\
+            "geographic coordinates and times the project_Features function when " +\
+            "projecting and clipping it to a small Lambert Conformal Conic domain, " +\
+            "with and without the spatial prefilter. This tool may be used to test " +\
+            "the cost of reading large lake, groundwater basin or channel initiation " +\
+            "point inputs for small domains."
+
+# --- Import Modules --- #
+
+# Import Python core modules
+import sys
+sys.dont_write_bytecode = True
+import os
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser
+
+# Import Additional Modules
+import numpy
+from osgeo import ogr
+from osgeo import osr
+
+# Import function library into namespace. Must exist in same directory as this script.
+import wrfhydro_functions as wrfh                                               # Function script packaged with this toolbox
+
+# --- End Import Modules --- #
+
+# --- Global Variables --- #
+
+# Default values
+default_nfeatures = 500000                                                      # Default number of lakes in the synthetic national dataset
+default_domain_size = 200000.0                                                  # Default width and height of the domain (m)
+default_seed = 1                                                                # Default random seed
+default_driver = 'GPKG'                                                         # Default OGR driver for the synthetic dataset
+
+# Extent of the synthetic national dataset (CONUS, decimal degrees)
+national_extent = (-125.0, -67.0, 25.0, 50.0)                                   # (minX, maxX, minY, maxY)
+
+# Lambert Conformal Conic domain projection, centered on the domain
+domain_proj4 = '+proj=lcc +lat_1=30 +lat_2=60 +lat_0=40.0 +lon_0=-97.0 +x_0=0 +y_0=0 +a=6370000 +b=6370000 +units=m +no_defs'
+
+# --- End Global Variables --- #
+
+# --- Functions --- #
+def synthetic_lakes(out_file, nfeatures, driver_name=default_driver, seed=default_seed):
+    '''
+    Write a polygon layer of small rectangular "lakes" distributed randomly over
+    the national extent, in WGS84 coordinates.
+    '''
+    rng = numpy.random.default_rng(seed)
+    minX, maxX, minY, maxY = national_extent
+    xs = rng.uniform(minX, maxX, nfeatures)
+    ys = rng.uniform(minY, maxY, nfeatures)
+    sizes = rng.uniform(0.001, 0.02, nfeatures)
+
+    sr = osr.SpatialReference()
+    sr.ImportFromProj4(wrfh.wgs84_proj4)
+    driver = ogr.GetDriverByName(driver_name)
+    ds = driver.CreateDataSource(out_file)
+    layer = ds.CreateLayer('lakes', sr, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('COMID', ogr.OFTInteger))
+    layerDef = layer.GetLayerDefn()
+    layer.StartTransaction()
+    for num, (x, y, size) in enumerate(zip(xs.tolist(), ys.tolist(), sizes.tolist())):
+        feature = ogr.Feature(layerDef)
+        feature.SetField('COMID', num+1)
+        feature.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON (({0} {1},{2} {1},{2} {3},{0} {3},{0} {1}))'.format(x, y, x+size, y+size)))
+        layer.CreateFeature(feature)
+        feature = None
+    layer.CommitTransaction()
+    ds = layer = None
+
+def domain_boundary(domain_size):
+    '''
+    Return a rectangular domain boundary geometry of domain_size meters, centered
+    on the origin of the Lambert Conformal Conic projection.
+    '''
+    proj = osr.SpatialReference()
+    proj.ImportFromProj4(domain_proj4)
+    half = domain_size/2.0
+    geom = ogr.CreateGeometryFromWkt('POLYGON (({0} {0},{1} {0},{1} {1},{0} {1},{0} {0}))'.format(-half, half))
+    geom.AssignSpatialReference(proj)
+    return geom, proj
+
+def benchmark(in_file, domain_size):
+    geom, proj = domain_boundary(domain_size)
+    for prefilter in [False, True]:
+        tic1 = time.time()
+        ds, layer, fieldNames = wrfh.project_Features(in_file, proj, clipGeom=geom, prefilter=prefilter)
+        print('  prefilter={0}: {1} features in {2:3.2f} seconds.'.format(prefilter, layer.GetFeatureCount(), time.time()-tic1))
+        ds = layer = None
+
+# --- End Functions --- #
+
+# --- Main Codeblock --- #
+if __name__ == '__main__':
+    print('Script initiated at {0}'.format(time.ctime()))
+    tic = time.time()
+
+    # Setup the input arguments
+    parser = ArgumentParser(description=descText, add_help=True)
+    parser.add_argument("-n",
+                        dest="nfeatures",
+                        type=int,
+                        default=default_nfeatures,
+                        help="Number of lakes in the synthetic national dataset.")
+    parser.add_argument("-d",
+                        dest="domain_size",
+                        type=float,
+                        default=default_domain_size,
+                        help="Width and height of the domain (m).")
+    parser.add_argument("-s",
+                        dest="seed",
+                        type=int,
+                        default=default_seed,
+                        help="Random seed for the synthetic dataset.")
+    parser.add_argument("-f",
+                        dest="driver",
+                        default=default_driver,
+                        help="OGR driver for the synthetic dataset ('GPKG' or 'ESRI Shapefile').")
+    args = parser.parse_args()
+
+    # Print information to screen
+    print('  Values that will be used in this benchmark:')
+    print('    Number of lakes: {0}'.format(args.nfeatures))
+    print('    Domain size: {0}m'.format(args.domain_size))
+    print('    Random seed: {0}'.format(args.seed))
+    print('    Driver: {0}\n'.format(args.driver))
+
+    tempdir = tempfile.mkdtemp()
+    in_file = os.path.join(tempdir, 'lakes.gpkg' if args.driver == 'GPKG' else 'lakes.shp')
+    tic1 = time.time()
+    synthetic_lakes(in_file, args.nfeatures, driver_name=args.driver, seed=args.seed)
+    print('  Built synthetic dataset in {0:3.2f} seconds.'.format(time.time()-tic1))
+    benchmark(in_file, args.domain_size)
+    shutil.rmtree(tempdir)
+    print('Process completed in {0:3.2f} seconds.'.format(time.time()-tic))
+# --- End Main Codeblock --- #
@@ -0,0 +1,93 @@
+# *=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=
+# Copyright UCAR (c) 2020
+# University Corporation for Atmospheric Research(UCAR)
+# National Center for Atmospheric Research(NCAR)
+# Research Applications Laboratory(RAL)
+# P.O.Box 3000, Boulder, Colorado, 80307-3000, USA
+#
+# Name:        Update_Forecast_Points.py
+# Purpose:
+# Author:      $ Kevin Sampson(ksampson)
+# Created:     2020
+# Licence:     <your licence>
+# *=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=
+
+descText = "This tool adds or moves forecast points in an existing WRF-Hydro routing stack " +\
+            "without re-running the terrain processing. Forecast points from the input CSV " +\
+            "file are snapped using the FLOWACC and CHANNELGRID layers stored in the " +\
+            "Fulldom_hires.nc file, and frxst_pts and basn_msk are updated in place only " +\
+            "upstream of the new or moved points. The cells and basin of the existing forecast " +\
+            "points are read from the Forecast_Point_Basins.csv file written with the routing " +\
+            "stack, which is also updated in place. If a Route_Link.nc file is provided, its " +\
+            "'gages' field is also updated in place. Forecast points that are not in the " +\
+            "CSV file are left unchanged. Make a copy of the input files first if needed."
+
+# --- Import Modules --- #
+
+# Import Python core modules
+import sys
+sys.dont_write_bytecode = True
+import time
+from argparse import ArgumentParser
+
+# Import Additional Modules
+import netCDF4
+
+# Import function library into namespace. Must exist in same directory as this script.
+import wrfhydro_functions as wrfh                                               # Function script packaged with this toolbox
+
+# --- End Import Modules --- #
+
+# --- Global Variables --- #
+
+# Default values
+defaultFulldom = 'Fulldom_hires.nc'
+
+# --- End Global Variables --- #
+
+# --- Main Codeblock --- #
+if __name__ == '__main__':
+    print('Script initiated at {0}'.format(time.ctime()))
+    tic = time.time()
+
+    # Setup the input arguments
+    parser = ArgumentParser(description=descText, add_help=True)
+    parser.add_argument("-i",
+                        dest="in_fulldom",
+                        default='./{0}'.format(defaultFulldom),
+                        help="Path to existing WRF-Hydro Fulldom_hires.nc file.")
+    parser.add_argument("-f",
+                        dest="in_csv",
+                        required=True,
+                        help="Path to forecast point CSV file (FID, LAT, LON fields) of the points to add or move.")
+    parser.add_argument("-b",
+                        dest="in_basins",
+                        default='./{0}'.format(wrfh.gageBasinCSV),
+                        help="Path to existing {0} file written with the routing stack.".format(wrfh.gageBasinCSV))
+    parser.add_argument("-r",
+                        dest="in_RL",
+                        default='',
+                        help="Path to existing Route_Link.nc file. If provided, the 'gages' field will be updated.")
+
+    # If no arguments are supplied, print help message
+    if len(sys.argv) == 1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+    args = parser.parse_args()
+
+    # Print information to screen
+    print('  Values that will be used in updating the forecast points:')
+    print('    Input Fulldom file: {0}'.format(args.in_fulldom))
+    print('    Input forecast points CSV: {0}'.format(args.in_csv))
+    print('    Input forecast point basins CSV: {0}'.format(args.in_basins))
+    print('    Input Route_Link file: {0}\n'.format(args.in_RL))
+
+    # Update the Fulldom and Route_Link files with the new forecast points
+    rootgrp = netCDF4.Dataset(args.in_fulldom, 'r+')
+    rootgrp.set_auto_mask(False)
+    fine_grid = wrfh.WRF_Hydro_Grid(rootgrp)                                     # Fulldom carries the routing grid spacing
+    rootgrp = wrfh.update_forecast_points(args.in_csv, rootgrp, fine_grid, args.in_basins, in_RL=args.in_RL)
+    rootgrp.close()
+    del rootgrp, fine_grid
+    print('Process completed in {0:3.2f} seconds.'.format(time.time()-tic))
+# --- End Main Codeblock --- #
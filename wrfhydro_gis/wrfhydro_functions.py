@@ -36,6 +36,9 @@ from operator import itemgetter
 import collections                                                              # Added 03/28/2023 Used in the group_min function
 from collections import defaultdict                                             # Added 09/03/2015 Needed for topological sorting algorthm
 from itertools import takewhile, count                                          # Added 09/03/2015 Needed for topological sorting algorthm
+from concurrent.futures import ProcessPoolExecutor                              # Used to classify independent groups of lakes in Lake_Link_Type
+from concurrent.futures import ThreadPoolExecutor                               # Used to rasterize bands of rows in FeatToRaster
+from concurrent.futures import wait, FIRST_COMPLETED                            # Used to schedule stages in StageGraph
 import platform                                                                 # Added 8/20/2020 to detect OS
 from packaging.version import parse as LooseVersion                             # To avoid deprecation warnings
 
@@ -49,6 +52,7 @@ import osgeo
 
 from shapely.geometry import LineString                                         # Added 03/28/2023 to support line midpoint geometry generation for RouteLink
 from shapely import wkt                                                         # Added 03/28/2023 to support line midpoint geometry generation for RouteLink
+import shapely                                                                  # Shapely >= 2.0 array functions and STRtree, used in Waterbody_SpatialJoin
 
 try:
     if LooseVersion(osgeo.__version__) > LooseVersion('3.0'):
@@ -66,6 +70,12 @@ try:
 except:
     sys.exit('ERROR: cannot find GDAL/OGR modules')
 
+try:
+    import pyarrow                                                              # Optional. Enables columnar (Arrow) vector writes with GDAL >= 3.8
+    import pyarrow.csv                                                          # Optional. Enables vectorized reads of point CSV files
+except ImportError:
+    pyarrow = None
+
 # Import whitebox
 #from whitebox.WBT.whitebox_tools import WhiteboxTools
 from whitebox.whitebox_tools import WhiteboxTools
@@ -89,6 +99,9 @@ os.environ["PROJ_LIB"] = internal_datadir
 # GDAL/OGR Raster and Vector outupt driver options
 RasterDriver = 'GTiff'
 VectorDriver = 'ESRI Shapefile'                                                # Output vector file format (OGR driver name)
+useArrowWrite = True                                                            # Write vector attributes through the OGR Arrow interface when pyarrow and GDAL >= 3.8 are available
+useArrowRead = True                                                             # Read vector layers as Arrow record batches when pyarrow and GDAL >= 3.6 are available
+useGeoPackage = False                                                           # Write streams and lakes layers to a single GeoPackage (with R-tree spatial index) instead of shapefiles
 
 # Version numbers toa ppend to metadata
 WRFH_Version = 5.2                                                              # WRF-Hydro version to be executed using the outputs of this tool
@@ -98,6 +111,13 @@ CFConv = 'CF-1.5'
 # Output netCDF format
 outNCType = 'NETCDF4_CLASSIC'                                                   # Define the output netCDF version for RouteLink.nc and LAKEPARM.nc
 
+# Chunking and compression of gridded netCDF outputs (Fulldom_hires.nc, GWBASINS.nc, spatial metadata). Ignored for NETCDF3 formats.
+ncZlib = False                                                                  # Compress 2D variables with zlib
+ncComplevel = 4                                                                 # zlib compression level (1=fastest, 9=smallest)
+ncShuffle = True                                                                # Apply the shuffle filter before compression (helps integer layers that are mostly NoData)
+ncChunk = None                                                                  # Chunk shape (rows, columns) of 2D variables, e.g. (512, 512). None = library default if compressed, otherwise contiguous
+ncLeastSignificantDigit = None                                                  # Quantize float variables to this many decimal places before compression (None = lossless)
+
 ###################################################
 # Default output file names
 FullDom = 'Fulldom_hires.nc'                                                    # Default Full Domain routing grid nc file
@@ -110,7 +130,10 @@ GWGRID_nc = 'GWBASINS.nc'
 GW_ASCII = 'gw_basns_geogrid.txt'                                               # Default Groundwater Basins ASCII grid output
 GW_TBL = 'GWBUCKPARM.TBL'
 LakesSHP = 'lakes.shp'                                                          # Default lakes shapefile name
+VectorGPKG = 'routing_vectors.gpkg'                                             # Default GeoPackage name for streams and lakes layers if useGeoPackage = True
 minDepthCSV = 'Lakes_with_minimum_depth.csv'                                    # Output file containing lakes with minimum depth enforced.
+gageHierCSV = 'Forecast_Point_Hierarchy.csv'                                    # Output file containing the forecast point each forecast point drains to
+gageBasinCSV = 'Forecast_Point_Basins.csv'                                      # Output file containing the frxst_pts cell, basn_msk label and outlet of each forecast point
 basinRaster = 'GWBasins.tif'                                                    # Output file name for raster grid of groundwater bucket locations
 ###################################################
 
@@ -173,6 +196,19 @@ Mannings_Bw = {1:1.6,
                8:16.,
                9:26.,
                10:110.}                                                         # Values from LR 7/01/2020
+
+# Columnar RouteLink table accepted by build_RouteLink (one row per link, in topological order)
+RouteLink_dtype = numpy.dtype([('link', 'i4'),                                  # Link ID
+                                ('to', 'i4'),                                   # Downstream link ID (0 = none)
+                                ('lon', 'f8'),                                  # Longitude of the link midpoint
+                                ('lat', 'f8'),                                  # Latitude of the link midpoint
+                                ('x', 'f8'),                                    # Projected x coordinate of the start node
+                                ('y', 'f8'),                                    # Projected y coordinate of the start node
+                                ('alt', 'f8'),                                  # Elevation of the start node (m)
+                                ('Length', 'f8'),                               # Link length (m)
+                                ('order', 'i4'),                                # Strahler stream order
+                                ('So', 'f8'),                                   # Slope (unitless drop/length)
+                                ('gages', 'S15')])                              # Gage ID (empty for none)
 ###################################################
 
 ###################################################
@@ -196,6 +232,13 @@ NoDownstream = [None, -1, 0]
 LkNodata = 0                                                                    # Set the nodata value for the link-to-lake association
 hydroSeq = 'HydroSeq'                                                           # Fieldname that stores a hydrologic sequence (ascending from downstream to upstream)
 save_Lake_Link_Type_arr = True                                                  # Switch for saving the Lake_Link_Type_arr array to CSV
+LakeProcesses = 1                                                               # Number of processes used to classify independent groups of lakes in Lake_Link_Type (1 = single process)
+RasterizeThreads = 1                                                            # Number of threads used to rasterize features in FeatToRaster (1 = single thread)
+StageWorkers = 1                                                                # Number of threads used to run independent stages of the routing stack build (1 = one stage at a time)
+useFulldomMemmap = False                                                        # Stage Fulldom layers in memory-mapped files in the project directory instead of in memory
+useCompactLayers = False                                                        # Stage Fulldom layers in compact types, and constant layers as scalars (output file types are unchanged)
+compactLayerTypes = {'FLOWDIRECTION':'u1',                                      # Esri D8 values and 255 (NoData) fit in 8 bits
+                    'landuse':'i2'}                                             # Land use class codes
 ###################################################
 
 ###################################################
@@ -247,9 +290,6 @@ dir_d8 = "dir_d8.tif"
 streams = "streams.tif"
 strahler = "strahler.tif"
 sub_basins = "sub_basins.tif"
-snapPour1 = 'snapped_pour_points_1.shp'                                         # Pour points snapped to nearest grid cell center
-snapPour2 = 'snapped_pour_points_2.shp'                                         # Pour points snapped with higher tolerance
-watersheds = "watersheds.tif"                                                   # Watersheds delineated above pour points
 start_pts_temp = 'Projected_start_points.shp'                                   # Channel initiation points projected to model CRS
 stream_id = "stream_id.tif"                                                     # Stream link ID raster
 streams_vector = "streams.shp"                                                  # Stream vector shapefile
@@ -334,6 +374,361 @@ class TeeNoFile(object):
     def __del__(self):
         self.close()
 
+class FulldomStore(object):
+    '''
+    Stage the 2D (y, x) layers of a Fulldom_hires.nc file in memory, so that the
+    processing steps (WB_functions, forecast_points, Routing_Table, add_reservoirs,
+    nlinks_checker) can read and modify the layers without a netCDF round trip at
+    every step. The store is used in place of the netCDF4.Dataset object, as each
+    layer supports the same rootgrp.variables[name][index] reads and writes.
+
+    Each layer is read from the file the first time it is used, and is held as a
+    numpy array (or a memory-mapped .npy file in memmap_dir, to limit memory use
+    on very large grids). Reads return copies, as a netCDF variable would. Layers
+    that are written to are marked dirty, and only dirty layers are written to
+    the file by flush() or checkpoint(). close() flushes and closes the file.
+    Variables that are not 2D layers (such as x, y, crs) are passed through to
+    the netCDF4.Dataset object.
+
+    In compact mode, layers are staged in the narrower types in compactLayerTypes
+    (uint8 FLOWDIRECTION, integer landuse), and a layer that is set to a single
+    value everywhere (such as the default OVROUGHRTFAC, RETDEPRTFAC and LKSATFAC
+    or the empty LAKEGRID) is held as that scalar until part of it is changed.
+    The types of the variables in the output file are not changed.
+
+    Channel, lake and gage layers that are NoData almost everywhere may be held as
+    a SparseGrid (sparse(), set_sparse()), so that Routing_Table, add_reservoirs
+    and nlinks_checker only handle the cells that hold a value. The dense grid is
+    built when the layer is written to the file, or when it is indexed as a layer.
+    '''
+    class Layer(object):
+        def __init__(self, store, name):
+            self.store = store
+            self.name = name
+        def __getitem__(self, key):
+            if self.name in self.store.sparse_layers:
+                value = self.store.sparse_layers[self.name].to_dense()[key]
+            elif self.name in self.store.constants:
+                value = numpy.broadcast_to(self.store.constants[self.name], self.store.rootgrp.variables[self.name].shape)[key]
+            else:
+                value = self.store.array(self.name)[key]
+            return numpy.array(value) if isinstance(value, numpy.ndarray) else value
+        def __setitem__(self, key, value):
+            full = key is Ellipsis or (isinstance(key, slice) and key == slice(None))
+            if self.store.compact and full and numpy.ndim(value) == 0:
+                self.store.layers.pop(self.name, None)
+                self.store.sparse_layers.pop(self.name, None)
+                self.store.constants[self.name] = numpy.asarray(value, dtype=self.store.layer_dtype(self.name))
+            else:
+                self.store.array(self.name, read=not full)[key] = value            # A full write does not need the current values
+            self.store.dirty.add(self.name)
+        def __getattr__(self, attr):
+            return getattr(self.store.rootgrp.variables[self.name], attr)      # dtype, shape, dimensions, attributes
+
+    class Variables(object):
+        def __init__(self, store):
+            self.store = store
+        def __getitem__(self, name):
+            ncvar = self.store.rootgrp.variables[name]
+            if ncvar.dimensions != ('y', 'x'):
+                return ncvar
+            return FulldomStore.Layer(self.store, name)
+        def __contains__(self, name):
+            return name in self.store.rootgrp.variables
+        def __iter__(self):
+            return iter(self.store.rootgrp.variables)
+        def keys(self):
+            return self.store.rootgrp.variables.keys()
+
+    def __init__(self, rootgrp, memmap_dir=None, compact=False):
+        self.rootgrp = rootgrp
+        self.memmap_dir = memmap_dir
+        self.compact = compact
+        self.layers = {}
+        self.constants = {}
+        self.sparse_layers = {}
+        self.dirty = set()
+        self.variables = FulldomStore.Variables(self)
+
+    def __getattr__(self, attr):
+        return getattr(self.rootgrp, attr)                                      # Dimensions, global attributes, etc.
+
+    def set_auto_mask(self, flag):
+        self.rootgrp.set_auto_mask(flag)                                        # Staged layers are always returned as numpy arrays
+
+    def layer_dtype(self, name):
+        '''Return the type in which a layer is staged.'''
+        if self.compact and name in compactLayerTypes:
+            return numpy.dtype(compactLayerTypes[name])
+        return self.rootgrp.variables[name].dtype
+
+    def array(self, name, read=True):
+        '''Return the staged array for a layer, reading it from the file (or expanding its constant value) on first use.'''
+        if name not in self.layers:
+            ncvar = self.rootgrp.variables[name]
+            ncvar.set_auto_mask(False)
+            dtype = self.layer_dtype(name)
+            if self.memmap_dir:
+                arr = numpy.lib.format.open_memmap(os.path.join(self.memmap_dir, '{0}.npy'.format(name)),
+                                                    mode='w+', dtype=dtype, shape=ncvar.shape)
+            else:
+                arr = numpy.empty(ncvar.shape, dtype=dtype)
+            if name in self.constants:
+                arr[:] = self.constants.pop(name)
+            elif name in self.sparse_layers:
+                arr[:] = self.sparse_layers.pop(name).to_dense()
+            elif read:
+                arr[:] = ncvar[:]
+            self.layers[name] = arr
+        return self.layers[name]
+
+    def release(self, name):
+        '''Drop the dense array for a layer (and its memory-mapped file).'''
+        self.layers.pop(name, None)
+        if self.memmap_dir:
+            remove_file(os.path.join(self.memmap_dir, '{0}.npy'.format(name)))
+        return
+
+    def sparse(self, name, nodata=NoDataVal):
+        '''
+        Return a copy of a layer as a SparseGrid. The layer is then held in sparse
+        form (its dense array is released) until it is indexed or written to.
+        '''
+        if name not in self.sparse_layers:
+            ncvar = self.rootgrp.variables[name]
+            if name in self.layers:
+                sp = SparseGrid.from_dense(self.layers[name], nodata)
+                self.release(name)
+            elif name in self.constants:
+                sp = SparseGrid.from_dense(numpy.broadcast_to(self.constants.pop(name), ncvar.shape), nodata)
+            else:
+                ncvar.set_auto_mask(False)
+                sp = SparseGrid.from_dense(ncvar[:], nodata)
+            self.sparse_layers[name] = sp
+        sp = self.sparse_layers[name]
+        return SparseGrid(sp.shape, sp.idx.copy(), sp.vals.copy(), nodata=nodata, dtype=sp.dtype)
+
+    def set_sparse(self, name, sp):
+        '''Replace a layer with a SparseGrid. The dense grid is built when the layer is flushed.'''
+        self.release(name)
+        self.constants.pop(name, None)
+        self.sparse_layers[name] = sp
+        self.dirty.add(name)
+        return
+
+    def flush(self, names=None):
+        '''Write the dirty layers (or only the dirty layers in names) to the file.'''
+        tic1 = time.time()
+        names = sorted(self.dirty if names is None else self.dirty.intersection(names))
+        for name in names:
+            ncvar = self.rootgrp.variables[name]
+            if name in self.constants:
+                block = max(1, 2**24//max(ncvar.shape[1], 1))                   # Write constant layers in blocks of rows to avoid a full-size array
+                for row in range(0, ncvar.shape[0], block):
+                    ncvar[row:row+block, :] = numpy.full((min(block, ncvar.shape[0]-row), ncvar.shape[1]), self.constants[name], dtype=ncvar.dtype)
+            elif name in self.sparse_layers:
+                ncvar[:] = self.sparse_layers[name].to_dense(dtype=ncvar.dtype)
+            else:
+                ncvar[:] = self.layers[name]
+            self.dirty.discard(name)
+        if len(names) > 0:
+            print('        Wrote {0} Fulldom layers to disk in {1: 3.2f} seconds: {2}'.format(len(names), time.time()-tic1, ', '.join(names)))
+        return
+
+    def checkpoint(self):
+        '''Flush the dirty layers and sync the file to disk, so that it is complete if processing stops.'''
+        self.flush()
+        self.rootgrp.sync()
+        return
+
+    def close(self):
+        self.flush()
+        self.rootgrp.close()
+        names = list(self.layers.keys())
+        self.layers = {}                                                        # Release the arrays (and memory-mapped files)
+        self.constants = {}
+        self.sparse_layers = {}
+        if self.memmap_dir:
+            for name in names:
+                remove_file(os.path.join(self.memmap_dir, '{0}.npy'.format(name)))
+        return
+
+class SparseGrid(object):
+    '''
+    Sparse representation of a 2D grid that is NoData almost everywhere, such as
+    CHANNELGRID, LINKID, STREAMORDER, frxst_pts or LAKEGRID. Only the cells that
+    hold a value are stored, as a sorted array of flat (row-major) cell indices
+    and an array of values. Per-cell logic can then work on the channel (or lake)
+    cells alone, and the dense grid is only built for output (to_dense).
+    '''
+    def __init__(self, shape, idx, vals, nodata=NoDataVal, dtype=None):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype if dtype is not None else numpy.asarray(vals).dtype)
+        self.nodata = numpy.array(nodata).astype(self.dtype)                   # As stored in the grid type (-9999 is -15 in 8-bit STREAMORDER)
+        self.idx = numpy.asarray(idx, dtype=numpy.int64)
+        self.vals = numpy.asarray(vals).astype(self.dtype)
+
+    @classmethod
+    def from_dense(cls, arr, nodata=NoDataVal):
+        '''Build a sparse grid from a dense array in a single pass.'''
+        arr = numpy.asarray(arr)
+        flat = arr.ravel()
+        idx = numpy.flatnonzero(flat != numpy.array(nodata).astype(arr.dtype))
+        return cls(arr.shape, idx, flat[idx], nodata=nodata, dtype=arr.dtype)
+
+    def to_dense(self, dtype=None):
+        '''Build the dense grid, with NoData in every cell that is not stored.'''
+        arr = numpy.full(self.shape, self.nodata, dtype=dtype if dtype is not None else self.dtype)
+        arr.flat[self.idx] = self.vals
+        return arr
+
+    def rows_cols(self):
+        '''Row and column of every stored cell.'''
+        return numpy.divmod(self.idx, self.shape[1])
+
+    def lookup(self, idx):
+        '''Values at the given flat cell indices (NoData where no value is stored).'''
+        idx = numpy.asarray(idx, dtype=numpy.int64)
+        pos = numpy.clip(numpy.searchsorted(self.idx, idx), 0, max(self.idx.shape[0]-1, 0))
+        out = numpy.full(idx.shape, self.nodata, dtype=self.dtype)
+        if self.idx.shape[0] > 0:
+            found = self.idx[pos] == idx
+            out[found] = self.vals[pos[found]]
+        return out
+
+    def keep(self, mask):
+        '''Keep only the stored cells where mask (aligned with the stored cells) is True.'''
+        self.idx = self.idx[mask]
+        self.vals = self.vals[mask]
+        return self
+
+    def drop(self, idx):
+        '''Set the given flat cell indices to NoData.'''
+        return self.keep(~numpy.isin(self.idx, idx))
+
+    def update(self, idx, vals):
+        '''Set values at the given flat cell indices. Cells set to NoData are removed.'''
+        idx = numpy.asarray(idx, dtype=numpy.int64)
+        vals = numpy.broadcast_to(numpy.asarray(vals).astype(self.dtype), idx.shape)
+        all_idx = numpy.concatenate([self.idx, idx])
+        all_vals = numpy.concatenate([self.vals, vals])
+        order = numpy.argsort(all_idx, kind='stable')                           # New values sort after existing values at the same cell
+        all_idx, all_vals = all_idx[order], all_vals[order]
+        last = numpy.r_[all_idx[1:] != all_idx[:-1], True]
+        self.idx, self.vals = all_idx[last], all_vals[last]
+        return self.keep(self.vals != self.nodata)
+
+class StageGraph(object):
+    '''
+    Run the stages of a workflow as a dependency graph. Each stage is a function
+    with no arguments, added with the names of the stages it depends on (which
+    must already be added, so the graph has no cycles) and the names of any shared
+    resources it uses (such as an open netCDF file). A stage is started once all
+    of its dependencies have finished and none of its resources are held by a
+    running stage. Up to 'workers' stages run at once in a thread pool. With one
+    worker, the stages run one at a time in the order they were added.
+
+    The return value of each stage is kept in results. The start and end time of
+    each stage are recorded, and report() prints the wall time of each stage and
+    the critical path (the chain of dependent stages with the longest total time).
+    If a stage raises an exception, no new stages are started, and the exception
+    is raised again once the running stages have finished.
+    '''
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = StageWorkers
+        self.workers = max(1, int(workers))
+        self.order = []                                                         # Stage names, in the order they were added
+        self.stages = {}                                                        # Stage name: (function, dependencies, resources)
+        self.results = {}
+        self.times = {}                                                         # Stage name: (start, end) in seconds from the start of run()
+
+    def add(self, name, func, deps=(), resources=()):
+        '''Add a stage that runs func after the stages in deps have finished.'''
+        if name in self.stages:
+            raise ValueError('Stage {0} has already been added.'.format(name))
+        missing = [dep for dep in deps if dep not in self.stages]
+        if len(missing) > 0:
+            raise KeyError('Stage {0} depends on stages that have not been added: {1}'.format(name, missing))
+        self.order.append(name)
+        self.stages[name] = (func, tuple(deps), frozenset(resources))
+        return
+
+    def run(self):
+        '''Run all stages, and return the dictionary of stage results.'''
+        tic1 = time.time()
+        pending = list(self.order)
+        done = set()
+        held = set()
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                # Start every ready stage that the worker budget and resources allow, in the order they were added
+                if error is None:
+                    for name in list(pending):
+                        if len(running) >= self.workers:
+                            break
+                        func, deps, resources = self.stages[name]
+                        if done.issuperset(deps) and held.isdisjoint(resources):
+                            pending.remove(name)
+                            held.update(resources)
+                            self.times[name] = (time.time()-tic1, None)
+                            running[executor.submit(func)] = name
+                elif not running:
+                    break
+                finished, not_done = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    self.times[name] = (self.times[name][0], time.time()-tic1)
+                    held.difference_update(self.stages[name][2])
+                    if future.exception() is not None:
+                        print('    Stage {0} failed after {1: 3.2f} seconds.'.format(name, self.times[name][1]-self.times[name][0]))
+                        error = error or future.exception()
+                        continue
+                    self.results[name] = future.result()
+                    done.add(name)
+        if error is not None:
+            raise error
+        print('    Ran {0} stages with {1} workers in {2: 3.2f} seconds.'.format(len(done), self.workers, time.time()-tic1))
+        return self.results
+
+    def critical_path(self):
+        '''Return the chain of dependent stages with the longest total wall time, and that time.'''
+        path_time = {}
+        path_prev = {}
+        for name in self.order:
+            if name not in self.times or self.times[name][1] is None:
+                continue
+            start, end = self.times[name]
+            prev = [dep for dep in self.stages[name][1] if dep in path_time]
+            best = max(prev, key=lambda dep: path_time[dep]) if prev else None
+            path_prev[name] = best
+            path_time[name] = (end-start) + (path_time[best] if best else 0)
+        if not path_time:
+            return [], 0.
+        name = max(path_time, key=lambda key: path_time[key])
+        total = path_time[name]
+        path = []
+        while name is not None:
+            path.append(name)
+            name = path_prev[name]
+        return path[::-1], total
+
+    def report(self):
+        '''Print the wall time of each stage and the critical path.'''
+        print('    Stage timing (seconds from start):')
+        print('      {0:<20} {1:>9} {2:>9} {3:>9}'.format('Stage', 'Start', 'End', 'Elapsed'))
+        for name in self.order:
+            if name in self.times and self.times[name][1] is not None:
+                start, end = self.times[name]
+                print('      {0:<20} {1:9.2f} {2:9.2f} {3:9.2f}'.format(name, start, end, end-start))
+        path, total = self.critical_path()
+        busy = sum(end-start for start, end in self.times.values() if end is not None)
+        print('    Total stage time: {0: 3.2f} seconds. Critical path: {1: 3.2f} seconds.'.format(busy, total))
+        print('    Critical path: {0}'.format(' -> '.join(path)))
+        return
+
 class WRF_Hydro_Grid:
     '''
     Class with which to create the WRF-Hydro grid representation. Provide grid
@@ -858,6 +1253,27 @@ def remove_file(in_file):
         os.remove(in_file)
     return
 
+def read_sparse(rootgrp, name, nodata=NoDataVal):
+    '''
+    Read a 2D layer as a SparseGrid. Layers staged in a FulldomStore are taken
+    from (and kept in) the store in sparse form, other netCDF files are read once.
+    '''
+    if isinstance(rootgrp, FulldomStore):
+        return rootgrp.sparse(name, nodata)
+    return SparseGrid.from_dense(numpy.asarray(rootgrp.variables[name][:]), nodata)
+
+def write_sparse(rootgrp, name, sp):
+    '''
+    Write a SparseGrid to a 2D layer. In a FulldomStore the layer is held in sparse
+    form and the dense grid is only built when the layer is flushed to disk.
+    '''
+    if isinstance(rootgrp, FulldomStore):
+        rootgrp.set_sparse(name, sp)
+    else:
+        ncvar = rootgrp.variables[name]
+        ncvar[:] = sp.to_dense(dtype=ncvar.dtype)
+    return
+
 def flip_grid(array):
     '''This function takes a two dimensional array (x,y) and flips it up-down to
     correct for the netCDF storage of these grids.'''
@@ -1092,6 +1508,194 @@ def define_projection(input_file, dest_srs):
     print('    Projection defined for input vector layer in {0:3.2f} seconds.'.format(time.time()-tic1))
     return
 
+def write_layer_columnar(ds, layer_name, dest_srs, geom_type, geoms_wkb, fields, columns, layer_options=[]):
+    '''
+    Create a vector layer with the correct spatial reference and write all
+    features to it in a single pass from columnar inputs. This avoids populating
+    attributes one SetField/SetFeature call at a time on an existing layer and
+    then copying the whole layer again to attach a coordinate system.
+
+        ds          - OGR data source open for writing
+        geoms_wkb   - Sequence of WKB geometries, one per output feature
+        fields      - List of (name, OGR field type, width) tuples, in field order.
+                      Use a width of None to accept the driver default.
+        columns     - Dictionary of {name: numpy array} holding one value per
+                      feature for every field in 'fields'
+
+    If pyarrow is available and GDAL >= 3.8, the batch is handed to OGR through
+    the Arrow interface. Otherwise, features are created in one loop inside a
+    layer transaction (a no-op for drivers without transaction support).
+    '''
+    tic1 = time.time()
+    layer = ds.CreateLayer(layer_name, dest_srs, geom_type, options=layer_options)
+    for fname, ftype, fwidth in fields:
+        field_defn = ogr.FieldDefn(fname, ftype)
+        if fwidth is not None:
+            field_defn.SetWidth(fwidth)
+        layer.CreateField(field_defn)
+    num_features = len(geoms_wkb)
+
+    use_arrow = useArrowWrite and pyarrow is not None and hasattr(layer, 'WritePyArrow')
+    if use_arrow:
+        arrow_types = {ogr.OFTInteger:pyarrow.int32(),
+                        ogr.OFTInteger64:pyarrow.int64(),
+                        ogr.OFTReal:pyarrow.float64(),
+                        ogr.OFTString:pyarrow.string()}
+        use_arrow = all(ftype in arrow_types for fname, ftype, fwidth in fields)   # Other field types use the fallback below
+    if use_arrow:
+        arrow_cols = {fname:pyarrow.array(columns[fname], type=arrow_types[ftype], from_pandas=True) for fname, ftype, fwidth in fields}
+        arrow_cols['wkb_geometry'] = pyarrow.array([bytes(geom) for geom in geoms_wkb], type=pyarrow.binary())
+        layer.WritePyArrow(pyarrow.table(arrow_cols), options=['GEOMETRY_NAME=wkb_geometry', 'GEOMETRY_ENCODING=WKB'])
+        del arrow_cols
+    else:
+        layerDefn = layer.GetLayerDefn()
+        field_vals = [(fname, columns[fname].tolist()) for fname, ftype, fwidth in fields]   # Convert each column to Python values once
+        layer.StartTransaction()
+        for num in range(num_features):
+            feature = ogr.Feature(layerDefn)
+            for fname, vals in field_vals:
+                feature.SetField(fname, vals[num])
+            feature.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geoms_wkb[num])))
+            layer.CreateFeature(feature)
+            feature = None
+        layer.CommitTransaction()
+        del field_vals
+    layer.SyncToDisk()
+    print('    Wrote {0} features to layer {1} in {2:3.2f} seconds.'.format(num_features, layer_name, time.time()-tic1))
+    return layer
+
+def layer_fields(layer):
+    '''
+    Return the (name, OGR field type, width) of every field in a layer, in the
+    form used by write_layer_columnar. A width of 0 is returned as None.
+    '''
+    layerDefn = layer.GetLayerDefn()
+    fields = []
+    for num in range(layerDefn.GetFieldCount()):
+        fieldDef = layerDefn.GetFieldDefn(num)
+        fields.append((fieldDef.GetName(), fieldDef.GetType(), fieldDef.GetWidth() or None))
+    return fields
+
+def read_layer_columnar(layer, field_names=None):
+    '''
+    Read the geometries and attributes of all features in a layer (respecting any
+    spatial or attribute filter) into columnar form. This is the counterpart to
+    write_layer_columnar, so that derived layers can be computed with vectorized
+    operations instead of per-feature OGR calls.
+
+        field_names - List of fields to read. Default is all fields.
+
+    Returns a Shapely geometry array and a dictionary of {name: numpy array}. Null
+    attribute values are returned as None in object arrays.
+
+    If pyarrow is available and GDAL >= 3.6, the layer is read as Arrow record
+    batches. Otherwise, features are read in one loop.
+    '''
+    tic1 = time.time()
+    fields = [field for field in layer_fields(layer) if field_names is None or field[0] in field_names]
+    simple_types = [ogr.OFTInteger, ogr.OFTInteger64, ogr.OFTReal, ogr.OFTString]
+    use_arrow = useArrowRead and pyarrow is not None and hasattr(layer, 'GetArrowStreamAsPyArrow')
+    use_arrow = use_arrow and all(ftype in simple_types for fname, ftype, fwidth in fields)    # Other field types use the fallback below
+    layer.ResetReading()
+    if use_arrow:
+        layer.SetIgnoredFields([fname for fname, ftype, fwidth in layer_fields(layer) if fname not in [field[0] for field in fields]])
+        stream = layer.GetArrowStreamAsPyArrow(['INCLUDE_FID=NO', 'GEOMETRY_ENCODING=WKB'])
+        table = pyarrow.Table.from_batches([batch for batch in stream], schema=stream.schema)
+        geom_name = layer.GetGeometryColumn() or 'wkb_geometry'
+        geoms = shapely.from_wkb(table.column(geom_name).to_numpy(zero_copy_only=False))
+        columns = {}
+        for fname, ftype, fwidth in fields:
+            column = table.column(fname)
+            if column.null_count == 0:
+                columns[fname] = column.to_numpy(zero_copy_only=False)
+            else:
+                columns[fname] = numpy.array(column.to_pylist(), dtype=object)
+        layer.SetIgnoredFields([])
+        stream = table = None
+    else:
+        wkbs = []
+        values = {fname:[] for fname, ftype, fwidth in fields}
+        for feature in layer:
+            geometry = feature.GetGeometryRef()
+            wkbs.append(None if geometry is None else bytes(geometry.ExportToWkb()))
+            for fname in values:
+                values[fname].append(feature.GetField(fname))
+            feature = geometry = None
+        geoms = shapely.from_wkb(wkbs)
+        columns = {fname:numpy.array(vals, dtype=object if None in vals else None) for fname, vals in values.items()}
+        del wkbs, values
+    layer.ResetReading()
+    print('    Read {0} features from layer {1} in {2:3.2f} seconds.'.format(len(geoms), layer.GetName(), time.time()-tic1))
+    return geoms, columns
+
+def vector_output(projdir, file_name):
+    '''
+    Return the data source path, layer name, and OGR driver name for a routing
+    stack vector output (streams, lakes). By default each output is written as
+    its own shapefile. If useGeoPackage is True, every output is instead a layer
+    in a single GeoPackage (VectorGPKG), named after the shapefile basename.
+    '''
+    layer_name = os.path.splitext(os.path.basename(file_name))[0]
+    if useGeoPackage:
+        return os.path.join(projdir, VectorGPKG), layer_name, 'GPKG'
+    return os.path.join(projdir, file_name), layer_name, VectorDriver
+
+def create_vector_output(projdir, file_name):
+    '''
+    Open or create the data source for a routing stack vector output, removing
+    any existing layer of the same name. Returns the data source, the layer name
+    and the layer creation options to use. GeoPackage layers are created with an
+    R-tree spatial index.
+    '''
+    out_file, layer_name, driver_name = vector_output(projdir, file_name)
+    driver = ogr.GetDriverByName(driver_name)
+    if driver_name == 'GPKG':
+        if os.path.exists(out_file):
+            out_ds = driver.Open(out_file, 1)
+            if out_ds.GetLayerByName(layer_name) is not None:
+                out_ds.DeleteLayer(layer_name)
+        else:
+            out_ds = driver.CreateDataSource(out_file)
+        layer_options = ['SPATIAL_INDEX=YES']
+    else:
+        if os.path.exists(out_file):
+            driver.DeleteDataSource(out_file)
+        out_ds = driver.CreateDataSource(out_file)
+        layer_options = []
+    return out_ds, layer_name, layer_options
+
+def delete_features(ds, layer_name, id_field, keep_ids):
+    '''
+    Delete all features from a layer whose id_field value is not in keep_ids.
+    Only the id_field column is read to find the features to delete. For a
+    GeoPackage the features are removed with a single SQL DELETE statement,
+    otherwise only the features to be removed are deleted, in one transaction.
+    Returns the number of features deleted.
+    '''
+    layer = ds.GetLayerByName(layer_name)
+    layerDefn = layer.GetLayerDefn()
+    layer.SetIgnoredFields([layerDefn.GetFieldDefn(num).GetName() for num in range(layerDefn.GetFieldCount())
+                            if layerDefn.GetFieldDefn(num).GetName() != id_field] + ['OGR_GEOMETRY', 'OGR_STYLE'])
+    fid_ids = [(feature.GetFID(), feature.GetField(id_field)) for feature in layer]
+    layer.SetIgnoredFields([])
+    layer.ResetReading()
+    fids = numpy.array([fid for fid, idval in fid_ids], dtype=numpy.int64)
+    ids = numpy.array([NoDataVal if idval is None else idval for fid, idval in fid_ids], dtype=numpy.int64)
+    delete_fids = fids[~numpy.isin(ids, numpy.asarray(keep_ids, dtype=numpy.int64))]
+    del fid_ids, fids, ids
+
+    if delete_fids.shape[0] > 0:
+        if ds.GetDriver().GetName() == 'GPKG':
+            fid_column = layer.GetFIDColumn() or 'fid'
+            ds.ExecuteSQL('DELETE FROM "{0}" WHERE "{1}" IN ({2})'.format(layer_name, fid_column, ','.join(map(str, delete_fids.tolist()))))
+        else:
+            layer.StartTransaction()
+            for fid in delete_fids.tolist():
+                layer.DeleteFeature(fid)
+            layer.CommitTransaction()
+    layer = layerDefn = None
+    return delete_fids.shape[0]
+
 def return_raster_array(in_file):
     '''
     Read a GDAL-compatible raster file from disk and return the array of raster
@@ -1104,7 +1708,7 @@ def return_raster_array(in_file):
     ds = band = None
     return arr, ndv
 
-def array_to_points(in_arr, dtype, GT, proj, NoDataVal=-9999):
+def array_to_points(in_arr, dtype, GT, proj, NoDataVal=-9999, return_coords=False):
     '''
     Build a point feature class for every grid cell that contains a unique value
     in the input array.
@@ -1114,12 +1718,28 @@ def array_to_points(in_arr, dtype, GT, proj, NoDataVal=-9999):
 
     Assumes input is a 2D numpy array. Seems to only work with integer field type
     currently.
+
+    All valid cells are found in a single pass and their cell-center coordinates
+    are computed from the GeoTransform as arrays. Features are ordered by value,
+    then by row and column. If return_coords is True, the (x, y, value) arrays
+    are returned instead of an OGR data source.
     '''
 
     tic1 = time.time()
     valField = 'VALUE'
     xMin, DX, xskew, yMax, yskew, DY = GT
 
+    # col, row to x, y   From https://www.perrygeo.com/python-affine-transforms.html
+    rows, cols = numpy.nonzero(in_arr != NoDataVal)                            # All valid cells in one pass
+    vals = numpy.asarray(in_arr[rows, cols])
+    sorter = numpy.argsort(vals, kind='stable')                                 # Order by value, keeping row-major order within each value
+    rows, cols, vals = rows[sorter], cols[sorter], vals[sorter]
+    xs = (cols * DX) + xMin + float(DX/2)
+    ys = (rows * DY) + yMax + float(DY/2)
+    del rows, cols, sorter
+    if return_coords:
+        return xs, ys, vals
+
     # Create in-memory output layer to store projected and/or clipped polygons
     drv = ogr.GetDriverByName('MEMORY')                                         # Other options: 'ESRI Shapefile'
     data_source = drv.CreateDataSource('')                                      # Create the data source. If in-memory, use '' or some other string as the data source name
@@ -1127,23 +1747,16 @@ def array_to_points(in_arr, dtype, GT, proj, NoDataVal=-9999):
     outLayer.CreateField(ogr.FieldDefn(valField, dtype))                         # Add a single field to the new layer
     outlayerDef = outLayer.GetLayerDefn()
 
-    # col, row to x, y   From https://www.perrygeo.com/python-affine-transforms.html
-    uniques = numpy.unique(in_arr[in_arr!=NoDataVal])                           # Determine unique values
-    for idval in uniques:
-        locs = numpy.where(in_arr==idval)
-        for j, i in zip(locs[0], locs[1]):
-            x = (i * DX) + xMin + float(DX/2)
-            y = (j * DY) + yMax + float(DY/2)
-
-            # Build output feature
-            outFeature = ogr.Feature(outlayerDef)
-            outFeature.SetField(valField, int(idval))                                    # Set pixel value attribute
-            wkt = "POINT({0} {1})".format(x, y)                                       # create the WKT for the feature using Python string formatting
-            point = ogr.CreateGeometryFromWkt(wkt)                                  # Create the point from the Well Known Txt
-            outFeature.SetGeometry(point)                                           # Set the feature geometry using the point
-            outLayer.CreateFeature(outFeature)                                            # Create the feature in the layer (shapefile)
-            outFeature.Destroy()
-            outFeature = point = None                                               # Dereference the feature
+    # Build output features directly from the coordinate arrays
+    for x, y, idval in zip(xs.tolist(), ys.tolist(), vals.tolist()):
+        outFeature = ogr.Feature(outlayerDef)
+        outFeature.SetField(valField, int(idval))                               # Set pixel value attribute
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(x, y)
+        outFeature.SetGeometry(point)                                           # Set the feature geometry using the point
+        outLayer.CreateFeature(outFeature)                                      # Create the feature in the layer (shapefile)
+        outFeature = point = None                                               # Dereference the feature
+    print('    Created {0} points from array in {1:3.2f} seconds.'.format(vals.shape[0], time.time()-tic1))
     outLayer = None
     return data_source
 
@@ -1163,60 +1776,148 @@ def ReprojectCoords(xcoords, ycoords, src_srs, tgt_srs):
 
     # Setup coordinate transform
     transform = osr.CoordinateTransformation(src_srs, tgt_srs)
-
-    ravel_x = numpy.ravel(xcoords)
-    ravel_y = numpy.ravel(ycoords)
-    trans_x = numpy.zeros(ravel_x.shape, ravel_x.dtype)
-    trans_y = numpy.zeros(ravel_y.shape, ravel_y.dtype)
-
-    for num,(x,y) in enumerate(zip(ravel_x, ravel_y)):
-        x1,y1,z = transform.TransformPoint(x,y)
-        trans_x[num] = x1
-        trans_y[num] = y1
+    trans_x, trans_y = transform_points(transform, xcoords, ycoords)
 
     # reshape transformed coordinate arrays of the same shape as input coordinate arrays
-    trans_x = trans_x.reshape(*xcoords.shape)
-    trans_y = trans_y.reshape(*ycoords.shape)
-    print('Completed transforming coordinate pairs [{0}] in {1: 3.2f} seconds.'.format(num, time.time()-tic1))
+    trans_x = trans_x.reshape(*xcoords.shape).astype(numpy.asarray(xcoords).dtype)
+    trans_y = trans_y.reshape(*ycoords.shape).astype(numpy.asarray(ycoords).dtype)
+    print('Completed transforming coordinate pairs [{0}] in {1: 3.2f} seconds.'.format(trans_x.size, time.time()-tic1))
     return trans_x, trans_y
 
+def transform_points(coordTrans, xcoords, ycoords):
+    '''
+    Transform arrays of x and y coordinates with an OSR coordinate transformation
+    in a single call, rather than one TransformPoint call per point. Returns
+    flattened arrays of the transformed x and y coordinates.
+    '''
+    xy = numpy.column_stack([numpy.ravel(xcoords), numpy.ravel(ycoords)]).astype(numpy.float64)
+    if xy.shape[0] == 0:
+        return xy[:,0], xy[:,1]
+    trans_xy = numpy.array(coordTrans.TransformPoints(xy.tolist()))
+    return trans_xy[:,0], trans_xy[:,1]
+
+def transform_geometries(geoms, coordTrans):
+    '''
+    Transform an array of Shapely geometries with an OSR coordinate transformation,
+    transforming the coordinates of all geometries in a single call.
+    '''
+    def transform_coords(coords):
+        trans_x, trans_y = transform_points(coordTrans, coords[:,0], coords[:,1])
+        return numpy.column_stack([trans_x, trans_y])
+    return shapely.transform(geoms, transform_coords)
+
 # Function for using forecast points
-def FeatToRaster(InputVector, inRaster, fieldname, dtype, NoData=None):
+def FeatToRaster(InputVector, inRaster, fieldname, dtype, NoData=None, layer_name=None, threads=None):
     '''
     This function will take a point shapefile and rasterize it. The point feature
     class must have a field in it with values of 1, which is an optional input
     to the RasterizeLayer function. Currently, this field is named PURPCODE. The
     result is a raster of NoData and 1 values, which is used as the "Input
     Depression Mask Grid" in TauDEM's PitRemove tool.
+
+    For multi-layer data sources (GeoPackage), provide the layer to rasterize
+    using the 'layer_name' parameter. Otherwise, the first layer is used.
+
+    InputVector may also be an OGR layer (such as an in-memory layer), and inRaster
+    may be a GDAL dataset or a WRF_Hydro_Grid object, so that nothing needs to be
+    written to or read from disk. If threads > 1 (default: RasterizeThreads), the
+    grid is split into bands of rows that are rasterized in a thread pool. The
+    features are burned in the same order in every band, so the result is the same.
     '''
     # Python GDAL_RASTERIZE syntax, adatped from:
     #    https://gis.stackexchange.com/questions/212795/rasterizing-shapefiles-with-gdal-and-python
+    tic1 = time.time()
+    if threads is None:
+        threads = RasterizeThreads
+
+    # Get the template grid information from a raster file, GDAL dataset, or WRF_Hydro_Grid object
+    if isinstance(inRaster, WRF_Hydro_Grid):
+        GT = inRaster.GeoTransform()
+        WKT = inRaster.WKT
+        ncols, nrows = inRaster.ncols, inRaster.nrows
+    else:
+        ds = gdal.Open(inRaster, gdalconst.GA_ReadOnly) if isinstance(inRaster, str) else inRaster
+        GT = ds.GetGeoTransform()
+        WKT = ds.GetProjection()
+        ncols, nrows = ds.RasterXSize, ds.RasterYSize
+        ds = None
 
-    # Open Raster input
-    ds = gdal.Open(inRaster, gdalconst.GA_ReadOnly)
-
-    # Get shapefile information
-    in_vector = ogr.Open(InputVector)
-    in_layer = in_vector.GetLayer()
+    # Get shapefile information, or use the layer provided
+    if isinstance(InputVector, ogr.Layer):
+        in_vector = None
+        in_layer = InputVector
+    else:
+        in_vector = ogr.Open(InputVector)
+        if layer_name is None:
+            in_layer = in_vector.GetLayer()
+        else:
+            in_layer = in_vector.GetLayerByName(layer_name)
     driver = gdal.GetDriverByName('Mem')                                        # Write to Memory
-    target_ds = driver.Create('', ds.RasterXSize, ds.RasterYSize, 1, dtype)
-
-    # Copy input raster info to output (SpatialReference, Geotransform, etc)
-    CopyDatasetInfo(ds, target_ds)
+    target_ds = driver.Create('', ncols, nrows, 1, dtype)
+    target_ds.SetGeoTransform(GT)
+    target_ds.SetProjection(WKT)
     band = target_ds.GetRasterBand(1)
     if NoData is not None:
         band.SetNoDataValue(NoData)
+
+    threads = min(threads, nrows)
+    if threads <= 1:
+        gdal.RasterizeLayer(target_ds, [1], in_layer, options=["ATTRIBUTE=%s" %fieldname])
+    else:
+        # Read the features once, and give each band of rows the features that overlap it
+        geoms, columns = read_layer_columnar(in_layer, [fieldname])
+        field_type = [ftype for fname, ftype, fwidth in layer_fields(in_layer) if fname == fieldname][0]
+        wkbs = shapely.to_wkb(geoms)
+        values = columns[fieldname].tolist()
+        bounds = shapely.bounds(geoms)
+        srs = in_layer.GetSpatialRef()
+        del geoms, columns
+
+        def burn_rows(rows):
+            row0, row1 = int(rows[0]), int(rows[-1])+1
+            top = GT[3] + row0*GT[5]
+            bottom = GT[3] + row1*GT[5]
+            overlaps = numpy.nonzero((bounds[:,3] >= min(top, bottom)) & (bounds[:,1] <= max(top, bottom)))[0]
+            mem_ds = ogr.GetDriverByName('MEMORY').CreateDataSource('')
+            mem_layer = mem_ds.CreateLayer('', srs, ogr.wkbUnknown)
+            mem_layer.CreateField(ogr.FieldDefn(fieldname, field_type))
+            layerDefn = mem_layer.GetLayerDefn()
+            for num in overlaps.tolist():
+                feature = ogr.Feature(layerDefn)
+                feature.SetField(fieldname, values[num])
+                feature.SetGeometry(ogr.CreateGeometryFromWkb(wkbs[num]))
+                mem_layer.CreateFeature(feature)
+                feature = None
+            band_ds = driver.Create('', ncols, row1-row0, 1, dtype)
+            band_ds.SetGeoTransform((GT[0], GT[1], GT[2], top, GT[4], GT[5]))
+            band_ds.SetProjection(WKT)
+            gdal.RasterizeLayer(band_ds, [1], mem_layer, options=["ATTRIBUTE=%s" %fieldname])
+            arr = BandReadAsArray(band_ds.GetRasterBand(1))
+            band_ds = mem_layer = mem_ds = None
+            return row0, arr
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for row0, arr in executor.map(burn_rows, numpy.array_split(numpy.arange(nrows), threads)):
+                band.WriteArray(arr, 0, row0)
+        del wkbs, values, bounds
     band.FlushCache()
-    gdal.RasterizeLayer(target_ds, [1], in_layer, options=["ATTRIBUTE=%s" %fieldname])
-    stats = target_ds.GetRasterBand(1).GetStatistics(0,1)                       # Calculate statistics on new raster
+    band = in_layer = in_vector = None
+    print('    Rasterized features to {0} rows, {1} columns in {2:3.2f} seconds.'.format(nrows, ncols, time.time()-tic1))
     return target_ds
 
-def project_Features(InputVector, outProj, clipGeom=None, geomType=None):
+def project_Features(InputVector, outProj, clipGeom=None, geomType=None, prefilter=True, batch_size=10000):
     '''
     This function is intended to project a polygon geometry to a new coordinate
     system. Optionally, the geometries can be clipped to an extent rectangle. If
     this option is chosen, the geometry will be clipped for each intersecting
     polygon.
+
+    If a clipping geometry is given and prefilter=True, the clipping geometry is
+    densified and transformed to the coordinate system of the input, and used as
+    a spatial filter on the input layer. Only features near the clipping geometry
+    are read, which avoids reading and transforming most of a large (national)
+    dataset for a small domain. Features are then transformed and clipped in
+    batches of batch_size features, using a prepared clipping geometry.
     '''
     tic1 = time.time()
     trans = False
@@ -1257,30 +1958,81 @@ def project_Features(InputVector, outProj, clipGeom=None, geomType=None):
         outLayer.CreateField(layer_definition.GetFieldDefnRef(i))
     layer_defininition = None
     outlayerDef = outLayer.GetLayerDefn()
+    inFeatCount = in_layer.GetFeatureCount()
+
+    # Apply the clipping geometry, in the input coordinate system, as a spatial filter
+    clip = None
+    if clipGeom:
+        clip = shapely.from_wkb(bytes(clipGeom.ExportToWkb()))
+        shapely.prepare(clip)                                                   # Prepared geometry for repeated intersection tests
+        if prefilter:
+            filterGeom = ogr.CreateGeometryFromWkb(clipGeom.ExportToWkb())
+            minX, maxX, minY, maxY = filterGeom.GetEnvelope()
+            filterGeom.Segmentize(max(maxX-minX, maxY-minY)/100.0)              # Densify so that the edges follow the transformed boundary
+            if trans:
+                try:
+                    ok = filterGeom.Transform(osr.CoordinateTransformation(outProj, in_proj)) == 0
+                except RuntimeError:
+                    ok = False
+            else:
+                ok = True
+            if ok:
+                minX, maxX, minY, maxY = filterGeom.GetEnvelope()
+                filterGeom = filterGeom.Buffer(max(maxX-minX, maxY-minY)*0.005)  # Small margin for the curvature between densified vertices
+                in_layer.SetSpatialFilter(filterGeom)
+                print('        Applied spatial filter from the clipping geometry. {0} candidate features.'.format(in_layer.GetFeatureCount()))
+            else:
+                print('        Could not transform the clipping geometry to the input coordinate system. No spatial filter applied.')
+            filterGeom = None
+
+    def write_batch(features, wkbs):
+        if trans or clip is not None:
+            geoms = shapely.from_wkb(wkbs)
+            if trans:
+                geoms = transform_geometries(geoms, coordTrans)                 # Transform all coordinates of the batch at once
+            if clip is not None:
+                keep = shapely.intersects(clip, geoms)
+                partial = keep & ~shapely.contains_properly(clip, geoms)        # Geometries within the clipping geometry are not clipped
+                geoms[partial] = shapely.intersection(geoms[partial], clip)     # Clip the geometry if requested
+                keep &= ~shapely.is_empty(geoms)
+            else:
+                keep = numpy.ones(len(features), dtype=bool)
+            wkbs = shapely.to_wkb(geoms)
+        else:
+            keep = numpy.ones(len(features), dtype=bool)
+        for feature, wkb, keep_feature in zip(features, wkbs, keep):
+            if not keep_feature:
+                continue                                                        # Go to the next feature (do not copy)
+            feature.SetGeometry(ogr.CreateGeometryFromWkb(wkb))                # Set output Shapefile's feature geometry
+            outLayer.CreateFeature(feature)
 
-    # Read all features in layer
+    # Read all features in layer, in batches
+    outLayer.StartTransaction()
+    features = []
+    wkbs = []
     for feature in in_layer:
         geometry = feature.GetGeometryRef()                                     # Get the geometry object from this feature
-        if trans:
-            geometry.Transform(coordTrans)                                      # Transform the geometry
-        if clipGeom:
-            if clipGeom.Intersects(geometry):
-                geometry = geometry.Intersection(clipGeom)                      # Clip the geometry if requested
-            else:
-                continue                                                        # Go to the next feature (do not copy)
         if not geometry:
             continue                                                            # Trap because some geometries end up as None
-        feature.SetGeometry(geometry)                                           # Set output Shapefile's feature geometry
-        outLayer.CreateFeature(feature)
+        features.append(feature)
+        wkbs.append(bytes(geometry.ExportToWkb()))
+        if len(features) == batch_size:
+            write_batch(features, wkbs)
+            features = []
+            wkbs = []
         feature = geometry = None                                  # Clear memory
+    if len(features) > 0:
+        write_batch(features, wkbs)
+    outLayer.CommitTransaction()
+    in_layer.SetSpatialFilter(None)
     in_layer.ResetReading()
     outLayer.ResetReading()
     outFeatCount = outLayer.GetFeatureCount()                                   # Get number of features in output layer
     #outLayer = None                                                            # Clear memory
 
-    print('        Number of output features: {0} of {1}'.format(outFeatCount, in_layer.GetFeatureCount()))
+    print('        Number of output features: {0} of {1}'.format(outFeatCount, inFeatCount))
     print('      Completed reprojection and-or clipping in {0:3.2f} seconds.'.format(time.time()-tic1))
-    in_vect = inlayerDef = in_layer = in_LayerDef = None
+    in_vect = inlayerDef = in_layer = in_LayerDef = features = wkbs = clip = None
     return data_source, outLayer, fieldNames
 
 def raster_to_polygon(in_raster, in_proj, geom_typ=ogr.wkbPolygon):
@@ -1308,10 +2060,23 @@ def raster_to_polygon(in_raster, in_proj, geom_typ=ogr.wkbPolygon):
     #feature = Layer.GetNextFeature()
     return ds, Layer
 
-def dissolve_polygon_to_multipolygon(inDS, inLayer, fieldname, quiet=True):
+def union_wkb(wkbs):
+    '''
+    Union a group of geometries, given as WKB, and return the result as WKB. This
+    is a module-level function so that it may be run in a process pool.
+    '''
+    return shapely.to_wkb(shapely.union_all(shapely.from_wkb(wkbs)))
+
+def dissolve_polygon_to_multipolygon(inDS, inLayer, fieldname, quiet=True, union=False, processes=1):
     '''
     This function will dissolve the polygons in an input polygon feature layer
     and provide an output in-memory multipolygon layer with the dissolved geometries.
+
+    The input layer is read once, collecting the geometry (as WKB) of every feature
+    by ID. By default, the polygons of each ID are gathered into one multipolygon
+    in bulk. If union=True, the polygons of each ID are instead merged using a
+    Shapely union, optionally in a pool of 'processes' processes. The attributes of
+    the last feature of each ID are copied to the output.
     '''
     tic1 = time.time()
     in_proj = inLayer.GetSpatialRef()
@@ -1331,33 +2096,70 @@ def dissolve_polygon_to_multipolygon(inDS, inLayer, fieldname, quiet=True):
     outlayerDef = outLayer.GetLayerDefn()
     inlayerDef = None
 
-    # Set up list of unique lake IDs over which to dissolve singlepart to multiapart polygons
-    valuelist = set([feature.GetField(fieldname) for feature in inLayer])       # Get list of unique IDs
+    # Read the ID, attributes and geometry of every feature in a single pass
+    ids = []
+    wkbs = []
+    attributes = {}
+    for feature in inLayer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        idval = feature.GetField(fieldname)
+        ids.append(idval)
+        wkbs.append(bytes(geometry.ExportToWkb()))                              # GDAL returns a bytearray, which shapely.from_wkb does not accept
+        attributes[idval] = [feature.GetField(name) for name in fieldNames]     # Attributes of the last feature with this ID are used
+        feature = geometry = None
     inLayer.ResetReading()                                                      # Reset layer
-    for idval in valuelist:
-        inLayer.SetAttributeFilter('"%s" = %s' %(fieldname, idval))         # Select the ID from the layer
-        polygeom = ogr.Geometry(ogr.wkbMultiPolygon)
-        for feature in inLayer:
-            polygeom.AddGeometry(feature.GetGeometryRef())
-        #polygeom = polygeom.UnionCascaded()
+    valuelist = list(attributes.keys())                                         # Unique IDs, in order of appearance
+
+    # Split every geometry into polygons, and sort the polygons by the position of their ID
+    id_pos = {idval:num for num,idval in enumerate(valuelist)}
+    feat_pos = numpy.array([id_pos[idval] for idval in ids], dtype=numpy.int64)
+    parts, part_index = shapely.get_parts(shapely.from_wkb(wkbs), return_index=True)
+    parts_pos = feat_pos[part_index]
+    order = numpy.argsort(parts_pos, kind='stable')
+    parts = parts[order]
+    parts_pos = parts_pos[order]
+    feat_counts = numpy.bincount(feat_pos, minlength=len(valuelist))
+    part_counts = numpy.bincount(parts_pos, minlength=len(valuelist))
+    del ids, wkbs, id_pos, feat_pos, part_index, order
+
+    if union:
+        # Union the polygons of each ID, optionally in a process pool
+        groups = [shapely.to_wkb(group) for group in numpy.split(parts, numpy.cumsum(part_counts)[:-1])]
+        if processes > 1 and len(groups) > 1:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                out_wkbs = list(executor.map(union_wkb, groups, chunksize=max(1, len(groups)//(processes*4))))
+        else:
+            out_wkbs = [union_wkb(group) for group in groups]
+        del groups
+    else:
+        # Build all multipolygons at once
+        out_wkbs = shapely.to_wkb(shapely.multipolygons(parts, indices=parts_pos))
+    del parts, parts_pos
+
+    # Create the output features
+    outLayer.StartTransaction()
+    for num, idval in enumerate(valuelist):
+        polygeom = ogr.ForceToMultiPolygon(ogr.CreateGeometryFromWkb(out_wkbs[num]))
         if not quiet:
-            print('  [{0}] Number of features in the original polygon: {1},  multipolygon: {2}'.format(int(idval), inLayer.GetFeatureCount(), polygeom.GetGeometryCount()))
+            print('  [{0}] Number of features in the original polygon: {1},  multipolygon: {2}'.format(int(idval), feat_counts[num], polygeom.GetGeometryCount()))
 
         # Create output Feature
         outFeature = ogr.Feature(outlayerDef)                                   # Create new feature
         outFeature.SetGeometry(polygeom)                                        # Set output Shapefile's feature geometry
 
         # Fill in fields. All fields in input will be transferred to output
-        for fieldname in fieldNames:
-            if fieldname == 'AREASQKM':
-                outFeature.SetField(fieldname, float(polygeom.Area()/1000000.0))       # Add an area field to re-calculate area
+        for name, value in zip(fieldNames, attributes[idval]):
+            if name == 'AREASQKM':
+                outFeature.SetField(name, float(polygeom.Area()/1000000.0))     # Add an area field to re-calculate area
             else:
-                outFeature.SetField(fieldname, feature.GetField(fieldname))
+                outFeature.SetField(name, value)
         outLayer.CreateFeature(outFeature)                                      # Add new feature to output Layer
-        feature = outFeature = polygeom = None                                  # Clear memory
-        inLayer.SetAttributeFilter(None)
+        outFeature = polygeom = None                                            # Clear memory
+    outLayer.CommitTransaction()
     inlayerDef = outlayerDef = outLayer = None
-    del idval, fieldNames, valuelist, in_proj
+    del fieldNames, valuelist, attributes, out_wkbs, feat_counts, part_counts, in_proj
     print('    Done dissolving input layer in {0:3.2f} seconds.'.format(time.time()-tic1))
     return ds
 
@@ -1453,6 +2255,36 @@ def add_CRS_var(rootgrp, sr, map_pro, CoordSysVarName, grid_mapping, PE_string,
     rootgrp.Conventions = CFConv                                                # Maybe 1.0 is enough?
     return rootgrp
 
+def nc_var_options(rootgrp, dims, dtype, zlib=None, complevel=None, shuffle=None, chunk=None, least_significant_digit=None):
+    '''
+    Build the createVariable keyword arguments (zlib, complevel, shuffle,
+    chunksizes, least_significant_digit) for a gridded variable with dimensions
+    'dims' in rootgrp. Options that are not given are taken from the global
+    ncZlib, ncComplevel, ncShuffle, ncChunk and ncLeastSignificantDigit settings.
+    The chunk shape applies to the last two (y, x) dimensions, and any leading
+    dimensions are chunked one at a time. Quantization applies only to floating
+    point variables. NETCDF3 files do not support these options, so no options
+    are returned for them.
+    '''
+    zlib = ncZlib if zlib is None else zlib
+    complevel = ncComplevel if complevel is None else complevel
+    shuffle = ncShuffle if shuffle is None else shuffle
+    chunk = ncChunk if chunk is None else chunk
+    least_significant_digit = ncLeastSignificantDigit if least_significant_digit is None else least_significant_digit
+
+    options = {}
+    if not rootgrp.data_model.startswith('NETCDF4'):
+        return options
+    if zlib:
+        options.update(zlib=True, complevel=int(complevel), shuffle=bool(shuffle))
+    if chunk:
+        sizes = [max(len(rootgrp.dimensions[dim]), 1) for dim in dims]
+        chunksizes = [1]*(len(sizes)-len(chunk)) + [min(int(size), int(chunk_size)) for size, chunk_size in zip(sizes[-len(chunk):], chunk)]
+        options['chunksizes'] = tuple(chunksizes[-len(sizes):])
+    if least_significant_digit is not None and numpy.dtype(dtype).kind == 'f':
+        options['least_significant_digit'] = int(least_significant_digit)
+    return options
+
 def create_CF_NetCDF(grid_obj, rootgrp, projdir, addLatLon=False, notes='', addVars=[], latArr=None, lonArr=None):
     """This function will create the netCDF file with CF conventions for the grid
     description. Valid output formats are 'GEOGRID', 'ROUTING_GRID', and 'POINT'.
@@ -1528,7 +2360,7 @@ def create_CF_NetCDF(grid_obj, rootgrp, projdir, addLatLon=False, notes='', addV
 
     # For prefilling additional variables and attributes on the same 2D grid, given as a list [[<varname>, <vardtype>, <long_name>],]
     for varinfo in addVars:
-        ncvar = rootgrp.createVariable(varinfo[0], varinfo[1], ('y', 'x'))
+        ncvar = rootgrp.createVariable(varinfo[0], varinfo[1], ('y', 'x'), **nc_var_options(rootgrp, ('y', 'x'), varinfo[1]))
         ncvar.esri_pe_string = PE_string
         ncvar.grid_mapping = CoordSysVarName
         #ncvar.long_name = varinfo[2]
@@ -1546,8 +2378,8 @@ def create_CF_NetCDF(grid_obj, rootgrp, projdir, addLatLon=False, notes='', addV
 
         # Populate this file with 2D latitude and longitude variables
         # Latitude and Longitude variables (WRF)
-        lat_WRF = rootgrp.createVariable('LATITUDE', 'f4', ('y', 'x'))          # (32-bit floating point)
-        lon_WRF = rootgrp.createVariable('LONGITUDE', 'f4', ('y', 'x'))         # (32-bit floating point)
+        lat_WRF = rootgrp.createVariable('LATITUDE', 'f4', ('y', 'x'), **nc_var_options(rootgrp, ('y', 'x'), 'f4'))     # (32-bit floating point)
+        lon_WRF = rootgrp.createVariable('LONGITUDE', 'f4', ('y', 'x'), **nc_var_options(rootgrp, ('y', 'x'), 'f4'))    # (32-bit floating point)
         lat_WRF.long_name = 'latitude coordinate'                               # 'LATITUDE on the WRF Sphere'
         lon_WRF.long_name = 'longitude coordinate'                              # 'LONGITUDE on the WRF Sphere'
         lat_WRF.units = "degrees_north"
@@ -1599,12 +2431,15 @@ def create_CF_NetCDF(grid_obj, rootgrp, projdir, addLatLon=False, notes='', addV
     # Return the netCDF file to the calling script
     return rootgrp, grid_mapping
 
-def build_GW_Basin_Raster(in_nc, projdir, in_method, strm, fdir, grid_obj, in_Polys=None):
+def build_GW_Basin_Raster(in_nc, projdir, in_method, strm, fdir, grid_obj, in_Polys=None, save_polygons=False):
     '''
     10/10/2017:
     This function was added to build the groundwater basins raster using a variety
     of methods. The result is a raster on the fine-grid which can be used to create
     groundwater bucket parameter tables in 1D and 2D for input to WRF-Hydro.
+
+    For the polygon method, the projected polygons are rasterized in memory. They
+    are written to Projected_GW_Basins.shp in projdir only if save_polygons=True.
     '''
 
     #(in_nc, in_method, strm, grid_obj, in_Polys) = (inFulldom, defaultGWmethod, channelgrid, fine_grid, in_GWPolys)
@@ -1638,13 +2473,11 @@ def build_GW_Basin_Raster(in_nc, projdir, in_method, strm, fdir, grid_obj, in_Po
         streams = os.path.basename(strm)
         dir_d8 = os.path.basename(fdir)
         sub_basins_file = os.path.join(projdir, sub_basins)
-        stream_id_file = os.path.join(projdir, stream_id)
 
-        # See if the link ID grid has already been created.
-        if not os.path.exists(stream_id_file):
-            wbt.stream_link_identifier(fdir, strm, stream_id, esri_pntr=True, zero_background=False)
-
-        # Build sub-basins, one for each reach
+        # Build sub-basins, one for each reach. Sub-basins are derived from the flow
+        # direction and stream rasters only, so the link ID grid written by Routing_Table
+        # is not needed. This step must wait until every writer of the stream raster
+        # (strm) has finished, such as forecast_points masking channels to basins.
         wbt.subbasins(dir_d8, streams, sub_basins, esri_pntr=esri_pntr)
 
         # Create raster object from output
@@ -1659,25 +2492,34 @@ def build_GW_Basin_Raster(in_nc, projdir, in_method, strm, fdir, grid_obj, in_Po
         # Project the input polygons to the output coordinate system
         Poly_FC = os.path.join(projdir, 'Projected_GW_Basins.shp')
         poly_ds, poly_layer, fieldNames = project_Features(in_Polys, grid_obj.proj)
-        out_ds = ogr.GetDriverByName(VectorDriver).CopyDataSource(poly_ds, Poly_FC) # Copy to file on disk
+        geoms, columns = read_layer_columnar(poly_layer)
+        fields = layer_fields(poly_layer)
+        geomType = poly_layer.GetGeomType()
         poly_layer = poly_ds = None
 
         # Assign a new ID field for basins, numbered 1...n. Add field to store this information if necessary
         print('        Adding auto-incremented basin ID field (1...n)')
-        poly_layer = out_ds.GetLayer()
         basinID = "newID"
-        if basinID not in fieldNames:
-            poly_layer.CreateField(ogr.FieldDefn(basinID, ogr.OFTInteger))
-        for num,feature in enumerate(poly_layer):
-            feature.SetField(basinID, num+1)      # Add an area field to re-calculate area
-            poly_layer.SetFeature(feature)
-        poly_layer.ResetReading()
-        feature = out_ds = poly_layer = None
-        del fieldNames
-
-        # Convert from polygon features to raster object.
-        GWBasns = FeatToRaster(Poly_FC, strm, basinID, gdal.GDT_Int32, NoData=NoDataVal)
-        ogr.GetDriverByName(VectorDriver).DeleteDataSource(Poly_FC)             # Delete temporary shapefile
+        if basinID not in columns:
+            fields.append((basinID, ogr.OFTInteger, None))
+        columns[basinID] = numpy.arange(1, len(geoms)+1, dtype=numpy.int32)
+
+        # Convert from polygon features to raster object, using an in-memory layer
+        wkbs = shapely.to_wkb(geoms)
+        mem_ds = ogr.GetDriverByName('MEMORY').CreateDataSource('')
+        mem_layer = write_layer_columnar(mem_ds, 'Projected_GW_Basins', grid_obj.proj, geomType, wkbs, fields, columns)
+        GWBasns = FeatToRaster(mem_layer, grid_obj, basinID, gdal.GDT_Int32, NoData=NoDataVal)
+        mem_layer = mem_ds = None
+
+        # Write the projected polygons to disk only if requested
+        if save_polygons:
+            driver = ogr.GetDriverByName(VectorDriver)
+            if os.path.exists(Poly_FC):
+                driver.DeleteDataSource(Poly_FC)
+            out_ds = driver.CreateDataSource(Poly_FC)
+            write_layer_columnar(out_ds, os.path.splitext(os.path.basename(Poly_FC))[0], grid_obj.proj, geomType, wkbs, fields, columns)
+            out_ds = driver = None
+        del fieldNames, geoms, columns, fields, wkbs
 
     print('    Finished building fine-grid groundwater basin grids in {0: 3.2f} seconds'.format(time.time()-tic1))
     return GWBasns
@@ -2259,29 +3101,39 @@ def WB_functions(rootgrp, indem, projdir, threshold, ovroughrtfac_val, retdeprtf
     print('    Terrain processing step completed without error in {0: 3.2f} seconds.'.format(time.time()-tic1))
     return rootgrp, dir_d8_file, flow_acc_file, streams_file, fill_pits_file, strahler_file
 
-def CSV_to_SHP(in_csv, DriverName='MEMORY', xVar='LON', yVar='LAT', idVar='FID', toProj=None):
-    tic1 = time.time()
-
-    drv = ogr.GetDriverByName(DriverName)
-    if drv is None:
-        print('      {0} driver not available.'.format(DriverName))
-        raise SystemExit
+def read_points_csv(in_csv, xVar='LON', yVar='LAT', idVar='FID'):
+    '''
+    Read the ID and coordinates of all points in a CSV file, such as a forecast
+    point file. The file is parsed in one vectorized call, using pyarrow if it
+    is available. Returns arrays of IDs, x and y coordinates.
+    '''
+    if pyarrow is not None:
+        table = pyarrow.csv.read_csv(in_csv)
+        ids = table.column(idVar).to_numpy()
+        x = table.column(xVar).to_numpy().astype(numpy.float64)
+        y = table.column(yVar).to_numpy().astype(numpy.float64)
+        del table
     else:
-        data_source = drv.CreateDataSource('')
-
-    # Read the input CSV file
-    csv_arr = numpy.genfromtxt(in_csv, delimiter=',', names=True)
-
-    # create the spatial reference for the input point CSV file, WGS84
+        csv_arr = numpy.atleast_1d(numpy.genfromtxt(in_csv, delimiter=',', names=True))
+        ids = csv_arr[idVar]
+        x = csv_arr[xVar].astype(numpy.float64)
+        y = csv_arr[yVar].astype(numpy.float64)
+        del csv_arr
+    return ids, x, y
+
+def wgs84_to_proj(x, y, toProj=None):
+    '''
+    Transform arrays of WGS84 longitude (x) and latitude (y) coordinates to the
+    coordinate system given by the WKT string toProj, all at once. Returns the
+    transformed coordinates and the spatial reference of the output coordinates.
+    '''
+    # create the spatial reference for the input coordinates, WGS84
     srs = osr.SpatialReference()
     srs.ImportFromProj4(wgs84_proj4)
-
-    # Handle coordinate transformation
     if toProj is not None:
         # Create the spatial reference for the output
         out_srs = osr.SpatialReference()
         out_srs.ImportFromWkt(toProj)
-        transform = osr.CoordinateTransformation(srs, out_srs)
     else:
         out_srs = srs.Clone()
 
@@ -2291,90 +3143,139 @@ def CSV_to_SHP(in_csv, DriverName='MEMORY', xVar='LON', yVar='LAT', idVar='FID',
         srs.SetAxisMappingStrategy(osgeo.osr.OAMS_TRADITIONAL_GIS_ORDER)
         out_srs.SetAxisMappingStrategy(osgeo.osr.OAMS_TRADITIONAL_GIS_ORDER)
 
-    # Add the fields we're interested in
-    layer = data_source.CreateLayer('frxst_FC', out_srs, ogr.wkbPoint)
-    layer.CreateField(ogr.FieldDefn(idVar, ogr.OFTInteger))
-    layer.CreateField(ogr.FieldDefn(yVar, ogr.OFTReal))
-    layer.CreateField(ogr.FieldDefn(xVar, ogr.OFTReal))
-    featureDefn = layer.GetLayerDefn()
-
-    # Process the text file and add the attributes and features to the shapefile
-    for row in csv_arr:
-        x = row[xVar]
-        y = row[yVar]
-
-        # Set the attributes using the values from the delimited text file
-        feature = ogr.Feature(featureDefn)                               # create the feature
-        feature.SetField(idVar, row[idVar])
-        feature.SetField(yVar, y)
-        feature.SetField(xVar, x)
-
-        #create point geometry
-        if toProj is not None:
-            x,y,z = transform.TransformPoint(x,y)
-            pass
-        point = ogr.Geometry(ogr.wkbPoint)
-        point.AddPoint(x,y)
+    # Handle coordinate transformation
+    if toProj is not None:
+        x, y = transform_points(osr.CoordinateTransformation(srs, out_srs), x, y)
+    srs = None
+    return x, y, out_srs
 
-        # Create the feature and set values
-        feature.SetGeometry(point)
-        layer.CreateFeature(feature)
-        feature = point = None
-        del x, y
-    layer = srs = drv = None                                      # Saveand close the data source
+def CSV_to_SHP(in_csv, DriverName='MEMORY', xVar='LON', yVar='LAT', idVar='FID', toProj=None):
+    tic1 = time.time()
+
+    drv = ogr.GetDriverByName(DriverName)
+    if drv is None:
+        print('      {0} driver not available.'.format(DriverName))
+        raise SystemExit
+    else:
+        data_source = drv.CreateDataSource('')
+
+    # Read the input CSV file and build the point geometries for all rows at once, transforming if necessary
+    ids, x, y = read_points_csv(in_csv, xVar=xVar, yVar=yVar, idVar=idVar)
+    trans_x, trans_y, out_srs = wgs84_to_proj(x, y, toProj=toProj)
+    points = shapely.to_wkb(shapely.points(trans_x, trans_y))
+
+    # Add the fields we're interested in, and the attributes from the delimited text file
+    fields = [(idVar, ogr.OFTInteger, None), (yVar, ogr.OFTReal, None), (xVar, ogr.OFTReal, None)]
+    columns = {idVar:ids.astype(numpy.int32),
+                yVar:y,
+                xVar:x}
+    layer = write_layer_columnar(data_source, 'frxst_FC', out_srs, ogr.wkbPoint, points, fields, columns)
+    print('      Created {0} points from {1} in {2:3.2f} seconds.'.format(ids.shape[0], os.path.basename(in_csv), time.time()-tic1))
+    layer = drv = None                                      # Saveand close the data source
+    del ids, x, y, trans_x, trans_y, points, columns
     return data_source
 
-def forecast_points(in_csv, rootgrp, bsn_msk, projdir, DX, WKT, fdir, fac, strm):
-    # (in_csv, rootgrp, bsn_msk, projdir, template_raster) = (in_csv, rootgrp2, basin_mask, projdir, mosprj)
+def snap_points(rows, cols, snap_arr, radius, method='max'):
+    '''
+    Snap a set of grid cells (rows, cols) to a cell within 'radius' cells, for all
+    points at once, by gathering the circular window around every point in a
+    single indexing operation.
 
-    tic1 = time.time()
+        method='max'        Move to the cell with the largest value of snap_arr
+                            (such as flow accumulation), as in Whitebox SnapPourPoints.
+        method='nearest'    Move to the nearest cell where snap_arr is True (such
+                            as stream cells), as in Whitebox JensonSnapPourPoints.
 
-    # Setup whitebox tool object and options
-    wbt = WhiteboxTools()
-    wbt.verbose = False
-    wbt.work_dir = projdir
-    esri_pntr = True
+    Ties are resolved in favor of the cell nearest to the point. Points with no
+    valid cell within the window are not moved. Returns the snapped rows and columns.
+    '''
+    nrows, ncols = snap_arr.shape
+    off_rows, off_cols = numpy.mgrid[-radius:radius+1, -radius:radius+1]
+    dist = (off_rows**2 + off_cols**2).ravel()
+    order = numpy.argsort(dist, kind='stable')                                  # Search offsets from nearest to farthest
+    order = order[dist[order] <= radius**2]
+    off_rows = off_rows.ravel()[order]
+    off_cols = off_cols.ravel()[order]
+
+    # Gather the window of every point: one row per point, one column per offset
+    win_rows = numpy.asarray(rows)[:,None] + off_rows[None,:]
+    win_cols = numpy.asarray(cols)[:,None] + off_cols[None,:]
+    in_grid = (win_rows>=0) & (win_rows<nrows) & (win_cols>=0) & (win_cols<ncols)
+    vals = snap_arr[numpy.clip(win_rows, 0, nrows-1), numpy.clip(win_cols, 0, ncols-1)]
+    if method == 'max':
+        vals = numpy.where(in_grid, vals.astype(numpy.float64), -numpy.inf)
+        found = numpy.isfinite(vals).any(axis=1)
+    else:
+        vals = in_grid & vals.astype(bool)
+        found = vals.any(axis=1)
+    best = numpy.argmax(vals, axis=1)                                           # First (nearest) occurrence of the best cell
+    point_idx = numpy.arange(best.shape[0])
+    snap_rows = numpy.where(found, win_rows[point_idx, best], rows)
+    snap_cols = numpy.where(found, win_cols[point_idx, best], cols)
+    return snap_rows, snap_cols
+
+def forecast_points(in_csv, rootgrp, bsn_msk, projdir, grid_obj, strm):
+    # (in_csv, rootgrp, bsn_msk, projdir, grid_obj, strm) = (in_csv, rootgrp2, basin_mask, projdir, fine_grid, channelgrid)
+
+    tic1 = time.time()
 
-    # Setup snap tolerances for snapping forecast points to channel pixels
-    snap_dist1 = int(DX)                                                        # This is to put the point on the grid only. One pixel tolerance
-    snap_dist2 = int(DX * walker)                                               # This is to search for the within a distance
+    # Setup snap tolerance for snapping forecast points to channel pixels
+    snap_cells = int(walker)                                                    # This is to search for the within a distance (walker cells)
 
-    # Make feature layer from CSV
+    # Read the forecast points from CSV and transform them to the routing grid
     print('    Forecast points provided and basins being delineated.')
-    frxst_FC = os.path.join(projdir, 'Temp_Frxst_Pts.shp')
-    ds = CSV_to_SHP(in_csv, DriverName='MEMORY', xVar='LON', yVar='LAT', idVar='FID', toProj=WKT)  # In-memory features
-    out_ds = ogr.GetDriverByName(VectorDriver).CopyDataSource(ds, frxst_FC)    # Copy to file on disk
-    ds = out_ds = None
-
-    # Snap pour points to channel grid within a tolerance
-    wbt.jenson_snap_pour_points(frxst_FC, strm, snapPour1, snap_dist2)
-
-    # Convert point shapefile to raster
-    frxst_raster = FeatToRaster(frxst_FC, fac, 'FID', gdal.GDT_Int32, NoData=NoDataVal)
-    frxst_raster_arr = BandReadAsArray(frxst_raster.GetRasterBand(1))
-    frxst_raster = None
-    frxst_raster_arr[frxst_raster_arr==0] = NoDataVal                           # Replace 0 with WRF-Hydro NoData value
+    ids, x, y = read_points_csv(in_csv, xVar='LON', yVar='LAT', idVar='FID')
+    x, y = wgs84_to_proj(x, y, toProj=grid_obj.WKT)[:2]
+    ids = ids.astype(numpy.int32)
+    GT = grid_obj.GeoTransform()
+    flac_arr = numpy.asarray(rootgrp.variables['FLOWACC'][:])                   # Read flow accumulation array from Fulldom
+    nrows, ncols = grid_obj.nrows, grid_obj.ncols
+    cols = numpy.floor((x - GT[0])/GT[1]).astype(numpy.int64)
+    rows = numpy.floor((y - GT[3])/GT[5]).astype(numpy.int64)
+    on_grid = (rows>=0) & (rows<nrows) & (cols>=0) & (cols<ncols)
+    if not on_grid.all():
+        print('    {0} forecast points are outside of the routing grid and will be ignored.'.format((~on_grid).sum()))
+    pour_ids = numpy.arange(1, ids.shape[0]+1, dtype=numpy.int32)[on_grid]      # Watersheds are numbered in the order of the points
+    pour_fids = numpy.full(ids.shape[0]+1, NoDataVal, dtype=numpy.int32)        # Lookup from watershed number to forecast point FID
+    pour_fids[1:] = ids
+    ids, rows, cols = ids[on_grid], rows[on_grid], cols[on_grid]
+    del x, y, on_grid
+
+    # Snap forecast points to the nearest channel cell within a tolerance
+    strm_arr = numpy.asarray(rootgrp.variables['CHANNELGRID'][:]) == 0          # Active channel cells
+    frxst_rows, frxst_cols = snap_points(rows, cols, strm_arr, snap_cells, method='nearest')
+    frxst_raster_arr = numpy.full((nrows, ncols), NoDataVal, dtype=numpy.int32)
+    frxst_raster_arr[frxst_rows, frxst_cols] = ids
     rootgrp.variables['frxst_pts'][:] = frxst_raster_arr
     print('    Process: frxst_pts written to output netCDF.')
-    del frxst_raster_arr
+    del frxst_raster_arr, strm_arr
 
     # Snap pour points to flow accumulation grid within a tolerance
-    wbt.snap_pour_points(frxst_FC, fac, snapPour2, snap_dist2)
-
-    # Delineate above points
-    watershed_file = os.path.join(projdir, watersheds)
-    wbt.watershed(fdir, snapPour2, watershed_file, esri_pntr=esri_pntr)
-    watershed_arr, ndv = return_raster_array(watershed_file)
-    watershed_arr[watershed_arr==ndv] = NoDataVal                               # Replace raster NoData with WRF-Hydro NoData value
+    snap_rows, snap_cols = snap_points(rows, cols, flac_arr, snap_cells, method='max')
+    pour_arr = numpy.full((nrows, ncols), NoDataVal, dtype=numpy.int32)
+    pour_arr[snap_rows, snap_cols] = pour_ids
+    del flac_arr, pour_ids, rows, cols
+
+    # Delineate above points in a single pass over the flow direction grid
+    fdir_arr = numpy.asarray(rootgrp.variables['FLOWDIRECTION'][:])             # Read flow direction array from Fulldom
+    watershed_arr, hierarchy = label_watersheds(fdir_arr, pour_arr)
     rootgrp.variables['basn_msk'][:] = watershed_arr
     print('    Process: basn_msk written to output netCDF.')
-    remove_file(watershed_file)                                                 # Delete fac from disk
-    del ndv, watershed_file
+    del fdir_arr, pour_arr
+
+    # Write the nested forecast point hierarchy (which forecast point each drains to)
+    hierFile = os.path.join(projdir, gageHierCSV)
+    with open(hierFile, 'w') as f:
+        w = csv.writer(f)
+        w.writerow(['FID', 'TO_FID'])
+        w.writerows((pour_fids[pour_id], pour_fids[to_id] if to_id!=NoDataVal else NoDataVal) for pour_id, to_id in sorted(hierarchy.items()))
+    print('    Found {0} forecast points nested within the basin of another forecast point.'.format(sum(to_id!=NoDataVal for to_id in hierarchy.values())))
+    del hierarchy, pour_fids, hierFile
 
-    # Delete temporary point shapefiles
-    ogr.GetDriverByName(VectorDriver).DeleteDataSource(frxst_FC)
-    ogr.GetDriverByName(VectorDriver).DeleteDataSource(os.path.join(projdir, snapPour1))
-    ogr.GetDriverByName(VectorDriver).DeleteDataSource(os.path.join(projdir, snapPour2))
+    # Write the frxst_pts cell, basn_msk label and basin outlet of each forecast point, for update_forecast_points
+    write_forecast_basins(os.path.join(projdir, gageBasinCSV), ids, frxst_rows, frxst_cols,
+                        watershed_arr[snap_rows, snap_cols], snap_rows, snap_cols)
+    del ids, frxst_rows, frxst_cols, snap_rows, snap_cols
 
     # Set mask for future raster output
     if bsn_msk:
@@ -2404,14 +3305,307 @@ def forecast_points(in_csv, rootgrp, bsn_msk, projdir, DX, WKT, fdir, fac, strm)
     print('    Built forecast point outputs in {0: 3.2f} seconds.'.format(time.time()-tic1))
     return rootgrp
 
-def build_RouteLink(RoutingNC, order, From_To, NodeElev, NodesLL, NodesXY, Lengths, StrOrder, Slopes, gageDict=None):
+def write_forecast_basins(out_csv, ids, frxst_rows, frxst_cols, labels, outlet_rows, outlet_cols):
+    '''
+    Write the frxst_pts cell, basn_msk label and basin outlet (pour point) cell of
+    each forecast point to a CSV file (gageBasinCSV). The table lets
+    update_forecast_points find the cells and basin of an existing forecast point
+    directly, without searching the grid.
+    '''
+    with open(out_csv, 'w') as f:
+        w = csv.writer(f)
+        w.writerow(['FID', 'FRXST_ROW', 'FRXST_COL', 'BASN_MSK', 'OUTLET_ROW', 'OUTLET_COL'])
+        w.writerows(zip(*[numpy.asarray(arr).tolist() for arr in (ids, frxst_rows, frxst_cols, labels, outlet_rows, outlet_cols)]))
+
+def read_forecast_basins(in_csv):
+    '''
+    Read a table written by write_forecast_basins. Returns a dictionary of
+    {FID: (frxst_pts row, frxst_pts column, basn_msk label, outlet row, outlet column)}.
+    '''
+    fields = ['FRXST_ROW', 'FRXST_COL', 'BASN_MSK', 'OUTLET_ROW', 'OUTLET_COL']
+    with open(in_csv, 'r') as f:
+        return {int(row['FID']):tuple(int(row[field]) for field in fields) for row in csv.DictReader(f)}
+
+def cells_index(rows, cols):
+    '''
+    Build an index to read or write a set of cells (rows, cols) of a 2D netCDF
+    variable in a single call, using only the rows and columns that the cells
+    fall on (orthogonal indexing), which is never larger than the window that
+    bounds the cells. Returns the index and the position of each cell in the
+    array that the index selects, so that var[index][position] gives the cell
+    values.
+    '''
+    urows, row_pos = numpy.unique(numpy.asarray(rows, dtype=numpy.int64), return_inverse=True)
+    ucols, col_pos = numpy.unique(numpy.asarray(cols, dtype=numpy.int64), return_inverse=True)
+    return (urows, ucols), (row_pos.ravel(), col_pos.ravel())
+
+def upstream_window(rootgrp, row, col, margin=64):
+    '''
+    Find the cells upstream of the cell (row, col) that share its basn_msk label,
+    reading FLOWDIRECTION and basn_msk only within a window around the cell. The
+    window extends 'margin' cells on each side of the cell, and is doubled until
+    the upstream cells no longer reach its edge (or it covers the grid). Returns
+    the window (as slices), the FLOWDIRECTION and basn_msk arrays in the window,
+    and the rows and columns of the upstream cells within the window.
+    '''
+    ncVars = rootgrp.variables
+    nrows, ncols = ncVars['basn_msk'].shape
+    while True:
+        r0, r1 = max(row-margin, 0), min(row+margin+1, nrows)
+        c0, c1 = max(col-margin, 0), min(col+margin+1, ncols)
+        win = (slice(r0, r1), slice(c0, c1))
+        fdir_win = numpy.asarray(ncVars['FLOWDIRECTION'][win])
+        basn_win = numpy.asarray(ncVars['basn_msk'][win])
+        up_rows, up_cols = upstream_cells(fdir_win, [row-r0], [col-c0], labels=basn_win)
+        at_edge = (r0>0 and (up_rows==0).any()) or (r1<nrows and (up_rows==r1-r0-1).any())
+        at_edge |= (c0>0 and (up_cols==0).any()) or (c1<ncols and (up_cols==c1-c0-1).any())
+        if not at_edge:
+            return win, fdir_win, basn_win, up_rows, up_cols
+        margin *= 2
+
+def update_forecast_points(in_csv, rootgrp, grid_obj, in_basins, in_RL=None):
+    '''
+    This function adds or moves forecast points in an existing routing stack,
+    without re-running the terrain processing. The Fulldom file (rootgrp) must be
+    open for writing, and grid_obj must describe the routing grid (WRF_Hydro_Grid
+    of the Fulldom file). The frxst_pts cell, basn_msk label and basin outlet of
+    the existing forecast points are taken from the table written by
+    forecast_points (in_basins), which is updated in place. Forecast points in the
+    CSV file that are new, or whose snapped location differs from the location in
+    the table, are updated using the stored FLOWDIRECTION, FLOWACC and CHANNELGRID
+    layers. Forecast points that are not in the CSV file are left as they are.
+
+        1) New and moved points are snapped as in forecast_points, reading only the
+           window of the grid that surrounds the points.
+        2) The basin of a moved point is merged into the basin downstream of its
+           outlet, and the label is reused at the new location.
+        3) Each new or moved point takes over the cells upstream of it that share
+           its basn_msk label, so nested basins upstream of it are not changed.
+        4) If a Route_Link file is provided, the 'gages' field is cleared for moved
+           points and set on the link (LINKID) under each new or moved point.
+
+    Each basin is traced within a window of FLOWDIRECTION and basn_msk around its
+    outlet, which is enlarged until it holds the whole basin (upstream_window), and
+    only that window is written. frxst_pts and LINKID are read only at the cells
+    of the changed points. CHANNELGRID is not re-masked to the updated basins.
+    '''
+    tic1 = time.time()
+    print('    Updating forecast points in existing routing stack.')
+    ncVars = rootgrp.variables
+
+    # Setup snap tolerance for snapping forecast points to channel pixels
+    snap_cells = int(walker)                                                    # This is to search for the within a distance (walker cells)
+
+    # Read the cells and basin of each existing forecast point
+    if not os.path.exists(in_basins):
+        print('      Forecast point basin table {0} not found. Re-run forecast point processing to create it.'.format(in_basins))
+        raise SystemExit
+    basins = read_forecast_basins(in_basins)
+
+    # Read the forecast points from CSV and transform them to the routing grid
+    ids, x, y = read_points_csv(in_csv, xVar='LON', yVar='LAT', idVar='FID')
+    x, y = wgs84_to_proj(x, y, toProj=grid_obj.WKT)[:2]
+    ids = ids.astype(numpy.int32)
+    nrows, ncols = grid_obj.nrows, grid_obj.ncols
+    cols = numpy.floor((x - grid_obj.x00)/grid_obj.DX).astype(numpy.int64)
+    rows = numpy.floor((y - grid_obj.y00)/grid_obj.DY).astype(numpy.int64)
+    on_grid = (rows>=0) & (rows<nrows) & (cols>=0) & (cols<ncols)
+    if not on_grid.all():
+        print('    {0} forecast points are outside of the routing grid and will be ignored.'.format((~on_grid).sum()))
+    ids, rows, cols = ids[on_grid], rows[on_grid], cols[on_grid]
+    del x, y, on_grid
+    if ids.shape[0] == 0:
+        print('    No forecast points found on the routing grid.')
+        return rootgrp
+
+    # Snap within the window of the grid that surrounds all of the points
+    r0, r1 = max(int(rows.min())-snap_cells, 0), min(int(rows.max())+snap_cells+1, nrows)
+    c0, c1 = max(int(cols.min())-snap_cells, 0), min(int(cols.max())+snap_cells+1, ncols)
+    win = (slice(r0, r1), slice(c0, c1))
+    strm_arr = numpy.asarray(ncVars['CHANNELGRID'][win]) == 0                  # Active channel cells
+    frxst_rows, frxst_cols = snap_points(rows-r0, cols-c0, strm_arr, snap_cells, method='nearest')
+    flac_win = numpy.asarray(ncVars['FLOWACC'][win])
+    pour_rows, pour_cols = snap_points(rows-r0, cols-c0, flac_win, snap_cells, method='max')
+    pour_fac = flac_win[pour_rows, pour_cols]
+    frxst_rows, frxst_cols, pour_rows, pour_cols = frxst_rows+r0, frxst_cols+c0, pour_rows+r0, pour_cols+c0
+    del strm_arr, flac_win, rows, cols, win
+
+    # Only new points and points that snap to a different cell are updated
+    new_cells = zip(ids.tolist(), frxst_rows.tolist(), frxst_cols.tolist(), pour_rows.tolist(), pour_cols.tolist())
+    changed = numpy.array([fid not in basins or (basins[fid][0], basins[fid][1], basins[fid][3], basins[fid][4]) != (frxst_row, frxst_col, pour_row, pour_col)
+                    for fid, frxst_row, frxst_col, pour_row, pour_col in new_cells], dtype=bool)
+    moved = [fid for fid in ids[changed].tolist() if fid in basins]
+    print('    Found {0} new and {1} moved forecast points ({2} unchanged).'.format(changed.sum()-len(moved), len(moved), (~changed).sum()))
+    ids, frxst_rows, frxst_cols = ids[changed], frxst_rows[changed], frxst_cols[changed]
+    pour_rows, pour_cols, pour_fac = pour_rows[changed], pour_cols[changed], pour_fac[changed]
+    if ids.shape[0] == 0:
+        return rootgrp
+    del new_cells, changed
+
+    # Check that the basin table matches basn_msk before anything is changed
+    if len(moved) > 0:
+        idx, pos = cells_index([basins[fid][3] for fid in moved], [basins[fid][4] for fid in moved])
+        found = numpy.asarray(ncVars['basn_msk'][idx])[pos]
+        stale = [fid for fid, label in zip(moved, found.tolist()) if label != basins[fid][2]]
+        if len(stale) > 0:
+            print('      The basn_msk label of forecast points {0} does not match {1}.'.format(stale, in_basins))
+            raise SystemExit
+        del idx, pos, found, stale
+
+    # Move frxst_pts from the old to the new cell of each point, in a single read and write
+    old_rows = [basins[fid][0] for fid in moved]
+    old_cols = [basins[fid][1] for fid in moved]
+    idx, pos = cells_index(numpy.r_[old_rows, frxst_rows], numpy.r_[old_cols, frxst_cols])
+    frxst_arr = numpy.asarray(ncVars['frxst_pts'][idx])
+    old_pos = (pos[0][:len(moved)], pos[1][:len(moved)])
+    kept_cells = {basins[fid][:2]:fid for fid in basins if fid not in moved}   # Cells shared with a point that is not moved
+    restore = numpy.array([kept_cells.get(basins[fid][:2], NoDataVal) for fid in moved], dtype=numpy.int32)
+    frxst_arr[old_pos] = numpy.where(frxst_arr[old_pos]==moved, restore, frxst_arr[old_pos])
+    frxst_arr[pos[0][len(moved):], pos[1][len(moved):]] = ids
+    ncVars['frxst_pts'][idx] = frxst_arr
+    print('    Process: frxst_pts updated at {0} cells.'.format(len(moved)+ids.shape[0]))
+    del old_rows, old_cols, idx, pos, frxst_arr, old_pos, kept_cells, restore
+
+    # Remove the basins of moved points by merging them into the basin downstream of each outlet
+    new_labels = {}
+    kept_labels = set(basins[fid][2] for fid in basins if fid not in moved)    # Basins shared with a point that is not moved
+    for fid in moved:
+        label, out_row, out_col = basins[fid][2:]
+        if label in kept_labels or label in new_labels.values():
+            continue
+        win, fdir_win, basn_win, up_rows, up_cols = upstream_window(rootgrp, out_row, out_col)
+        out_row, out_col = out_row-win[0].start, out_col-win[1].start
+        to_row, to_col = walk_downstream(fdir_win, [out_row], [out_col], 1)
+        to_label = NoDataVal if (to_row[0], to_col[0]) == (out_row, out_col) else basn_win[to_row[0], to_col[0]]
+        basn_win[up_rows, up_cols] = to_label
+        ncVars['basn_msk'][win] = basn_win
+        new_labels[fid] = label                                                 # Reuse the label at the new location
+        del win, fdir_win, basn_win, up_rows, up_cols, to_row, to_col
+    del kept_labels
+
+    # Delineate new basins from the most downstream point to the most upstream point
+    next_label = max([cells[2] for cells in basins.values()], default=0) + 1
+    for idx in numpy.argsort(-pour_fac, kind='stable').tolist():
+        fid = int(ids[idx])
+        if fid not in new_labels:
+            new_labels[fid] = next_label
+            next_label += 1
+        win, fdir_win, basn_win, up_rows, up_cols = upstream_window(rootgrp, int(pour_rows[idx]), int(pour_cols[idx]))
+        basn_win[up_rows, up_cols] = new_labels[fid]
+        ncVars['basn_msk'][win] = basn_win
+        del win, fdir_win, basn_win, up_rows, up_cols
+    print('    Process: basn_msk updated upstream of {0} forecast points.'.format(ids.shape[0]))
+
+    # Update the basin table, reading the label at every outlet in case a new point shares an outlet
+    for fid, frxst_row, frxst_col, pour_row, pour_col in zip(ids.tolist(), frxst_rows.tolist(), frxst_cols.tolist(), pour_rows.tolist(), pour_cols.tolist()):
+        basins[fid] = (frxst_row, frxst_col, new_labels[fid], pour_row, pour_col)
+    fids = numpy.array(list(basins), dtype=numpy.int64)
+    table = numpy.array([basins[fid] for fid in fids.tolist()], dtype=numpy.int64)
+    idx, pos = cells_index(table[:,3], table[:,4])
+    table[:,2] = numpy.asarray(ncVars['basn_msk'][idx])[pos]
+    write_forecast_basins(in_basins, fids, table[:,0], table[:,1], table[:,2], table[:,3], table[:,4])
+    del basins, moved, new_labels, pour_rows, pour_cols, pour_fac, fids, table, idx, pos
+
+    # Patch the gages field of the Route_Link file in place
+    if in_RL:
+        idx, pos = cells_index(frxst_rows, frxst_cols)
+        link_ids = numpy.asarray(ncVars['LINKID'][idx])[pos]                    # LINKID under every new or moved point in a single read
+        rootgrp_RL = netCDF4.Dataset(in_RL, 'r+')
+        rootgrp_RL.set_auto_mask(False)
+        links = rootgrp_RL.variables['link'][:]
+        Gages = rootgrp_RL.variables['gages']
+        gage_strs = numpy.char.strip(numpy.ascontiguousarray(Gages[:]).view('S15').ravel())
+        clear_idx = numpy.flatnonzero(numpy.isin(gage_strs, [str(fid).encode() for fid in ids.tolist()]))
+        link_idx = dict(zip(links.tolist(), range(links.shape[0])))
+        set_idx = {}
+        for fid, link_id in zip(ids.tolist(), link_ids.tolist()):
+            if link_id in link_idx:
+                set_idx[link_idx[link_id]] = fid
+            else:
+                print('      Forecast point {0} is not on a link in the Route_Link file.'.format(fid))
+        for idx in clear_idx.tolist():
+            if idx not in set_idx:
+                Gages[idx,:] = numpy.frombuffer(b' '*15, dtype='S1')
+        for idx, fid in set_idx.items():
+            Gages[idx,:] = numpy.frombuffer(str(fid).rjust(15).encode(), dtype='S1')
+        rootgrp_RL.close()
+        print('    Process: gages updated for {0} links in {1}.'.format(len(set_idx), in_RL))
+        del pos, link_ids, links, Gages, gage_strs, clear_idx, link_idx, set_idx
+
+    print('    Updated forecast points in {0: 3.2f} seconds.'.format(time.time()-tic1))
+    return rootgrp
+
+def order_lookup(orders, lookup_dict):
+    '''
+    Gather order-based parameter values (Mannings_Order, Mannings_ChSSlp,
+    Mannings_Bw) for an array of stream orders. The dictionary is expanded to a
+    dense lookup table indexed by stream order so that all values are gathered
+    in a single vectorized indexing operation.
+    '''
+    orders = numpy.asarray(orders)
+    lut_size = max(max(lookup_dict.keys()), int(orders.max(initial=0))) + 1
+    lut = numpy.full(lut_size, numpy.nan, dtype=numpy.float64)
+    lut[list(lookup_dict.keys())] = list(lookup_dict.values())
+    vals = numpy.full(orders.shape, numpy.nan, dtype=numpy.float64)
+    valid = orders >= 0
+    vals[valid] = lut[orders[valid]]
+    if numpy.isnan(vals).any():
+        missing = numpy.unique(orders[numpy.isnan(vals)]).tolist()
+        raise KeyError('Stream order(s) {0} not found in order-based parameter table.'.format(missing))
+    return vals
+
+def build_RouteLink_table(order, From_To, NodeElev, NodesLL, NodesXY, Lengths, StrOrder, Slopes, gageDict=None):
+    '''
+    Convert the per-link dictionaries built by Routing_Table into a columnar
+    RouteLink table (a structured numpy array) in the topological order given
+    by 'order'. This is the table accepted by build_RouteLink. Each column is
+    filled from an iterator, so no intermediate Python lists are created.
+    '''
+    nlinks = len(order)
+    table = numpy.empty(nlinks, dtype=RouteLink_dtype)
+    table['link'] = numpy.fromiter(order, dtype='i4', count=nlinks)
+    table['to'] = numpy.fromiter((From_To.get(featID, 0) for featID in order), dtype='i4', count=nlinks)
+    table['lon'] = numpy.fromiter((NodesLL[featID][0] for featID in order), dtype='f8', count=nlinks)
+    table['lat'] = numpy.fromiter((NodesLL[featID][1] for featID in order), dtype='f8', count=nlinks)
+    table['x'] = numpy.fromiter((NodesXY[featID][0] for featID in order), dtype='f8', count=nlinks)
+    table['y'] = numpy.fromiter((NodesXY[featID][1] for featID in order), dtype='f8', count=nlinks)
+    table['alt'] = numpy.fromiter((NodeElev[featID] for featID in order), dtype='f8', count=nlinks)
+    table['Length'] = numpy.fromiter((Lengths[featID] for featID in order), dtype='f8', count=nlinks)
+    table['order'] = numpy.fromiter((StrOrder[featID] for featID in order), dtype='i4', count=nlinks)
+    table['So'] = numpy.fromiter((Slopes[featID] for featID in order), dtype='f8', count=nlinks)
+    table['gages'] = b''
+    if gageDict:
+        gage_links = [featID for featID in order if featID in gageDict]
+        gage_idx = numpy.flatnonzero(numpy.isin(table['link'], numpy.array(gage_links, dtype='i4')))
+        table['gages'][gage_idx] = [str(gageDict[featID]) for featID in table['link'][gage_idx].tolist()]
+    return table
+
+def build_RouteLink(RoutingNC, order, From_To=None, NodeElev=None, NodesLL=None, NodesXY=None, Lengths=None, StrOrder=None, Slopes=None, gageDict=None):
     '''
     8/10/2017: This function is designed to build the routiing parameter netCDF file.
                 Ideally, this will be the only place the produces the file, and
                 all functions wishing to write the file will reference this function.
+
+    'order' may be either a columnar RouteLink table already in topological order
+    (a structured numpy array with the fields of RouteLink_dtype, or a dictionary
+    of equal-length arrays with those keys), or a list of link IDs accompanied by
+    the per-link dictionaries, which are converted using build_RouteLink_table.
+    The 'gages' column is optional in a dictionary of arrays. Every variable is
+    written to the file in a single slab.
     '''
     tic1 = time.time()
 
+    if isinstance(order, (numpy.ndarray, dict)):
+        RL_table = order                                                        # Columnar table provided directly
+    else:
+        RL_table = build_RouteLink_table(order, From_To, NodeElev, NodesLL, NodesXY, Lengths, StrOrder, Slopes, gageDict=gageDict)
+    del order, From_To, NodeElev, NodesLL, NodesXY, Lengths, StrOrder, Slopes, gageDict
+    if isinstance(RL_table, numpy.ndarray):
+        table_fields = RL_table.dtype.names
+    else:
+        table_fields = list(RL_table.keys())
+    nlinks = len(RL_table['link'])
+
     # To create a netCDF parameter file
     rootgrp = netCDF4.Dataset(RoutingNC, 'w', format=outNCType)
 
@@ -2419,7 +3613,7 @@ def build_RouteLink(RoutingNC, order, From_To, NodeElev, NodesLL, NodesXY, Lengt
     #dim1 = 'linkDim'
     dim1 = 'feature_id'
     dim2 = 'IDLength'
-    dim = rootgrp.createDimension(dim1, len(order))
+    dim = rootgrp.createDimension(dim1, nlinks)
     gage_id = rootgrp.createDimension(dim2, 15)
 
     # Create fixed-length variables
@@ -2511,24 +3705,24 @@ def build_RouteLink(RoutingNC, order, From_To, NodeElev, NodesLL, NodesXY, Lengt
     rootgrp.history = 'Created %s' %time.ctime()
 
     print('        Starting to fill in routing table NC file.')
-    ids[:] = numpy.array(order)                                                 # Fill in id field information
+    ids[:] = RL_table['link']                                                   # Fill in id field information
 
     # Change None values to 0.  Could alternatively use numpy.nan
-    froms[:] = numpy.zeros(len(order))
-    tos[:] = numpy.array([From_To.get(featID, 0) for featID in order])
+    froms[:] = numpy.zeros(nlinks, dtype='i4')
+    tos[:] = RL_table['to']
 
     # Fill in other variables
-    slons[:] = numpy.array([NodesLL[featID][0] for featID in order])
-    slats[:] = numpy.array([NodesLL[featID][1] for featID in order])
-    geo_x[:] = numpy.array([NodesXY[featID][0] for featID in order])
-    geo_y[:] = numpy.array([NodesXY[featID][1] for featID in order])
-    selevs[:] = numpy.array([round(NodeElev[featID], 3) for featID in order])   # Round to 3 decimal places
-    Lengthsnc[:] = numpy.array([round(Lengths[featID], 1) for featID in order]) # Round to 1 decimal place
+    slons[:] = RL_table['lon']
+    slats[:] = RL_table['lat']
+    geo_x[:] = RL_table['x']
+    geo_y[:] = RL_table['y']
+    selevs[:] = numpy.round(RL_table['alt'], 3)                                 # Round to 3 decimal places
+    Lengthsnc[:] = numpy.round(RL_table['Length'], 1)                           # Round to 1 decimal place
 
     # Modify order and slope arrays
-    orders[:] = numpy.array([StrOrder[featID] for featID in order])
-    Sos_ = numpy.round(numpy.array([Slopes[featID] for featID in order]), 3)
-    Sos[:] = Sos_[:]
+    order_arr = numpy.asarray(RL_table['order'])
+    orders[:] = order_arr
+    Sos[:] = numpy.round(RL_table['So'], 3)
 
     # Set default arrays
     Qis[:] = Qi
@@ -2540,28 +3734,30 @@ def build_RouteLink(RoutingNC, order, From_To, NodeElev, NodesLL, NodesXY, Lengt
 
     # Apply order-based Mannings N values according to global dictionary "Mannings_Order"
     if ManningsOrd:
-        ns[:] = numpy.array([Mannings_Order[item] for item in orders[:]])
+        ns[:] = order_lookup(order_arr, Mannings_Order)
     else:
         ns[:] = n
 
     # Apply order-based Channel Side-slope values according to global dictionary "Mannings_Order"
     if ChSSlpOrd:
-        ChSlps[:] = numpy.array([Mannings_ChSSlp[item] for item in orders[:]])
+        ChSlps[:] = order_lookup(order_arr, Mannings_ChSSlp)
     else:
         ChSlps[:] = ChSlp
 
     # Apply order-based bottom-width values according to global dictionary "Mannings_Order"
     if BwOrd:
-        BtmWdths[:] = numpy.array([Mannings_Bw[item] for item in orders[:]])
+        BtmWdths[:] = order_lookup(order_arr, Mannings_Bw)
     else:
         BtmWdths[:] = BtmWdth
+    del order_arr
 
     # Added 10/10/2017 by KMS to include user-supplied gages in reach-based routing files
-    if gageDict is not None:
-        Gages[:,:] = numpy.asarray([tuple(str(gageDict[arcid]).rjust(15)) if arcid in gageDict else tuple('               ') for arcid in order])
+    if 'gages' in table_fields:
+        gage_strs = numpy.char.rjust(numpy.asarray(RL_table['gages'], dtype='S15'), 15)
     else:
-        Gages[:,:] = numpy.asarray([tuple('               ') for arcid in order])    # asarray converts from tuple to array
-    del gageDict
+        gage_strs = numpy.full(nlinks, b' '*15, dtype='S15')
+    Gages[:,:] = gage_strs.view('S1').reshape(nlinks, 15)                       # Fixed-width strings viewed as a character array
+    del gage_strs, RL_table
 
     # Close file
     rootgrp.close()
@@ -2580,6 +3776,85 @@ def find_line_midpoint(geom):
     del midPoint, shapelyLine
     return outGeom
 
+def stream_link_identifier(fdir_arr, strm_arr, strm_ndv=None, NoData=NoDataVal):
+    '''
+    Assign a unique 32-bit link ID (1...n) to every channel cell, replacing the
+    Whitebox stream_link_identifier tool. Whitebox writes an int16 raster, so
+    networks with more than 32,768 links receive negative IDs that are then lost
+    in raster_streams_to_vector.
+
+    A link begins at every channel head (no upstream channel cells) and at every
+    confluence (more than one upstream channel cell). Every other channel cell
+    has exactly one upstream channel cell and inherits that cell's link ID. The
+    inheritance is resolved with vectorized pointer-jumping, so the number of
+    passes grows with log2 of the longest link rather than the number of links.
+
+    Inputs:
+        fdir_arr - Esri-scheme D8 flow direction array.
+        strm_arr - Stream raster array. Channel cells are > 0 and != strm_ndv.
+    Output:
+        link_arr - int32 array of link IDs, NoData outside the channel network.
+    '''
+    tic1 = time.time()
+
+    # Channel cells are any positive, valid value in the stream raster
+    channel_mask = strm_arr > 0
+    if strm_ndv is not None:
+        channel_mask[strm_arr==strm_ndv] = False
+    chan_idx = numpy.flatnonzero(channel_mask)                                  # Flat index of every channel cell (row-major)
+    nchan = chan_idx.shape[0]
+    link_arr = numpy.full(strm_arr.shape, NoData, dtype=numpy.int32)
+    if nchan == 0:
+        print('        No channel cells found. No link IDs assigned.')
+        return link_arr
+
+    # Position of each grid cell in the compact channel-cell arrays (-1 = not a channel)
+    pos = numpy.full(strm_arr.size, -1, dtype=numpy.int64)
+    pos[chan_idx] = numpy.arange(nchan)
+
+    # Find the downstream channel cell for every channel cell (-1 = none)
+    down_j, down_i, valid_mask = move_downstream(fdir_arr, trim=True, mask=channel_mask)
+    down_pos = pos[numpy.ravel_multi_index((down_j, down_i), strm_arr.shape)]
+    down_pos[~valid_mask] = -1                                                  # Flows off the grid
+    down_pos[down_pos==numpy.arange(nchan)] = -1                                # No valid flow direction (points to itself)
+    del down_j, down_i, valid_mask, pos
+
+    # Links begin at heads and confluences: any cell without exactly one channel inflow
+    has_down = down_pos >= 0
+    src = numpy.flatnonzero(has_down)
+    tgt = down_pos[has_down]
+    heads = numpy.bincount(tgt, minlength=nchan) != 1
+
+    # Point every non-head cell at its single upstream channel cell
+    up_pos = numpy.arange(nchan)
+    single = ~heads[tgt]
+    up_pos[tgt[single]] = src[single]
+    del down_pos, has_down, src, tgt, single
+
+    # Pointer-jumping: after k passes each cell points 2**k cells upstream, stopping at its link head
+    max_iter = int(numpy.ceil(numpy.log2(nchan))) + 1
+    for iteration in range(max_iter):
+        next_pos = up_pos[up_pos]
+        if numpy.array_equal(next_pos, up_pos):
+            break
+        up_pos = next_pos
+    del next_pos
+
+    # Closed flow-direction loops have no head. Give each looping cell its own link.
+    looped = ~heads[up_pos]
+    if looped.any():
+        print('        Warning: {0} channel cells form closed flow loops. Each will be assigned its own link ID.'.format(looped.sum()))
+        heads[looped] = True
+        up_pos[looped] = numpy.flatnonzero(looped)
+
+    # Number the link heads 1...n and broadcast each head's ID along its link
+    head_ids = numpy.zeros(nchan, dtype=numpy.int32)
+    head_ids[heads] = numpy.arange(1, heads.sum()+1, dtype=numpy.int32)
+    link_arr.flat[chan_idx] = head_ids[up_pos]
+    print('        Assigned {0} link IDs to {1} channel cells in {2:3.2f} seconds.'.format(heads.sum(), nchan, time.time()-tic1))
+    del chan_idx, up_pos, heads, head_ids, looped
+    return link_arr
+
 def Routing_Table(projdir, rootgrp, grid_obj, fdir, strm, Elev, Strahler, gages=False, Lakes=None):
     """If "Create reach-based routing files?" is selected, this function will create
     the Route_Link.nc table and Streams.shp shapefiles in the output directory."""
@@ -2639,7 +3914,6 @@ def Routing_Table(projdir, rootgrp, grid_obj, fdir, strm, Elev, Strahler, gages=
     wbt.verbose = False
     wbt.work_dir = projdir
     esri_pntr = True
-    zero_background = False
     id_field = 'STRM_VAL'                                                       # Whitebox-assigned stream ID field
 
     # Setup temporary and other outputs
@@ -2647,27 +3921,24 @@ def Routing_Table(projdir, rootgrp, grid_obj, fdir, strm, Elev, Strahler, gages=
     streams_vector_file = os.path.join(projdir, streams_vector)
     RoutingNC = os.path.join(projdir, RT_nc)
 
-    # Run Whitebox functions for creating link IDs and vectors
+    # Build link IDs and vectors
 
     '''
-    The stream_link_identifier appears to output an int16 raster, limiting the number
-    of individual stream link IDs possible. Further, it will populate negative values
-    in the output, providing both positive and negative IDs. Unfortunately, any
-    IDs that are assigned negative values in the output will not be resolved as
-    stream vectors in the raster_streams_to_vector routine.
+    The Whitebox stream_link_identifier outputs an int16 raster, so networks with
+    more than 32,768 links were given negative IDs that were silently dropped by
+    raster_streams_to_vector. Link IDs are now assigned natively as int32 and
+    written to an Int32 raster before vectorizing.
     '''
-    wbt.stream_link_identifier(fdir, strm, stream_id, esri_pntr=esri_pntr, zero_background=zero_background)
+    fdir_arr, fdir_ndv = return_raster_array(fdir)
+    strm_arr, strm_ndv = return_raster_array(strm)
+    strm_link_arr = stream_link_identifier(fdir_arr, strm_arr, strm_ndv=strm_ndv)
+    del fdir_arr, fdir_ndv, strm_arr, strm_ndv
+    link_raster = grid_obj.numpy_to_Raster(strm_link_arr)
+    save_raster(stream_id_file, link_raster, grid_obj.nrows, grid_obj.ncols, gdal.GDT_Int32, NoData=NoDataVal)
+    link_raster = None
     wbt.raster_streams_to_vector(stream_id, fdir, streams_vector, esri_pntr=esri_pntr)
     print('        Stream to features step complete.')
 
-    # Read the link IDs as an array from the output file
-    strm_link_arr, ndv = return_raster_array(stream_id_file)
-    if numpy.unique(strm_link_arr).shape[0] > 32768 or strm_link_arr[strm_link_arr<0].shape[0] > 0:
-        print('        Warning: Number of unique IDs exceeds limit of 16-bit unsigned integer type. ' + \
-                'Not all reaches may be converted to stream vectors. Check output carefully.')
-    strm_link_arr[strm_link_arr==ndv] = NoDataVal                               # Set nodata values to WRF-Hydro nodata value
-    strm_link_arr[strm_link_arr<1] = NoDataVal                                  # Remove zeros from background of grid
-
     # Find any LINKID reach ID values that did not get transferred to the stream vector file.
     # These are typically single-cell channel cells on the edge of the grid.
     ds = ogr.Open(streams_vector_file)
@@ -2677,33 +3948,37 @@ def Routing_Table(projdir, rootgrp, grid_obj, fdir, strm, Elev, Strahler, gages=
     ds = lyr = None
 
     # Resolve issue where LINKID values are present that do not correspond to a vector ID (10/25/2020)
-    grid_reach_IDs = numpy.unique(strm_link_arr[strm_link_arr!=NoDataVal])
-    missing_reach_IDs = grid_reach_IDs[~numpy.in1d(grid_reach_IDs, vector_reach_IDs)]
+    # The LINKID, CHANNELGRID and STREAMORDER layers are handled as sparse (channel cells only) grids.
+    link_sp = SparseGrid.from_dense(strm_link_arr, NoDataVal)
+    del strm_link_arr
+    grid_reach_IDs = numpy.unique(link_sp.vals)
+    missing_reach_IDs = grid_reach_IDs[~numpy.isin(grid_reach_IDs, vector_reach_IDs)]
     print('        Eliminating {0} IDs in LINKID grid that could not be resolved in stream vector layer.'.format(missing_reach_IDs.shape[0]))
     print('          {0}'.format(missing_reach_IDs.tolist()))
-    channel_arr = rootgrp.variables['CHANNELGRID'][:]
-    strorder_arr = rootgrp.variables['STREAMORDER'][:]
-    for idVal in missing_reach_IDs:
-        arr_mask = strm_link_arr==idVal         # Build a boolean mask for masking all array elements to be changed
-        strm_link_arr[arr_mask] = NoDataVal     # Set all linkid values that didn't get resolved in the routelink file to nodata.
-        channel_arr[arr_mask] = NoDataVal       # Set all channel values that didn't get resolved in the routelink file to nodata.
-        strorder_arr[arr_mask] = NoDataVal      # Set all channel values that didn't get resolved in the routelink file to nodata.
-        del arr_mask
-    rootgrp.variables['LINKID'][:] = strm_link_arr
-    rootgrp.variables['CHANNELGRID'][:] = channel_arr
-    rootgrp.variables['STREAMORDER'][:] = strorder_arr
-    del channel_arr, strorder_arr, grid_reach_IDs, missing_reach_IDs
+    channel_sp = read_sparse(rootgrp, 'CHANNELGRID')
+    strorder_sp = read_sparse(rootgrp, 'STREAMORDER')
+    if missing_reach_IDs.shape[0] > 0:
+        missing_cells = link_sp.idx[numpy.isin(link_sp.vals, missing_reach_IDs)]   # Search only the channel cells for unresolved IDs
+        link_sp.drop(missing_cells)                                             # Set all linkid values that didn't get resolved in the routelink file to nodata.
+        channel_sp.drop(missing_cells)                                          # Set all channel values that didn't get resolved in the routelink file to nodata.
+        strorder_sp.drop(missing_cells)                                         # Set all channel values that didn't get resolved in the routelink file to nodata.
+        del missing_cells
+    write_sparse(rootgrp, 'LINKID', link_sp)
+    write_sparse(rootgrp, 'CHANNELGRID', channel_sp)
+    write_sparse(rootgrp, 'STREAMORDER', strorder_sp)
+    del channel_sp, strorder_sp, grid_reach_IDs, missing_reach_IDs
 
     gage_linkID = {}
     if gages:
         print('        Adding forecast points:LINKID association.')
-        gage_arr = rootgrp.variables['frxst_pts'][:]
-        unique_gages = numpy.unique(gage_arr[gage_arr!=NoDataVal])
-        gage_linkID = {gage:strm_link_arr[gage_arr==gage][0] for gage in unique_gages}    # Create blank dictionary so that it exists and can be deleted later
+        gage_sp = read_sparse(rootgrp, 'frxst_pts')                             # Forecast point cells only
+        gage_links = link_sp.lookup(gage_sp.idx)
+        first = numpy.unique(gage_sp.vals, return_index=True)[1]                # First cell (in row-major order) of each forecast point
+        gage_linkID = dict(zip(gage_sp.vals[first].tolist(), gage_links[first].tolist()))
         print('        Found {0} forecast point:LINKID associations.'.format(len(gage_linkID)))
-        del unique_gages, gage_arr
+        del gage_sp, gage_links, first
     linkID_gage = {val:key for key, val in gage_linkID.items()}                 # Reverse the dictionary
-    del strm_link_arr, ndv, gage_linkID
+    del link_sp, gage_linkID
 
     # Setup coordinate transform for calculating lat/lon from x/y
     wgs84_proj = osr.SpatialReference()
@@ -2715,156 +3990,134 @@ def Routing_Table(projdir, rootgrp, grid_obj, fdir, strm, Elev, Strahler, gages=
         wgs84_proj.SetAxisMappingStrategy(osgeo.osr.OAMS_TRADITIONAL_GIS_ORDER)
     coordTrans = osr.CoordinateTransformation(grid_obj.proj, wgs84_proj)        # Transformation from grid projection to WGS84
 
-    # Initiate dictionaries for storing topology and attribute information
-    Lengths = {}                        # Gather the stream feature length
-    StrOrder = {}                       # Store stream order for each node
-    NodeElev = {}                       # Elevation of the start node
-    slope_dic = {}                      # Slope (unitless drop/length)
-    NodeLL = {}                         # Dictionary to store geocentric (longitude, latitude) coordinates for every start node
-    NodeXY = {}                         # Dictionary to store projectedc (x, y) coordinates for every start node
-
-    # Open shapefile
+    # Open shapefile. Geometry and the original Whitebox attributes are read in
+    # this single pass so that the output layer can be written once at the end.
     driver = ogr.GetDriverByName("ESRI Shapefile")
-    data_source = driver.Open(streams_vector_file, 1)
+    data_source = driver.Open(streams_vector_file, 0)
     lyr = data_source.GetLayer()
-    topology_dic = {}
-    coords_dic = {}
-    for feature in lyr:
-        # Open each feature and get geometry
-        flowline_id = int(feature.GetField(id_field))
-        geom = feature.GetGeometryRef()
-        flowline_length = geom.Length()
-
-        # Get coordinates of first and last point, flow line ID, and flow line length
-        first_point = geom.GetPoint(0)
-        #mid_point = geom.Centroid()
-        mid_point = find_line_midpoint(geom)
-        last_point = geom.GetPoint(geom.GetPointCount() - 1)
-        first_point_coords = (first_point[0], first_point[1])
-        mid_point_coords = (mid_point.GetX(), mid_point.GetY())
-        last_point_coords = (last_point[0], last_point[1])
-
-        # Create topology dictionary of 'bottom_point geometry: stream flowline ID'
-        try:
-            topology_dic[last_point_coords] += [flowline_id]
-        except KeyError:
-            topology_dic[last_point_coords] = [flowline_id]
-
-        # Create coordinate dictionary of flowline ID: first point, last point, length
-        coords_dic[flowline_id] = first_point_coords, last_point_coords, flowline_length, mid_point_coords
-        feature = geom = first_point = last_point = None
-    lyr.ResetReading()
-
-    # Create to/from dictionary matching bottom point to top point, creating dic of 'from ID: to ID'
-    to_from_dic = {}
-    for flowline_id, (first_point_coords, last_point_coords, flowline_length, mid_point_coords) in coords_dic.items():
-        if first_point_coords in topology_dic:
-            #for feature_id in topology_dic[first_point_coords]:
-            for feature_id in topology_dic.pop(first_point_coords):
-                to_from_dic[feature_id] = flowline_id
-
-    # Add in flowlines with nothing downstream
-    for feature_id in coords_dic:
-        if feature_id not in to_from_dic:
-            to_from_dic[feature_id] = 0
-    del topology_dic
+    geom_type = lyr.GetGeomType()
+    in_fields = layer_fields(lyr)
+    geoms, in_vals = read_layer_columnar(lyr)
+    data_source = lyr = None
+    link_arr = in_vals[id_field].astype(numpy.int64)                           # Link ID of each feature, in layer order
+    nfeats = link_arr.shape[0]
+
+    # Get coordinates of first, middle and last point, and the length of every flow line
+    Lengths = shapely.length(geoms)                                             # Gather the stream feature length
+    NodeXY = shapely.get_coordinates(shapely.get_point(geoms, 0))               # Projected (x, y) coordinates of every start node
+    last_xy = shapely.get_coordinates(shapely.get_point(geoms, -1))
+    mid_xy = shapely.get_coordinates(shapely.line_interpolate_point(geoms, Lengths/2))
+
+    # Create to/from topology by matching the bottom point of each flow line to the top point of
+    # another. Each point is numbered once, and the first flow line (in layer order) that starts at
+    # a point is downstream of every flow line that ends there (0 = nothing downstream).
+    node_idx = numpy.unique(numpy.concatenate([NodeXY, last_xy]), axis=0, return_inverse=True)[1].ravel()
+    start_link = numpy.zeros(node_idx.max(initial=-1)+1, dtype=numpy.int64)
+    start_link[node_idx[:nfeats][::-1]] = link_arr[::-1]
+    to_arr = start_link[node_idx[nfeats:]]
+    start_pos = numpy.zeros(start_link.shape, dtype=numpy.int64)
+    start_pos[node_idx[:nfeats][::-1]] = numpy.arange(nfeats)[::-1]
+    has_down = to_arr != 0
+
+    # Topology dictionary of 'from ID: to ID', with the flow lines grouped by the flow line they flow
+    # into (in layer order), followed by the flow lines with nothing downstream
+    from_idx = numpy.flatnonzero(has_down)
+    from_idx = from_idx[numpy.argsort(start_pos[node_idx[nfeats:]][from_idx], kind='stable')]
+    from_idx = numpy.concatenate([from_idx, numpy.flatnonzero(~has_down)])
+    to_from_dic = dict(zip(link_arr[from_idx].tolist(), to_arr[from_idx].tolist()))
+    del node_idx, start_link, start_pos, has_down, from_idx
 
     # Get the order of segments according to a simple topological sort
     order = sort_topologically_stackless({key:[val] for key,val in to_from_dic.items()})
+    del to_from_dic
 
-    # Open elevation raster
-    dem_array = gdal.Open(Elev, 0)
-    dem_rb = dem_array.GetRasterBand(1)
-
-    # Open strahler stream order raster
-    strahler_array = gdal.Open(Strahler, 0)
-    strahler_rb = strahler_array.GetRasterBand(1)
-
-    # Iterate over coordinate dictionary​
+    # Get top/first and bottom/last coordinate values from the DEM and Strahler stream order rasters
     tic2 = time.time()
-    for idval, (top_xy, bot_xy, length, mid_xy) in coords_dic.items():
-
-        # Get top/first coordinates values from DEM
-        row, col = grid_obj.xy_to_grid_ij(top_xy[0], top_xy[1])
-        top_elevation = float(dem_rb.ReadAsArray(col, row, 1, 1))
-        strahler_value = int(strahler_rb.ReadAsArray(col, row, 1, 1))
-
-        # Get bottom/last coordinates values from DEM
-        row, col = grid_obj.xy_to_grid_ij(bot_xy[0], bot_xy[1])
-        bottom_elevation = dem_rb.ReadAsArray(col, row, 1, 1)
-
-        # Fix negative slopes
-        drop = top_elevation - bottom_elevation
-        slope = drop/length
-        if slope < minSo:
-            slope = minSo
-
-        # Populate all dictionaries
-        slope_dic[idval] = float(slope)
-        StrOrder[idval] = strahler_value
-        NodeElev[idval] = top_elevation
-        Lengths[idval] = length
-        NodeXY[idval] = (top_xy[0], top_xy[1])
-
-        point = ogr.Geometry(ogr.wkbPoint)
-        #point.AddPoint(top_xy[0], top_xy[1])        # Top of line
-        point.AddPoint(mid_xy[0], mid_xy[1])        # Midpoint of line
-        point.Transform(coordTrans)                                      # Transform the geometry
-        NodeLL[idval] = (point.GetX(), point.GetY())
-        point = None
-    del coords_dic
-    print('  All dictionaries have been created in {0: 3.2f} seconds.'.format(time.time()-tic2))
-
-    # Create new field in shapefile
-    field_defn = ogr.FieldDefn("link", ogr.OFTInteger64)
-    lyr.CreateField(field_defn)
-
-    field_defn = ogr.FieldDefn("to", ogr.OFTInteger64)
-    lyr.CreateField(field_defn)
-
-    field_defn = ogr.FieldDefn("Order_", ogr.OFTInteger)
-    lyr.CreateField(field_defn)
-
-    field_defn = ogr.FieldDefn("GageID", ogr.OFTString)
-    field_defn.SetWidth(15)
-    lyr.CreateField(field_defn)
-
-    field_defn = ogr.FieldDefn("LakeID", ogr.OFTInteger64)
-    lyr.CreateField(field_defn)
-
-    field_defn = ogr.FieldDefn("length", ogr.OFTReal)
-    lyr.CreateField(field_defn)
-
-    field_defn = ogr.FieldDefn("Slope", ogr.OFTReal)
-    lyr.CreateField(field_defn)
-
-    field_defn = ogr.FieldDefn("TopElev", ogr.OFTReal)
-    lyr.CreateField(field_defn)
-
-    # Iterate over shapefile to add new values to the newly created field
-    for feature in lyr:
-        link_id = int(feature.GetField(id_field))
-        feature.SetField("link", link_id)
-        feature.SetField("to", to_from_dic.get(link_id, 0))
-        feature.SetField("Order_", StrOrder[link_id])
-        feature.SetField("GageID", str(linkID_gage.get(link_id, None)))
-        feature.SetField("LakeID", NoDataVal)
-        feature.SetField("length", Lengths[link_id])
-        feature.SetField("Slope", slope_dic[link_id])
-        feature.SetField("TopElev", NodeElev[link_id])
-        lyr.SetFeature(feature)
-    data_source = feature = lyr = None
+    top_rows = ((NodeXY[:,1] - grid_obj.y00) / grid_obj.DY).astype(numpy.int64)    # Grid indices as in xy_to_grid_ij
+    top_cols = ((NodeXY[:,0] - grid_obj.x00) / grid_obj.DX).astype(numpy.int64)
+    bot_rows = ((last_xy[:,1] - grid_obj.y00) / grid_obj.DY).astype(numpy.int64)
+    bot_cols = ((last_xy[:,0] - grid_obj.x00) / grid_obj.DX).astype(numpy.int64)
+    dem_arr = return_raster_array(Elev)[0].astype(numpy.float64)
+    NodeElev = dem_arr[top_rows, top_cols]                                      # Elevation of the start node
+    drop = NodeElev - dem_arr[bot_rows, bot_cols]
+    StrOrder = return_raster_array(Strahler)[0][top_rows, top_cols].astype(numpy.int32)   # Stream order of each start node
+    del dem_arr, top_rows, top_cols, bot_rows, bot_cols, last_xy
+
+    # Fix negative slopes
+    slope_arr = drop / Lengths                                                  # Slope (unitless drop/length)
+    slope_arr[slope_arr < minSo] = minSo
+    del drop
+
+    # Geocentric (longitude, latitude) coordinates of the midpoint of every line
+    lon_arr, lat_arr = transform_points(coordTrans, mid_xy[:,0], mid_xy[:,1])
+    del mid_xy
+    print('  All link attributes have been calculated in {0: 3.2f} seconds.'.format(time.time()-tic2))
+
+    # Lookup tables from link ID to the position of its (first) feature and to its forecast point
+    link_pos = numpy.zeros(link_arr.max(initial=0)+1, dtype=numpy.int64)
+    link_pos[link_arr[::-1]] = numpy.arange(nfeats)[::-1]
+    gage_links = numpy.fromiter(linkID_gage.keys(), dtype=numpy.int64, count=len(linkID_gage))
+    on_link = (gage_links >= 0) & (gage_links < link_pos.shape[0])
+    link_gage = numpy.full(link_pos.shape, None, dtype=object)
+    link_gage[gage_links[on_link]] = numpy.array(list(linkID_gage.values()), dtype=object)[on_link]
+    has_gage = numpy.zeros(link_pos.shape, dtype=bool)
+    has_gage[gage_links[on_link]] = True
+    del gage_links, on_link
+
+    # Build each output attribute as a column, in the same order as the features
+    out_fields = [("link", ogr.OFTInteger64, None),
+                    ("to", ogr.OFTInteger64, None),
+                    ("Order_", ogr.OFTInteger, None),
+                    ("GageID", ogr.OFTString, 15),
+                    ("LakeID", ogr.OFTInteger64, None),
+                    ("length", ogr.OFTReal, None),
+                    ("Slope", ogr.OFTReal, None),
+                    ("TopElev", ogr.OFTReal, None)]
+    out_cols = dict(in_vals)
+    out_cols["link"] = link_arr
+    out_cols["to"] = to_arr
+    out_cols["Order_"] = StrOrder
+    out_cols["GageID"] = link_gage[link_arr].astype(str).astype(object)        # 'None' where there is no forecast point
+    out_cols["LakeID"] = numpy.full(link_arr.shape, NoDataVal, dtype=numpy.int64)
+    out_cols["length"] = Lengths
+    out_cols["Slope"] = slope_arr
+    out_cols["TopElev"] = NodeElev
+    del in_vals
+
+    # Replace the Whitebox output with a single write that also defines the
+    # projection, which is not done automatically by Whitebox.
+    if useGeoPackage:
+        driver.DeleteDataSource(streams_vector_file)                            # Whitebox shapefile is not needed once written to the GeoPackage
+    data_source, layer_name, layer_options = create_vector_output(projdir, streams_vector)
+    write_layer_columnar(data_source, layer_name, grid_obj.proj, geom_type, shapely.to_wkb(geoms),
+                            in_fields + out_fields, out_cols, layer_options=layer_options)
+    data_source = None
+    del geoms, out_cols, in_fields, out_fields
     print('  Fields have been added to the shapefile.')
 
-    # We need to define the projection for the streams file: this is not done automatically by Whitebox.
-    define_projection(streams_vector_file, grid_obj.proj)
-
     # Added 8/16/2020 because a value of 0 exists in the order list
     order.remove(0)
 
-    # Call function to build the netCDF parameter table
-    build_RouteLink(RoutingNC, order, to_from_dic, NodeElev, NodeLL, NodeXY, Lengths, StrOrder, slope_dic, gageDict=linkID_gage)
-    del linkID_gage, order, to_from_dic, NodeElev, Lengths, StrOrder, NodeLL, NodeXY, slope_dic
+    # Build the columnar RouteLink table in topological order and write the netCDF parameter table
+    order = numpy.array(order, dtype=numpy.int64)
+    pos = link_pos[order]
+    RL_table = numpy.empty(order.shape[0], dtype=RouteLink_dtype)
+    RL_table['link'] = order
+    RL_table['to'] = to_arr[pos]
+    RL_table['lon'] = lon_arr[pos]
+    RL_table['lat'] = lat_arr[pos]
+    RL_table['x'] = NodeXY[pos,0]
+    RL_table['y'] = NodeXY[pos,1]
+    RL_table['alt'] = NodeElev[pos]
+    RL_table['Length'] = Lengths[pos]
+    RL_table['order'] = StrOrder[pos]
+    RL_table['So'] = slope_arr[pos]
+    RL_table['gages'] = b''
+    gage_idx = numpy.flatnonzero(has_gage[order])
+    RL_table['gages'][gage_idx] = link_gage[order[gage_idx]].astype(str)
+    build_RouteLink(RoutingNC, RL_table)
+    del RL_table, gage_idx, pos, link_pos, link_gage, has_gage
+    del link_arr, linkID_gage, order, to_arr, NodeElev, Lengths, StrOrder, lon_arr, lat_arr, NodeXY, slope_arr
     print('Reach-based routing inputs generated in {0:3.2f} seconds.'.format(time.time()-tic1))
     return rootgrp
 
@@ -3006,16 +4259,8 @@ def add_reservoirs(rootgrp, projdir, fac, in_lakes, grid_obj, lakeIDfield=None,
     print('      Adding reservoirs to routing stack.')
     print('      Gridded: {0}'.format(Gridded))
 
-    # Setup Whitebox tools
-    wbt = WhiteboxTools()
-    wbt.verbose = False
-    wbt.work_dir = projdir
-
     # Outputs
     LakeNC = os.path.join(projdir, LK_nc)
-    outshp = os.path.join(projdir, LakesSHP)                                    # Clipped and projected input lakes shapefile
-    frxst_FC = os.path.join(projdir, 'Lake_outlets.shp')
-    snapPour = 'Lake_snapped_pour_points.shp'                                   # Pour points snapped downstream of lake outlets
 
     # Setup coordinate transform for calculating lat/lon from x/y
     wgs84_proj = osr.SpatialReference()
@@ -3031,137 +4276,129 @@ def add_reservoirs(rootgrp, projdir, fac, in_lakes, grid_obj, lakeIDfield=None,
     # Use extent of the template raster to add a feature layer of lake polygons
     geom = grid_obj.boundarySHP('', 'MEMORY')                                   # Get domain extent for cliping geometry
     lake_ds, lake_layer, fieldNames = project_Features(in_lakes, grid_obj.proj, clipGeom=geom)
-    geom = lake_layer = None
+    geom = None
 
-    # Save to disk in order to use in the FeatToRaster function.
-    lake_ds  = ogr.GetDriverByName(VectorDriver).CopyDataSource(lake_ds, outshp)
-    lake_layer = lake_ds.GetLayer()
+    # Read the clipped and reprojected lake polygons into columnar form
+    geoms, columns = read_layer_columnar(lake_layer)
+    fields = layer_fields(lake_layer)
+    geomType = lake_layer.GetGeomType()
+    lake_ds = lake_layer = None
 
     # Add and re-calculate area information for new, clipped and reprojected lake polygons
-    lake_layer.CreateField(ogr.FieldDefn('AREASQKM', ogr.OFTReal))              # Add a single field to the new layer
-    for feature in lake_layer:
-        geometry = feature.GetGeometryRef()                                     # Get the geometry object from this feature
-        feature.SetField('AREASQKM', float(geometry.Area()/1000000.0))          # Add an area field to re-calculate area
-        lake_layer.SetFeature(feature)
-        feature = geometry = None
-    lake_layer.ResetReading()
+    if 'AREASQKM' not in columns:
+        fields.append(('AREASQKM', ogr.OFTReal, None))                          # Add a single field to the new layer
+    columns['AREASQKM'] = shapely.area(geoms)/1000000.0                         # Add an area field to re-calculate area
 
     # Assign a new ID field for lakes, numbered 1...n. Add field to store this information if necessary
     if lakeIDfield is None:
         print('    Adding auto-incremented lake ID field (1...n)')
         lakeID = "newID"
-        if lakeID not in fieldNames:
-            lake_layer.CreateField(ogr.FieldDefn(lakeID, ogr.OFTInteger))
-        for num,feature in enumerate(lake_layer):
-            feature.SetField(lakeID, num+1)      # Add an area field to re-calculate area
-            lake_layer.SetFeature(feature)
-        lake_layer.ResetReading()
-        feature = None
+        if lakeID not in columns:
+            fields.append((lakeID, ogr.OFTInteger, None))
+        columns[lakeID] = numpy.arange(1, len(geoms)+1, dtype=numpy.int32)
     else:
         print('    Using provided lake ID field: {0}'.format(lakeIDfield))
         lakeID = lakeIDfield                                                    # Use existing field specified by 'lakeIDfield' parameter
 
+    # Build an in-memory layer to rasterize. The lakes are written to disk only
+    # once it is known which lakes are on the channel network.
+    wkbs = shapely.to_wkb(geoms)
+    mem_ds = ogr.GetDriverByName('MEMORY').CreateDataSource('')
+    mem_layer = write_layer_columnar(mem_ds, 'lakes', grid_obj.proj, geomType, wkbs, fields, columns)
+
     # Generate dictionary of areas, and centroid lat/lon for populatingLAKEPARM.nc
     print('    Starting to gather lake centroid and area information.')
-    cen_lats = {}
-    cen_lons = {}
-    areas = {}
-    for feature in lake_layer:
-        idval = feature.GetField(lakeID)
-        areas[idval] = feature.GetField('AREASQKM')
-        centroid = feature.GetGeometryRef().Centroid()
-        centroid.Transform(coordTrans)                                      # Transform the geometry
-        cen_lats[idval] = centroid.GetY()
-        cen_lons[idval] = centroid.GetX()
-        feature = centroid = None
-    lake_layer.ResetReading()
+    centroids = shapely.centroid(geoms)
+    cen_x, cen_y = transform_points(coordTrans, shapely.get_x(centroids), shapely.get_y(centroids))
+    lake_ids = columns[lakeID].tolist()
+    areas = dict(zip(lake_ids, columns['AREASQKM'].tolist()))
+    cen_lats = dict(zip(lake_ids, cen_y.tolist()))
+    cen_lons = dict(zip(lake_ids, cen_x.tolist()))
+    del geoms, centroids, cen_x, cen_y, lake_ids
     print('    Done gathering lake centroid information.')
     lakeIDList = list(areas.keys())
 
     # Convert lake geometries to raster geometries on the model grid
-    LakeRaster = FeatToRaster(outshp, fac, lakeID, gdal.GDT_Int32, NoData=NoDataVal)
+    LakeRaster = FeatToRaster(mem_layer, grid_obj, lakeID, gdal.GDT_Int32, NoData=NoDataVal)
     Lake_arr = BandReadAsArray(LakeRaster.GetRasterBand(1))                     # Read raster object into numpy array
-    LakeRaster = None
+    LakeRaster = mem_layer = mem_ds = None
     Lake_arr[Lake_arr==0] = NoDataVal                                           # Convert 0 to WRF-Hydro NoData
 
+    # The lake and channel grids are handled as sparse grids (lake and channel cells only) from here
+    lake_sp = SparseGrid.from_dense(Lake_arr, NoDataVal)
+    del Lake_arr
+    lake_uniques = numpy.unique(lake_sp.vals)
+    lake_pos = numpy.searchsorted(lake_uniques, lake_sp.vals)                   # Index of each lake cell's lake in lake_uniques
+
     # Code-block to eliminate lakes that do not coincide with active channel cells
-    strm_arr = rootgrp.variables['CHANNELGRID'][:]                              # Read channel grid array from Fulldom
-    lake_uniques = numpy.unique(Lake_arr[Lake_arr!=NoDataVal])
+    strm_sp = read_sparse(rootgrp, 'CHANNELGRID')                               # Read channel grid cells from Fulldom
     if subsetLakes:
-        Lk_chan = {lake:strm_arr[numpy.logical_and(Lake_arr==lake, strm_arr==0)].shape[0]>0 for lake in lake_uniques}   # So slow...
+        # Count active channel cells in each lake with a single pass over the lake cells
+        on_chan = strm_sp.lookup(lake_sp.idx) == 0
+        Lk_chan = numpy.bincount(lake_pos[on_chan], minlength=lake_uniques.shape[0]) > 0
         old_Lk_count = lake_uniques.shape[0]
-        lake_uniques = numpy.array([lake for lake,val in Lk_chan.items() if val])   # New set of lakes to use
+        lake_sp.keep(Lk_chan[lake_pos])                                         # Remove lakes from Lake Array that are not on channels
+        lake_uniques = lake_uniques[Lk_chan]                                    # New set of lakes to use
+        lake_pos = numpy.searchsorted(lake_uniques, lake_sp.vals)
+        del on_chan
         new_Lk_count = lake_uniques.shape[0]
-        Lake_arr[~numpy.isin(Lake_arr, lake_uniques)] = NoDataVal               # Remove lakes from Lake Array that are not on channels
         print('    Found {0} lakes on active channels. Lost {1} lakes that were not on active channels.'.format(new_Lk_count, old_Lk_count-new_Lk_count))
         del Lk_chan, old_Lk_count, new_Lk_count
 
-        # Reset the 1...n index and eliminate lakes from shapefile that were eliminated here
-        #num = 1                                                                 # Initialize the lake ID counter
+        # Eliminate lakes from the output vector that were eliminated here
         print('    Removing lakes not on gridded channel network')
-        for feature in lake_layer:
-            idval = feature.GetField(lakeID)
-            if idval not in lake_uniques.tolist():
-                #print('      Removing lake: {0}'.format(idval))
-                lake_layer.DeleteFeature(feature.GetFID())
-            else:
-                #feature.SetField(lakeID, num)      # Add an area field to re-calculate area
-                #lake_layer.SetFeature(feature)
-                #num += 1
-                pass
-        lake_layer.ResetReading()
-    lake_ds = lake_layer = None
+        keep = numpy.isin(columns[lakeID], lake_uniques)
+        wkbs = wkbs[keep]
+        columns = {fname:values[keep] for fname, values in columns.items()}
+        print('    Removed {0} lakes from output lakes.'.format((~keep).sum()))
+        del keep
+
+    # Save the lakes to disk, in a single pass
+    lake_ds, lake_lyr_name, layer_options = create_vector_output(projdir, LakesSHP)
+    write_layer_columnar(lake_ds, lake_lyr_name, grid_obj.proj, geomType, wkbs, fields, columns, layer_options=layer_options)
+    lake_ds = None
+    del wkbs, columns, fields
 
     # Save the gridded lake array to the Fulldom file
     if Gridded:
-        rootgrp.variables['LAKEGRID'][:] = Lake_arr                             # Write array to output netCDF file
+        write_sparse(rootgrp, 'LAKEGRID', lake_sp)                              # Write array to output netCDF file
     else:
         rootgrp.variables['LAKEGRID'][:] = NoDataVal                            # No need to populate LAKEGRID if not using gridded lakes
     print('    Process: LAKEGRID written to output netCDF.')
 
     # Find the maximum flow accumulation value for each lake
-    flac_arr = rootgrp.variables['FLOWACC'][:]                                  # Read flow accumulation array from Fulldom
-    flac_max = {lake:flac_arr[Lake_arr==lake].max() for lake in lake_uniques}
-
-    # Iterate over lakes, assigning the outlet pixel to the lake ID in channelgrid
-    strm_arr[Lake_arr>0] = NoDataVal                                            # Set all lake areas to WRF-Hydro NoData value under these lakes
-    for lake,maxfac in flac_max.items():
-        strm_arr[numpy.logical_and(Lake_arr==lake, flac_arr==maxfac)] = lake    # Set the lake outlet to the lake ID in Channelgrid
-    del flac_arr
+    flac_arr = numpy.asarray(rootgrp.variables['FLOWACC'][:])                   # Read flow accumulation array from Fulldom
+    flac_max = label_max(flac_arr, lake_sp.idx, lake_pos, lake_uniques.shape[0])
+
+    # Assign the outlet pixel(s) of every lake to the lake ID in channelgrid
+    strm_sp.drop(lake_sp.idx[lake_sp.vals>0])                                   # Set all lake areas to WRF-Hydro NoData value under these lakes
+    is_outlet = flac_arr.ravel()[lake_sp.idx] == flac_max[lake_pos]             # Cells at the maximum flow accumulation of their lake
+    strm_sp.update(lake_sp.idx[is_outlet], lake_sp.vals[is_outlet])             # Set the lake outlet to the lake ID in Channelgrid
+    del flac_arr, flac_max, is_outlet
     if Gridded:
-        rootgrp.variables['CHANNELGRID'][:] = strm_arr
+        write_sparse(rootgrp, 'CHANNELGRID', strm_sp)
     print('    Process: CHANNELGRID written to output netCDF.')
 
-    # Now march down a set number of pixels to get minimum lake elevation
-    strm_arr[strm_arr<1] = NoDataVal                                            # Remove channels (active and inactive)
-    ds = array_to_points(strm_arr, ogr.OFTInteger, grid_obj.GeoTransform(), grid_obj.proj)
-    out_ds = ogr.GetDriverByName(VectorDriver).CopyDataSource(ds, frxst_FC)    # Copy to file on disk
-    ds = out_ds = None
-    del strm_arr, ds, out_ds
-
-    tolerance = grid_obj.DX * LK_walker                                         # Snap distance is the horizontal cellsize multiplied by number of pixels to 'walk' downstream
-    snapPourFile = os.path.join(projdir, snapPour)
-    wbt.snap_pour_points(frxst_FC, fac, snapPour, tolerance)                    # Snap pour points to flow accumulation grid within a tolerance
+    # Now march down a set number of pixels from every lake outlet to get minimum lake elevation
+    is_outlet = strm_sp.vals >= 1                                               # Remove channels (active and inactive)
+    outlet_rows, outlet_cols = numpy.divmod(strm_sp.idx[is_outlet], strm_sp.shape[1])   # Lake outlet cells, in row-major order
+    outlet_IDs = strm_sp.vals[is_outlet]
+    fdir_arr = rootgrp.variables['FLOWDIRECTION'][:]                            # Read flow direction array from Fulldom
+    walk_rows, walk_cols = walk_downstream(fdir_arr, outlet_rows, outlet_cols, LK_walker)
+    del strm_sp, fdir_arr, outlet_rows, outlet_cols, is_outlet
 
     # Gathering maximum elevation from input DEM
     fill_arr = rootgrp.variables['TOPOGRAPHY'][:]                               # Read elevation array from Fulldom
-    max_elevs = {lake:fill_arr[Lake_arr==lake].max() for lake in lake_uniques}
-    del Lake_arr, lake_uniques
+    max_elevs = label_max(fill_arr, lake_sp.idx, lake_pos, lake_uniques.shape[0])
+    max_elevs = dict(zip(lake_uniques.tolist(), max_elevs.tolist()))
+    del lake_sp, lake_uniques, lake_pos
 
-    # Read the shapefile from previous Snap Pour Points and extract the values directly from the grid
-    snap_ds = ogr.Open(snapPourFile, 0)
-    pointlyr = snap_ds.GetLayer()                                               # Get the 'layer' object from the data source
-    min_elevs = {}
-    for feature in pointlyr:
-        idval = feature.GetField('VALUE')
-        point = feature.GetGeometryRef()
-        row, col = grid_obj.xy_to_grid_ij(point.GetX(), point.GetY())
-        min_elevs[idval] = fill_arr[row, col]
-        feature = point = None
-        del idval, row, col
-    snap_ds = pointlyr = None
-    ogr.GetDriverByName(VectorDriver).DeleteDataSource(snapPourFile)
-    ogr.GetDriverByName(VectorDriver).DeleteDataSource(frxst_FC)
+    # Sample the elevation grid at the cell reached downstream of each outlet. If a
+    # lake has more than one outlet cell, the last outlet in row-major order is used.
+    walk_elevs = numpy.asarray(fill_arr[walk_rows, walk_cols])
+    order = numpy.argsort(outlet_IDs, kind='stable')
+    min_elevs = dict(zip(outlet_IDs[order].tolist(), walk_elevs[order].tolist()))
+    del walk_rows, walk_cols, walk_elevs, outlet_IDs, order
 
     # Only add in 'missing' lakes if this is a reach-routing simulation and lakes
     # don't need to be resolved on the grid.
@@ -3222,6 +4459,280 @@ def add_reservoirs(rootgrp, projdir, fac, in_lakes, grid_obj, lakeIDfield=None,
     print('    Lake parameter table created without error in {0: 3.2f} seconds.'.format(time.time()-tic1))
     return rootgrp, lakeID
 
+def update_LAKEPARM(LakeNC, add_LakeNC=None, keep_ids=None):
+    '''
+    Update an existing LAKEPARM parameter file in place, appending the lakes in
+    another LAKEPARM file (add_LakeNC) and/or keeping only the lakes in keep_ids.
+    Unlike rebuilding the file with build_LAKEPARM, every variable and attribute
+    is copied from the existing file, so any lake parameters that were edited
+    after the file was created are preserved. The ascendingIndex variable is
+    recalculated for the new set of lakes.
+    '''
+    tic1 = time.time()
+    dim1 = 'feature_id'
+    tmp_LakeNC = LakeNC + '.tmp'
+
+    rootgrp = netCDF4.Dataset(LakeNC, 'r')
+    rootgrp.set_auto_mask(False)
+    if add_LakeNC is not None:
+        rootgrp_add = netCDF4.Dataset(add_LakeNC, 'r')
+        rootgrp_add.set_auto_mask(False)
+        add_vars = rootgrp_add.variables
+        n_add = len(rootgrp_add.dimensions[dim1])
+    else:
+        add_vars = {}
+        n_add = 0
+
+    # Find the lakes to keep from the existing file and the file to append
+    ids = rootgrp.variables['lake_id'][:]
+    keep = numpy.ones(ids.shape, dtype=bool)
+    keep_add = numpy.ones(n_add, dtype=bool)
+    if keep_ids is not None:
+        keep_ids = numpy.asarray(list(keep_ids), dtype=ids.dtype)
+        keep = numpy.isin(ids, keep_ids)
+        if n_add > 0:
+            keep_add = numpy.isin(add_vars['lake_id'][:], keep_ids)
+    nlakes = int(keep.sum() + keep_add.sum())
+    print('        Lakes Table: {0} existing lakes, {1} added lakes, {2} lakes in output.'.format(ids.shape[0], n_add, nlakes))
+
+    # Copy dimensions, variables and attributes to the new file
+    rootgrp_out = netCDF4.Dataset(tmp_LakeNC, 'w', format=rootgrp.data_model)
+    rootgrp_out.setncatts(rootgrp.__dict__)
+    for name, dim in rootgrp.dimensions.items():
+        rootgrp_out.createDimension(name, nlakes if name == dim1 else (None if dim.isunlimited() else len(dim)))
+    for name, ncVar in rootgrp.variables.items():
+        attrs = ncVar.__dict__
+        outVar = rootgrp_out.createVariable(name, ncVar.dtype, ncVar.dimensions, fill_value=attrs.get('_FillValue'))
+        outVar.setncatts({key:val for key,val in attrs.items() if key != '_FillValue'})
+        if dim1 in ncVar.dimensions:
+            values = [ncVar[:][keep]]
+            if n_add > 0:
+                if name in add_vars:
+                    values.append(add_vars[name][:][keep_add])
+                else:
+                    values.append(numpy.zeros((int(keep_add.sum()),) + ncVar.shape[1:], dtype=ncVar.dtype))
+            outVar[:] = numpy.concatenate(values)
+        else:
+            outVar[...] = ncVar[...]
+        del ncVar, outVar, attrs
+    rootgrp_out.variables['ascendingIndex'][:] = numpy.argsort(rootgrp_out.variables['lake_id'][:])
+    rootgrp_out.history = 'Updated %s' %time.ctime()
+    rootgrp_out.close()
+    rootgrp.close()
+    if add_LakeNC is not None:
+        rootgrp_add.close()
+    os.replace(tmp_LakeNC, LakeNC)
+    print('        Done updating {0} in {1:3.2f} seconds.'.format(os.path.basename(LakeNC), time.time()-tic1))
+    return nlakes
+
+def add_reservoirs_incremental(rootgrp, projdir, in_lakes, grid_obj, LakeNC, lakeIDfield=None, Gridded=True):
+    """
+    This function adds new lakes to an existing routing stack, without rebuilding
+    the routing stack or re-processing the lakes that are already present. The
+    Fulldom file (rootgrp) must be open for writing, and grid_obj must describe
+    the routing grid (WRF_Hydro_Grid of the Fulldom file). The lakes are handled
+    as in add_reservoirs, but all work is limited to the bounding window of each
+    new lake (plus LK_walker cells for the minimum elevation walk):
+
+        1) Each new lake is rasterized on its own window of the routing grid,
+           together with the new lakes that overlap the window. Cells which
+           already belong to a lake in LAKEGRID are not changed.
+        2) LAKEGRID and CHANNELGRID are read and written only within the window.
+        3) Lakes not on an active channel are removed, as in add_reservoirs.
+        4) The parameters of the new lakes are appended to the existing LAKEPARM
+           file, leaving the existing lakes untouched.
+
+    If lakeIDfield is None, new lakes are numbered from the maximum lake ID in
+    the existing LAKEPARM file. Otherwise, lakes with an ID already present in
+    LAKEPARM are skipped. The new lakes are written to the lakes vector output in
+    projdir, for use by LK_main in reach-based routing (Gridded=False).
+
+    Returns the Fulldom file object, the lake ID field, and the list of new lake IDs.
+    """
+    tic1 = time.time()                                                          # Set timer
+    print('      Adding new reservoirs to existing routing stack.')
+    print('      Gridded: {0}'.format(Gridded))
+
+    # Read the IDs of the lakes already in the routing stack
+    rootgrp_LK = netCDF4.Dataset(LakeNC, 'r')
+    existing_IDs = rootgrp_LK.variables['lake_id'][:].astype(numpy.int64)
+    rootgrp_LK.close()
+    max_ID = int(existing_IDs.max()) if existing_IDs.shape[0] > 0 else 0
+    print('    Found {0} lakes in existing lake parameter table.'.format(len(existing_IDs)))
+
+    # Setup coordinate transform for calculating lat/lon from x/y
+    wgs84_proj = osr.SpatialReference()
+    wgs84_proj.ImportFromProj4(wgs84_proj4)
+    if int(osgeo.__version__[0]) >= 3:
+        # GDAL 3 changes axis order: https://github.com/OSGeo/gdal/issues/1546
+        wgs84_proj.SetAxisMappingStrategy(osgeo.osr.OAMS_TRADITIONAL_GIS_ORDER)
+    coordTrans = osr.CoordinateTransformation(grid_obj.proj, wgs84_proj)        # Transformation from grid projection to WGS84
+
+    # Use extent of the routing grid to clip and project the new lake polygons
+    geom = grid_obj.boundarySHP('', 'MEMORY')                                   # Get domain extent for cliping geometry
+    lake_ds, lake_layer, fieldNames = project_Features(in_lakes, grid_obj.proj, clipGeom=geom)
+    geom = None
+
+    # Read the clipped and reprojected lake polygons into columnar form
+    geoms, columns = read_layer_columnar(lake_layer)
+    fields = layer_fields(lake_layer)
+    geomType = lake_layer.GetGeomType()
+    lake_ds = lake_layer = None
+
+    # Calculate area and assign lake IDs that do not conflict with the existing lakes
+    if 'AREASQKM' not in columns:
+        fields.append(('AREASQKM', ogr.OFTReal, None))                          # Add a single field to the new layer
+    columns['AREASQKM'] = shapely.area(geoms)/1000000.0                         # Add an area field to re-calculate area
+    if lakeIDfield is None:
+        print('    Adding auto-incremented lake ID field ({0}...n)'.format(max_ID+1))
+        lakeID = "newID"
+        if lakeID not in columns:
+            fields.append((lakeID, ogr.OFTInteger, None))
+        columns[lakeID] = numpy.arange(max_ID+1, max_ID+len(geoms)+1, dtype=numpy.int32)
+    else:
+        print('    Using provided lake ID field: {0}'.format(lakeIDfield))
+        lakeID = lakeIDfield                                                    # Use existing field specified by 'lakeIDfield' parameter
+        keep = ~numpy.isin(columns[lakeID], existing_IDs)                       # Lakes already in the routing stack are skipped
+        if (~keep).sum() > 0:
+            print('    Skipped {0} lakes with IDs already present in {1}.'.format((~keep).sum(), os.path.basename(LakeNC)))
+        geoms = geoms[keep]
+        columns = {fname:values[keep] for fname, values in columns.items()}
+        del keep
+
+    # Gather areas, centroid lat/lon and the bounding window of each new lake
+    print('    Starting to gather lake centroid and area information.')
+    centroids = shapely.centroid(geoms)
+    cen_x, cen_y = transform_points(coordTrans, shapely.get_x(centroids), shapely.get_y(centroids))
+    lake_ids = columns[lakeID].tolist()
+    areas = dict(zip(lake_ids, columns['AREASQKM'].tolist()))
+    cen_lats = dict(zip(lake_ids, cen_y.tolist()))
+    cen_lons = dict(zip(lake_ids, cen_x.tolist()))
+    cen_px, cen_py = shapely.get_x(centroids), shapely.get_y(centroids)        # Centroids in the grid projection
+    del centroids, cen_x, cen_y
+    lakeIDList = list(areas.keys())
+    print('    Found {0} new lakes within the domain.'.format(len(lakeIDList)))
+
+    # Window of the routing grid around each new lake, padded by LK_walker cells for the minimum elevation walk
+    bounds = shapely.bounds(geoms).reshape(-1, 4)                               # (minX, minY, maxX, maxY)
+    row0 = numpy.maximum(numpy.floor((bounds[:,3] - grid_obj.y00)/grid_obj.DY).astype(int) - LK_walker, 0)
+    row1 = numpy.minimum(numpy.ceil((bounds[:,1] - grid_obj.y00)/grid_obj.DY).astype(int) + LK_walker, grid_obj.nrows)
+    col0 = numpy.maximum(numpy.floor((bounds[:,0] - grid_obj.x00)/grid_obj.DX).astype(int) - LK_walker, 0)
+    col1 = numpy.minimum(numpy.ceil((bounds[:,2] - grid_obj.x00)/grid_obj.DX).astype(int) + LK_walker, grid_obj.ncols)
+    on_grid = numpy.nonzero((row1 > row0) & (col1 > col0))[0]
+    del bounds
+
+    # In-memory copy of the new lakes, used to rasterize the window of each lake
+    wkbs = shapely.to_wkb(geoms)
+    mem_ds = ogr.GetDriverByName('MEMORY').CreateDataSource('')
+    mem_layer = write_layer_columnar(mem_ds, 'lakes', grid_obj.proj, geomType, wkbs, fields, columns)
+
+    # Read only the windows of the routing grid that contain each new lake
+    ncVars = rootgrp.variables
+    min_elevs = {}
+    max_elevs = {}
+    new_lakes = []
+    for num in on_grid.tolist():
+        idval = lake_ids[num]
+        win = (slice(row0[num], row1[num]), slice(col0[num], col1[num]))
+
+        # Rasterize the new lakes that overlap the window. Overlapping new lakes are
+        # resolved exactly as in a rasterization of the full grid.
+        x0, y0 = grid_obj.x00 + col0[num]*grid_obj.DX, grid_obj.y00 + row0[num]*grid_obj.DY
+        x1, y1 = grid_obj.x00 + col1[num]*grid_obj.DX, grid_obj.y00 + row1[num]*grid_obj.DY
+        LakeRaster = gdal.GetDriverByName('Mem').Create('', int(col1[num]-col0[num]), int(row1[num]-row0[num]), 1, gdal.GDT_Int32)
+        LakeRaster.SetGeoTransform((x0, grid_obj.DX, 0, y0, 0, grid_obj.DY))
+        LakeRaster.SetProjection(grid_obj.WKT)
+        mem_layer.SetSpatialFilterRect(min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+        gdal.RasterizeLayer(LakeRaster, [1], mem_layer, options=["ATTRIBUTE=%s" %lakeID])
+        lake_win = BandReadAsArray(LakeRaster.GetRasterBand(1)) == idval        # Read raster object into numpy array
+        LakeRaster = None
+
+        # Do not overwrite cells of existing lakes
+        LK_win = numpy.asarray(ncVars['LAKEGRID'][win])
+        lake_win &= ~(LK_win > 0)
+
+        # Eliminate lakes that do not coincide with active channel cells
+        strm_win = numpy.asarray(ncVars['CHANNELGRID'][win])
+        if not (strm_win[lake_win] == 0).any():
+            continue
+        new_lakes.append(idval)
+
+        # Assign the outlet pixel(s) of the lake to the lake ID in channelgrid
+        flac_win = numpy.asarray(ncVars['FLOWACC'][win])
+        outlets = lake_win & (flac_win == flac_win[lake_win].max())
+        strm_win[lake_win] = NoDataVal
+        strm_win[outlets] = idval
+        if Gridded:
+            LK_win[lake_win] = idval
+            ncVars['LAKEGRID'][win] = LK_win
+            ncVars['CHANNELGRID'][win] = strm_win
+
+        # March down from the outlet to get the minimum lake elevation. The window
+        # is padded by LK_walker cells, so the walk only stops at the edge of the grid.
+        # If a lake has more than one outlet cell, the last outlet in row-major order is used.
+        outlet_rows, outlet_cols = numpy.nonzero(outlets)
+        walk_rows, walk_cols = walk_downstream(numpy.asarray(ncVars['FLOWDIRECTION'][win]), outlet_rows[-1:], outlet_cols[-1:], LK_walker)
+        fill_win = numpy.asarray(ncVars['TOPOGRAPHY'][win])
+        min_elevs[idval] = fill_win[walk_rows[0], walk_cols[0]].item()
+        max_elevs[idval] = fill_win[lake_win].max().item()
+        del LK_win, strm_win, flac_win, fill_win, lake_win, outlets, outlet_rows, outlet_cols, walk_rows, walk_cols
+    mem_layer = mem_ds = None
+    print('    Found {0} new lakes on active channels. Lost {1} lakes that were not on active channels.'.format(len(new_lakes), len(lakeIDList)-len(new_lakes)))
+    if Gridded:
+        print('    Process: LAKEGRID and CHANNELGRID updated in output netCDF.')
+
+    # Save the new lakes on the channel network to disk, in a single pass
+    keep = numpy.isin(columns[lakeID], new_lakes)
+    out_ds, lake_lyr_name, layer_options = create_vector_output(projdir, LakesSHP)
+    write_layer_columnar(out_ds, lake_lyr_name, grid_obj.proj, geomType, wkbs[keep], fields,
+                            {fname:values[keep] for fname, values in columns.items()}, layer_options=layer_options)
+    out_ds = None
+    print('    Removed {0} lakes from {1}.'.format((~keep).sum(), lake_lyr_name))
+    del keep, wkbs, geoms, columns, fields
+
+    # Only add in 'missing' lakes if this is a reach-routing simulation and lakes
+    # don't need to be resolved on the grid.
+    if not Gridded:
+        missing = numpy.array([item not in min_elevs for item in lake_ids], dtype=bool)
+        MissingLks = numpy.array(lake_ids)[missing].tolist()
+        if len(MissingLks) > 0:
+            print('    Found {0} lakes that could not be resolved on the grid: {1}\n      Sampling elevation from the centroid of these features.'.format(len(MissingLks), str(MissingLks)))
+            rows = ((cen_py[missing] - grid_obj.y00)/grid_obj.DY).astype(int)   # As in grid_obj.xy_to_grid_ij
+            cols = ((cen_px[missing] - grid_obj.x00)/grid_obj.DX).astype(int)
+            fill_win = numpy.asarray(ncVars['TOPOGRAPHY'][rows.min():rows.max()+1, cols.min():cols.max()+1])   # Single read of the window around the centroids
+            centroidElev = fill_win[rows-rows.min(), cols-cols.min()].astype(float).tolist()
+            max_elevs.update(zip(MissingLks, centroidElev))
+            min_elevs.update(zip(MissingLks, centroidElev))
+            del rows, cols, fill_win, centroidElev
+        del missing, MissingLks
+    del lake_ids, cen_px, cen_py
+    if len(min_elevs) == 0:
+        print('    No new lakes to add to the routing stack.')
+        return rootgrp, lakeID, []
+
+    # Give a minimum active lake depth to all lakes with no elevation variation
+    elevRange = {key:max_elevs[key]-val for key,val in min_elevs.items()}   # Get lake depths
+    noDepthLks = {key:val for key,val in elevRange.items() if val<minDepth}     # Make a dictionary of these lakes
+    if len(noDepthLks) > 0:
+        print('    Found {0} lakes with no elevation range. Providing minimum depth of {1}m for these lakes.'.format(len(noDepthLks), minDepth))
+        min_elevs.update({key:max_elevs[key]-minDepth for key,val in noDepthLks.items() if val==0 }) # Give these lakes a minimum depth
+        with open(os.path.join(projdir, minDepthCSV),'w') as f:
+            w = csv.writer(f)
+            w.writerows(noDepthLks.items())
+    del elevRange, noDepthLks
+
+    # Calculate the Orifice and Wier heights, as in add_reservoirs
+    OrificEs = {x:(min_elevs[x] + ((max_elevs[x] - min_elevs[x])/3)) for x in min_elevs}
+    WeirE_vals = {x:(min_elevs[x] + ((max_elevs[x] - min_elevs[x])*0.9)) for x in min_elevs}
+
+    # Build a lake parameter file for the new lakes and append it to the existing file
+    add_LakeNC = os.path.join(projdir, 'new_' + os.path.basename(LakeNC))
+    build_LAKEPARM(add_LakeNC, min_elevs, areas, max_elevs, OrificEs, cen_lats, cen_lons, WeirE_vals)
+    update_LAKEPARM(LakeNC, add_LakeNC=add_LakeNC)
+    remove_file(add_LakeNC)
+    print('    Added {0} lakes to routing stack in {1: 3.2f} seconds.'.format(len(min_elevs), time.time()-tic1))
+    return rootgrp, lakeID, list(min_elevs.keys())
+
 def getxy(ds):
     """
     This function will use the affine transformation (GeoTransform) to produce an
@@ -3314,33 +4825,184 @@ def move_downstream(DIRECTION, trim=True, mask=slice(None)):
     del j_size, i_size, j, i
     return downstream_index_grid_j, downstream_index_grid_i, valid_mask
 
+def walk_downstream(DIRECTION, rows, cols, nsteps):
+    '''
+    Follow an Esri-scheme flow direction grid downstream for 'nsteps' cells from
+    every starting cell (rows, cols) at once. Each step moves all walkers
+    together, so the cost is proportional to the number of starting cells rather
+    than the size of the grid. A walker stops if it reaches a cell with no valid
+    flow direction or if the next step would leave the grid. Returns the row and
+    column of each walker after the walk.
+    '''
+    j_size, i_size = DIRECTION.shape
+
+    # Row and column offsets for each D8 direction value (0 offset = no valid direction)
+    dj_lut = numpy.zeros(256, dtype=numpy.int64)
+    di_lut = numpy.zeros(256, dtype=numpy.int64)
+    for dirval, (dj, di) in {1:(0,1), 2:(1,1), 4:(1,0), 8:(1,-1), 16:(0,-1), 32:(-1,-1), 64:(-1,0), 128:(-1,1)}.items():
+        dj_lut[dirval] = dj
+        di_lut[dirval] = di
+
+    rows = numpy.array(rows, dtype=numpy.int64)
+    cols = numpy.array(cols, dtype=numpy.int64)
+    for step in range(nsteps):
+        dirs = numpy.asarray(DIRECTION[rows, cols]).astype(numpy.int64)
+        dirs[(dirs < 0) | (dirs > 255)] = 0
+        next_rows = rows + dj_lut[dirs]
+        next_cols = cols + di_lut[dirs]
+        on_grid = (next_rows >= 0) & (next_rows < j_size) & (next_cols >= 0) & (next_cols < i_size)
+        rows[on_grid] = next_rows[on_grid]
+        cols[on_grid] = next_cols[on_grid]
+    return rows, cols
+
+def upstream_cells(DIRECTION, rows, cols, labels=None):
+    '''
+    Find every cell upstream of (draining to) the starting cells (rows, cols) on an
+    Esri-scheme flow direction grid, including the starting cells. The search
+    moves upstream one front at a time and checks only the 8 neighbors of each
+    front, so the cost is proportional to the size of the upstream area rather than
+    the size of the grid. If a label array is given, the search only enters cells
+    with the same label as the starting cell they are reached from. Returns the
+    rows and columns of the upstream cells.
+    '''
+    j_size, i_size = DIRECTION.shape
+
+    # Direction value that a neighbor at each (row, column) offset must have to drain into the center cell
+    inflow = {(0,-1):1, (-1,-1):2, (-1,0):4, (-1,1):8, (0,1):16, (1,1):32, (1,0):64, (1,-1):128}
+
+    front_j = numpy.array(rows, dtype=numpy.int64)
+    front_i = numpy.array(cols, dtype=numpy.int64)
+    visited = numpy.zeros((j_size, i_size), dtype=bool)
+    visited[front_j, front_i] = True
+    out_j, out_i = [front_j], [front_i]
+    while front_j.size > 0:
+        next_j, next_i = [], []
+        for (dj, di), dirval in inflow.items():
+            nj = front_j + dj
+            ni = front_i + di
+            on_grid = (nj >= 0) & (nj < j_size) & (ni >= 0) & (ni < i_size)
+            fj, fi, nj, ni = front_j[on_grid], front_i[on_grid], nj[on_grid], ni[on_grid]
+            keep = (DIRECTION[nj, ni] == dirval) & ~visited[nj, ni]
+            if labels is not None:
+                keep &= labels[nj, ni] == labels[fj, fi]
+            next_j.append(nj[keep])
+            next_i.append(ni[keep])
+        front_j = numpy.concatenate(next_j)                                     # Each cell drains to one cell, so it is found only once
+        front_i = numpy.concatenate(next_i)
+        visited[front_j, front_i] = True
+        out_j.append(front_j)
+        out_i.append(front_i)
+    del visited
+    return numpy.concatenate(out_j), numpy.concatenate(out_i)
+
+def label_watersheds(DIRECTION, pour_arr, NoData=NoDataVal):
+    '''
+    Delineate the watershed above every pour point at once using an Esri-scheme
+    flow direction grid. Each cell is labeled with the value of the nearest pour
+    point downstream of it (pour points are any cells in pour_arr that are not
+    NoData), so nested watersheds are split at each pour point. Cells are ordered
+    from the headwaters downstream in one topological sort of the flow direction
+    grid, and labels are then passed from each cell to its upstream neighbors in
+    the reverse of that order, so the cost is proportional to the size of the grid
+    regardless of the number of pour points. Cells that do not drain to a pour
+    point (or that are part of a flow direction loop) are set to NoData.
+
+    Returns the label array and a dictionary of {pour point: downstream pour point}
+    giving the nested pour point hierarchy (NoData if it drains to no other point).
+    '''
+    tic1 = time.time()
+    j_size, i_size = DIRECTION.shape
+    ncells = j_size * i_size
+
+    # Row and column offsets for each D8 direction value (0 offset = no valid direction)
+    dj_lut = numpy.zeros(256, dtype=numpy.int64)
+    di_lut = numpy.zeros(256, dtype=numpy.int64)
+    for dirval, (dj, di) in {1:(0,1), 2:(1,1), 4:(1,0), 8:(1,-1), 16:(0,-1), 32:(-1,-1), 64:(-1,0), 128:(-1,1)}.items():
+        dj_lut[dirval] = dj
+        di_lut[dirval] = di
+
+    # Flat index of the downstream cell of every cell (-1 = no downstream cell on the grid)
+    dirs = numpy.asarray(DIRECTION).astype(numpy.int64).ravel()
+    dirs[(dirs < 0) | (dirs > 255)] = 0
+    j, i = numpy.divmod(numpy.arange(ncells, dtype=numpy.int64), i_size)
+    next_j = j + dj_lut[dirs]
+    next_i = i + di_lut[dirs]
+    valid = (dj_lut[dirs]!=0) | (di_lut[dirs]!=0)
+    valid &= (next_j >= 0) & (next_j < j_size) & (next_i >= 0) & (next_i < i_size)
+    down = numpy.where(valid, next_j * i_size + next_i, -1)
+    del dirs, j, i, next_j, next_i, valid
+
+    # Topological sort: peel off cells with no remaining upstream cells, one front at a time
+    indegree = numpy.bincount(down[down>=0], minlength=ncells)
+    front = numpy.flatnonzero(indegree==0)
+    fronts = []
+    while front.size > 0:
+        fronts.append(front)
+        front = down[front]
+        front = front[front>=0]
+        numpy.subtract.at(indegree, front, 1)
+        front = numpy.unique(front[indegree[front]==0])
+    del indegree, front
+
+    # Pass labels upstream from each cell, starting with the most downstream cells
+    labels = numpy.asarray(pour_arr).astype(numpy.int32).ravel()
+    is_pour = labels != NoData
+    for front in reversed(fronts):
+        front = front[~is_pour[front]]                                          # Pour point cells keep their own label
+        to_cell = down[front]
+        has_down = to_cell >= 0
+        labels[front[has_down]] = labels[to_cell[has_down]]
+
+    # Each pour point drains to the label of the cell immediately downstream of it
+    pour_cells = numpy.flatnonzero(is_pour)
+    to_cell = down[pour_cells]
+    to_label = numpy.full(pour_cells.shape, NoData, dtype=numpy.int32)
+    to_label[to_cell>=0] = labels[to_cell[to_cell>=0]]
+    hierarchy = dict(zip(labels[pour_cells].tolist(), to_label.tolist()))
+    del fronts, down, is_pour, pour_cells, to_cell, to_label
+    print('    Delineated {0} watersheds in {1: 3.2f} seconds.'.format(len(hierarchy), time.time()-tic1))
+    return labels.reshape(j_size, i_size), hierarchy
+
 def get_tot_chan_and_lakes(CH_NETRT, DIRECTION, CH_nodata=-9999):
     '''
     Numpy arrays from top to bottom, so we need to reverse all j indices
     in the function below
+
+    CH_NETRT is a SparseGrid of the CHANNELGRID layer, so only the channel cells
+    are visited. Returns the number of channel elements, a SparseGrid of channel
+    cell IDs (CH_NETLNK), and the flat indices of the flow direction error cells.
     '''
     print('          Obtaining valid channel cells')
     tic1 = time.time()
-    error_cells = []
-
-    # Empty grid
-    CH_NETLNK = numpy.full(CH_NETRT.shape, CH_nodata)
-
-    # Vectorized approach
-    channelgrid_mask = CH_NETRT>=0
+    j_size, i_size = DIRECTION.shape
 
-    # For each channel grid, look up what is downstream
-    downstream_index_grid_j, downstream_index_grid_i, valid_mask = move_downstream(DIRECTION, trim=False, mask=channelgrid_mask)
+    # Channel cells, in row-major order
+    channel_cells = CH_NETRT.idx[CH_NETRT.vals>=0]
+    cell_j, cell_i = numpy.divmod(channel_cells, i_size)
+
+    # For each channel cell, look up what is downstream (0 offset = no valid direction)
+    dj_lut = numpy.zeros(256, dtype=numpy.int64)
+    di_lut = numpy.zeros(256, dtype=numpy.int64)
+    for dirval, (dj, di) in {1:(0,1), 2:(1,1), 4:(1,0), 8:(1,-1), 16:(0,-1), 32:(-1,-1), 64:(-1,0), 128:(-1,1)}.items():
+        dj_lut[dirval] = dj
+        di_lut[dirval] = di
+    dirs = numpy.asarray(DIRECTION).ravel()[channel_cells].astype(numpy.int64)
+    dirs[(dirs < 0) | (dirs > 255)] = 0
+    downstream_index_grid_j = cell_j + dj_lut[dirs]
+    downstream_index_grid_i = cell_i + di_lut[dirs]
+    valid_mask = (downstream_index_grid_j>=0) & (downstream_index_grid_j<j_size) & (downstream_index_grid_i>=0) & (downstream_index_grid_i<i_size)
+    downstream_cells = downstream_index_grid_j*i_size + downstream_index_grid_i
+    del cell_j, cell_i, downstream_index_grid_j, downstream_index_grid_i
 
     # Number of cells that are not flowing off the grid
     counter2 = valid_mask.sum()
 
     # Find where the valid downstream channels are also channel cells
-    cnt = channelgrid_mask[downstream_index_grid_j[valid_mask], downstream_index_grid_i[valid_mask]].sum()
+    cnt = (CH_NETRT.lookup(downstream_cells[valid_mask])>=0).sum()
 
     # Find flow direction errors
-    channel_error_mask = numpy.logical_and(channelgrid_mask, DIRECTION==0)
-    error_cells += numpy.asarray(numpy.where(channel_error_mask)).T.tolist()
+    channel_error_mask = dirs==0
+    error_cells = channel_cells[channel_error_mask]
 
     # Adjust counters to eliminate these error cells
     cnt -= channel_error_mask.sum()
@@ -3352,38 +5014,32 @@ def get_tot_chan_and_lakes(CH_NETRT, DIRECTION, CH_nodata=-9999):
     print('            Completed cnt calculation in {0:3.2f} seconds'.format(time.time()-tic1))
 
     # Reduce all arrays to eliminate problem pixels
-    valid_mask = valid_mask[~channel_error_mask[channelgrid_mask]]
-    downstream_index_grid_j = downstream_index_grid_j[~channel_error_mask[channelgrid_mask]]
-    downstream_index_grid_i = downstream_index_grid_i[~channel_error_mask[channelgrid_mask]]
-    channelgrid_mask[channel_error_mask] = False
-
-    CH_NETLNK.flat[numpy.flatnonzero(channelgrid_mask)[valid_mask]] = numpy.arange(1, counter2+1)
-    CH_NETLNK[channel_error_mask] = CH_nodata                                   # Redundant with previous step?
+    valid_mask = valid_mask[~channel_error_mask]
+    downstream_cells = downstream_cells[~channel_error_mask]
+    channel_cells = channel_cells[~channel_error_mask]
+    CH_NETLNK = numpy.full(channel_cells.shape, CH_nodata, dtype=numpy.int64)
+    CH_NETLNK[valid_mask] = numpy.arange(1, counter2+1)
 
     # Reverse the valid mask, so that we are only looking at the cells that flow off the grid
     valid_mask2 = ~valid_mask
     counter3 = (valid_mask2).sum()
-
-    # Using multiple levels of boolean indexing
-    CH_NETLNK.flat[numpy.flatnonzero(channelgrid_mask)[valid_mask2]] = numpy.arange(cnt+1, (cnt+1)+(counter3+1))
+    CH_NETLNK[valid_mask2] = numpy.arange(cnt+1, (cnt+1)+counter3)
     cnt += counter3
     counter2 += counter3
 
     # Still need to add in the channels that drain to a non channel
-    valid_mask3 = CH_NETRT[downstream_index_grid_j[valid_mask], downstream_index_grid_i[valid_mask]]<0
-    valid_mask4 = valid_mask
-    valid_mask4[valid_mask] = valid_mask3
+    valid_mask4 = valid_mask.copy()
+    valid_mask4[valid_mask] = CH_NETRT.lookup(downstream_cells[valid_mask])<0
     counter4 = (valid_mask4).sum()
-    #CH_NETRT.flat[numpy.flatnonzero(channelgrid_mask)[valid_mask4]] = numpy.arange(cnt+1, (cnt+1)+(counter3+1))
-    CH_NETLNK.flat[numpy.flatnonzero(channelgrid_mask)[valid_mask4]] = numpy.arange(cnt+1, (cnt+1)+(counter3+1))
+    CH_NETLNK[valid_mask4] = numpy.resize(numpy.arange(cnt+1, (cnt+1)+(counter3+1)), counter4)    # IDs are repeated if there are more of these cells than boundary cells
     counter2 += counter4
     cnt += counter4
-    del downstream_index_grid_j, downstream_index_grid_i, channelgrid_mask
+    del downstream_cells, valid_mask, valid_mask2, valid_mask4, dirs
 
     print('            Found {0} cells that are within parameters'.format(counter3+counter4))
     print('            total number of channel elements: {0}'.format(cnt))
     print('            Completed lake and boundary calculation in {0:3.2f} seconds'.format(time.time()-tic1))
-    return cnt, CH_NETLNK, error_cells
+    return cnt, SparseGrid(CH_NETRT.shape, channel_cells, CH_NETLNK, nodata=CH_nodata), error_cells
 
 def nlinks_checker(rootgrp_FD,
                     FD_linkidVar='LINKID',
@@ -3423,27 +5079,32 @@ def nlinks_checker(rootgrp_FD,
     variables_FD = rootgrp_FD.variables
 
     if FD_linkidVar in variables_FD:
-        FD_linkID = variables_FD[FD_linkidVar][:]
-        print('        Found {0} {1} cells in input {1} variable'.format(numpy.unique(FD_linkID[:]).shape[0], FD_linkidVar))
-        del FD_linkID
-
-    # Gather the channelgrid
-    FD_chgrid = variables_FD[FD_chgridVar][:]
-    FD_order = variables_FD[FD_orderVar][:]
-    strm_order_min = FD_order.min()
-    print('        Found {0} channelgrid cells in input {1} variable'.format((FD_chgrid>=0).sum(), FD_chgridVar))
+        FD_linkID = read_sparse(rootgrp_FD, FD_linkidVar, CH_nodata)
+        nvals = numpy.unique(FD_linkID.vals).shape[0] + int(FD_linkID.idx.shape[0] < numpy.prod(FD_linkID.shape))   # Count NoData as a value
+        print('        Found {0} {1} cells in input {1} variable'.format(nvals, FD_linkidVar))
+        del FD_linkID, nvals
+
+    # Gather the channelgrid and stream order as sparse grids (channel cells only)
+    FD_chgrid = read_sparse(rootgrp_FD, FD_chgridVar, CH_nodata)
+    FD_order = read_sparse(rootgrp_FD, FD_orderVar, CH_nodata)
+    order_vals = FD_order.vals
+    if FD_order.idx.shape[0] < numpy.prod(FD_order.shape):
+        order_vals = numpy.append(order_vals, FD_order.nodata)                  # NoData cells are part of the grid minimum
+    strm_order_min = order_vals.min()
+    del order_vals
+    print('        Found {0} channelgrid cells in input {1} variable'.format((FD_chgrid.vals>=0).sum(), FD_chgridVar))
 
     # Do NLINKS check - Vectorized approach
     NLINKS = 0
     print('          Obtaining total number of channel cells in domain')
-    NLINKS = (FD_chgrid>=0).sum()
+    NLINKS = (FD_chgrid.vals>=0).sum()
     print("            NLINKS IS {0}".format(NLINKS))
 
     # Perform check on number of links
     FD8_grid = variables_FD[FD_FD8Var][:]
 
     # Determine if any of the Flowdirection values are invalid and set to 0 if so
-    invalid_FDs = ~numpy.in1d(FD8_grid, valid_FDs).reshape(FD8_grid.shape)
+    invalid_FDs = ~numpy.isin(FD8_grid, valid_FDs)
     FD8_grid[invalid_FDs] = 0
     del invalid_FDs
 
@@ -3455,56 +5116,58 @@ def nlinks_checker(rootgrp_FD,
         print('        Apparent error in network topology {0} {1}'.format(cnt, NLINKS))
 
     # Perfroam check for errors after the lake and edge step
+    error_idx = numpy.unique(error_cells)
     secondary_check = True
     if secondary_check:
-        CH_OUT = CH_NETLNK.copy()
-        CH_OUT[CH_OUT!=CH_nodata] = 0
-        error_cells2 = numpy.asarray(numpy.where(FD_chgrid!=CH_OUT)).T.tolist()
-        for error_cell2 in error_cells:
-            if error_cell2 not in error_cells:
-                error_cells.append(error_cell2)
-        del CH_OUT, error_cells2
-    print('        Found {0} channel grid cells that do not match after assigning IDs.'.format(len(error_cells)))
-
-    if len(error_cells) > 0:
+        # Channel cells that did not receive a channel cell ID (or the reverse)
+        error_idx = numpy.union1d(error_idx, numpy.setxor1d(FD_chgrid.idx[FD_chgrid.vals>=0], CH_NETLNK.idx))
+    error_j, error_i = numpy.divmod(error_idx, FD_chgrid.shape[1])              # Each error cell once, in row-major order
+    del error_cells
+    print('        Found {0} channel grid cells that do not match after assigning IDs.'.format(error_j.shape[0]))
+
+    if error_j.shape[0] > 0:
         print('        Enumerating location of error cells:')
-        for error_j, error_i in error_cells:
-            error_lon = variables_FD['LONGITUDE'][error_j, error_i]
-            error_lat = variables_FD['LATITUDE'][error_j, error_i]
-            if not silent:
-                print('          Direction i,j {0},{1} is invalid'.format(error_i,error_j))
-                print('            Longitude/Latitude: {0},{1}'.format(error_lon, error_lat))
-
-            if fix_CH:
-                # Set the problematic channelgrid cell to NoData
-                FD_chgrid[error_j, error_i] = CH_nodata
-
-                # Set other variables related to the channel to nodata
-                FD_order[error_j, error_i] = strm_order_min
-
-                # Reset all channel cell IDs to reflect the loss of this cell
-                chID = CH_NETLNK[error_j, error_i]
-                CH_NETLNK[error_j, error_i] = CH_nodata
-                CH_NETLNK[CH_NETLNK>chID] -= 1
+        if not silent:
+            error_lon = numpy.asarray(variables_FD['LONGITUDE'][:])[error_j, error_i]   # Gather all error cell coordinates at once
+            error_lat = numpy.asarray(variables_FD['LATITUDE'][:])[error_j, error_i]
+            for j, i, lon, lat in zip(error_j.tolist(), error_i.tolist(), error_lon.tolist(), error_lat.tolist()):
+                print('          Direction i,j {0},{1} is invalid'.format(i, j))
+                print('            Longitude/Latitude: {0},{1}'.format(lon, lat))
             del error_lon, error_lat
 
+        if fix_CH:
+            # Set the problematic channelgrid cells to NoData
+            FD_chgrid.drop(error_idx)
+
+            # Set other variables related to the channel to nodata
+            FD_order.update(error_idx, strm_order_min)
+
+            # Reset all channel cell IDs to reflect the loss of these cells, in one pass:
+            #   each ID is reduced by the number of removed IDs that are smaller than it.
+            removed_IDs = numpy.sort(CH_NETLNK.vals[numpy.isin(CH_NETLNK.idx, error_idx)])
+            CH_NETLNK.drop(error_idx)
+            CH_NETLNK.vals -= numpy.searchsorted(removed_IDs, CH_NETLNK.vals)
+            del removed_IDs
+    ch_altered = fix_CH and error_idx.shape[0] > 0                              # Every error cell is a channel cell
+    del error_idx, error_j, error_i
+
     # Alter grids in the input if requested
     if not numpy.array_equal(variables_FD[FD_FD8Var][:], FD8_grid):
         print('        WARNING: The {0} variable in Fulldom_hires.nc file will be altered.'.format(FD_FD8Var))
         variables_FD[FD_FD8Var][:] = FD8_grid
     else:
         print('        The {0} variable in the input Fulldom_hires.nc file will not be altered.'.format(FD_FD8Var))
-    if not numpy.array_equal(variables_FD[FD_chgridVar][:],FD_chgrid):
+    if ch_altered:
         print('        WARNING: The {0} variable in Fulldom_hires.nc file will be altered.'.format(FD_chgridVar))
-        variables_FD[FD_chgridVar][:] = FD_chgrid
+        write_sparse(rootgrp_FD, FD_chgridVar, FD_chgrid)
         print('        WARNING: The {0} variable in Fulldom_hires.nc file will be altered.'.format(FD_orderVar))
-        variables_FD[FD_orderVar][:] = FD_order
+        write_sparse(rootgrp_FD, FD_orderVar, FD_order)
     else:
         print('        The {0} variable in Fulldom_hires.nc file will not be altered.'.format(FD_chgridVar))
         print('        The {0} variable in Fulldom_hires.nc file will not be altered.'.format(FD_orderVar))
 
     # Clean up
-    del variables_FD, FD_chgrid, FD_order
+    del variables_FD, FD_chgrid, FD_order, CH_NETLNK
     print('        NLINKS checking process completed in {0:3.2f} seconds'.format(time.time()-tic1))
     return rootgrp_FD
 
@@ -3516,6 +5179,24 @@ def group_min(l, g):
             groups[gi] = li
     return groups
 
+def label_max(value_arr, cells, label_pos, nlabels):
+    '''
+    Maximum of 'value_arr' within each label. 'cells' holds the flat index of
+    every labelled cell (such as the cells of a SparseGrid label layer) and
+    'label_pos' the position (0 to nlabels-1) of the label of each cell.
+    The cells are sorted by label once and reduced with numpy.maximum.reduceat,
+    instead of one full-grid comparison per label. Returns an array of length
+    'nlabels', indexed by label position.
+    '''
+    values = numpy.asarray(value_arr).ravel()[cells]
+    sorter = numpy.argsort(label_pos, kind='stable')
+    sorted_pos = label_pos[sorter]
+    starts = numpy.flatnonzero(numpy.r_[True, sorted_pos[1:] != sorted_pos[:-1]])
+    out = numpy.zeros(nlabels, dtype=values.dtype)
+    if cells.shape[0] > 0:
+        out[sorted_pos[starts]] = numpy.maximum.reduceat(values[sorter], starts)
+    return out
+
 def set_problem(problem_lakes, LakeID, problemstr):
     '''This function is used to add elements to a dictionary where the values are
     a list and the keys may or may not exist. This speeds up adding elements to
@@ -3526,25 +5207,46 @@ def set_problem(problem_lakes, LakeID, problemstr):
         problem_lakes[LakeID] = [problemstr]
     return problem_lakes
 
-def get_inflow_segs(FLWBarr, localLk, FromComIDs, FromSegs, LakeAssociation=LakeAssoc):
+def lake_link_groups(FLWBarr, LakeAssociation=LakeAssoc):
+    '''This function will index the rows of the flowline:lake association array
+    by lake, so that the links of any lake can be found without scanning the
+    whole array.
+    Inputs:
+        1) FLWBarr: Array containing flowlines and the associated lake
+    Output:
+        LakeRows: Dictionary of lake ID: array of row indices into FLWBarr,
+                  in the same order as the rows of FLWBarr.
+    '''
+    sorter = numpy.argsort(FLWBarr[LakeAssociation], kind='stable')             # Stable sort keeps FLWBarr row order within each lake
+    lakes_sorted = FLWBarr[LakeAssociation][sorter]
+    bounds = numpy.flatnonzero(numpy.r_[True, lakes_sorted[1:] != lakes_sorted[:-1], True])
+    LakeRows = {lake:sorter[start:end] for lake, start, end in zip(lakes_sorted[bounds[:-1]].tolist(), bounds[:-1], bounds[1:])}
+    return LakeRows
+
+def get_inflow_segs(FLWBarr, localLk, FromComIDs, FromSegs, LakeAssociation=LakeAssoc, LakeRows=None):
     '''This function will list all inflow segments to a particular lake.
     Inputs:
         1) FLWBarr: Array containing flowlines and the associated lake
         2) localLk: The ID of the lake to examine
         3) FromComIDs: Dictionary of the From:To relationship for flowlines
         4) FromSegs: Dictionary of the upstream links for each flowline
+        5) LakeRows: Optional dictionary of lake ID: FLWBarr row indices (see
+           lake_link_groups) to avoid scanning FLWBarr for the lake links.
     Globals:
         1) LakeAssociation: The field name used to associate flowlines with lakes.
     Output:
         inflows: Array of links that are inflows to the lake
     '''
 
-    Lake_Links = FLWBarr[FLWBarr[LakeAssociation]==localLk]                           # Find all of the links inside the lake
+    if LakeRows is None:
+        Lake_Links = FLWBarr[FLWBarr[LakeAssociation]==localLk]                 # Find all of the links inside the lake
+    else:
+        Lake_Links = FLWBarr[LakeRows.get(localLk, numpy.empty(0, dtype=numpy.int64))]
 
     # Find all headwater segments as start points
-    ToSeg_keys = Lake_Links[FLID]                                               # Array of all lake links for this local lake
-    ToSeg_vals = numpy.array([FromComIDs.get(key) for key in ToSeg_keys])       # Array of all downstream links for all of the lake links
-    ups = ToSeg_keys[~numpy.in1d(ToSeg_keys, ToSeg_vals)].tolist()              # List of all 'headwater' segments for this lake
+    ToSeg_keys = Lake_Links[FLID].tolist()                                      # List of all lake links for this local lake
+    ToSeg_vals = {FromComIDs.get(key) for key in ToSeg_keys}                    # Set of all downstream links for all of the lake links
+    ups = [key for key in ToSeg_keys if key not in ToSeg_vals]                  # List of all 'headwater' segments for this lake
     del ToSeg_keys, ToSeg_vals, Lake_Links
 
     # Gather all inflow segments from lake 'headwater' segments
@@ -3588,7 +5290,7 @@ def check_downstream(uplink, localLk, FromComIDs, Lake_LinkDict):
     #print '      Looked downstream %s links from %s in lake %s.' %(counter, uplink, localLk)
     return result, downlinks, counter
 
-def get_lake_routing_info(FLWBarr, localLk, Lake_LinkDict, accum_val, FromComIDs, FromSegs, LakeAssociation=LakeAssoc):
+def get_lake_routing_info(FLWBarr, localLk, Lake_LinkDict, accum_val, FromComIDs, FromSegs, LakeAssociation=LakeAssoc, LakeRows=None):
     '''This function will list all inflow segments to a "lake" as well as additional
     datasets to assist in routing through the lake.
 
@@ -3599,6 +5301,8 @@ def get_lake_routing_info(FLWBarr, localLk, Lake_LinkDict, accum_val, FromComIDs
         4) accum_val: The value given to each segment before performing lake routed accumulations
         5) FromComIDs: Dictionary of the From:To relationship for flowlines
         6) FromSegs: Dictionary of the upstream links for each flowline
+        7) LakeRows: Optional dictionary of lake ID: FLWBarr row indices (see
+           lake_link_groups) to avoid scanning FLWBarr for the lake links.
     Globals:
         1) LakeAssociation: A field describing which lake ComID a flowline is associated with
         2) FLID: The flowline ComID
@@ -3621,18 +5325,22 @@ def get_lake_routing_info(FLWBarr, localLk, Lake_LinkDict, accum_val, FromComIDs
     UseAll = True                                                               # Switch to look outside of just the links that spatially intersect the lake
 
     # Use all links that are associated with lakes (either through spatial join or attribute join)
-    Lake_Links = FLWBarr[FLWBarr[LakeAssociation]==localLk]                           # Find all of the links associated with the current lake
+    if LakeRows is None:
+        Lake_Links = FLWBarr[FLWBarr[LakeAssociation]==localLk]                 # Find all of the links associated with the current lake
+    else:
+        Lake_Links = FLWBarr[LakeRows.get(localLk, numpy.empty(0, dtype=numpy.int64))]
     Lake_LinksList = Lake_Links[FLID].tolist()                                  # List of lake link ComIDs
+    Lake_LinksSet = set(Lake_LinksList)                                         # Set of the same links, for membership tests
 
     # Find all headwater segments as start points
-    ToSeg_keys = numpy.unique(Lake_Links[FLID])                                 # Array of all unique lake links for this local lake
-    ToSeg_vals = numpy.unique(numpy.array([FromComIDs.get(key) for key in ToSeg_keys])) # Array of all unique downstream links for all of the lake links
-    ups = ToSeg_keys[~numpy.in1d(ToSeg_keys, ToSeg_vals)].tolist()              # List of all 'headwater' segments for this lake
+    ToSeg_keys = sorted(Lake_LinksSet)                                          # Sorted list of all unique lake links for this local lake
+    ToSeg_vals = {FromComIDs.get(key) for key in ToSeg_keys}                    # Set of all unique downstream links for all of the lake links
+    ups = [key for key in ToSeg_keys if key not in ToSeg_vals]                  # List of all 'headwater' segments for this lake
 
     # Find any non-assigned lake segments in the lake flow network by iterating down the network
     newLakeLinks = {}                                                           # Dictionary to store new flowline:lake associations
     counter = 0                                                                 # Initiate counter
-    seen = []                                                                   # Initiate list of seen links
+    seen = set()                                                                # Initiate set of seen links
     if UseAll:
 
         # Added 12/30/2019 to avoid situations with no upstream or downstream links
@@ -3652,7 +5360,7 @@ def get_lake_routing_info(FLWBarr, localLk, Lake_LinkDict, accum_val, FromComIDs
                     downs.remove(key)
 
             # Add any link:lake associations that were not already present. This is an attempt to eliminate flow looping out of lakes and back in.
-            checklinks = list(set([item for item in downs if item not in Lake_LinksList]))  # Unique list of links that are downstream of lake links but not associated with that lake
+            checklinks = list(set([item for item in downs if item not in Lake_LinksSet]))   # Unique list of links that are downstream of lake links but not associated with that lake
 
             # Check these suspect links for downstream connectivity back to the lake
             if len(checklinks) > 0:
@@ -3664,14 +5372,17 @@ def get_lake_routing_info(FLWBarr, localLk, Lake_LinkDict, accum_val, FromComIDs
                         # If result == True, then this lake flows out and then back into itself
                         #print '      Looked downstream %s links from %s in lake %s.' %(counter1, uplink, localLk)
                         Lake_LinksList += downlinks                             # Add these links to the lake association
+                        Lake_LinksSet.update(downlinks)
                         newLakeLinks.update({item:localLk for item in downlinks})   # Store these new flowline:lake associations
                     else:
                         # This downstream segment never returns to the lake. Disassociate.
-                        Lake_LinksList = [item for item in Lake_LinksList if item not in downlinks[1:]] # Remove these segments from association with this lake
+                        remove_links = set(downlinks[1:])
+                        Lake_LinksList = [item for item in Lake_LinksList if item not in remove_links] # Remove these segments from association with this lake
+                        Lake_LinksSet = set(Lake_LinksList)
                     downs.remove(uplink)                                        # Remove this segment so that the loop can complete.
-                    seen.append(uplink)
+                    seen.add(uplink)
 
-            downs = [item for item in downs if item in Lake_LinksList]          # Remove downstream segments that are not associated with this lake
+            downs = [item for item in downs if item in Lake_LinksSet]           # Remove downstream segments that are not associated with this lake
             #for key in downs:
             #    if key in NoDownstream:
             #        continue                                                    # Downstream segment is not a valid ComID
@@ -3687,11 +5398,11 @@ def get_lake_routing_info(FLWBarr, localLk, Lake_LinkDict, accum_val, FromComIDs
     SegVals2 = {key:accum_val for key in Lake_LinksList}                        # Set all initial values to accum_val
 
     # Test to regenerate upstream inflows to account for newly added links (2/26/2018)
-    ToSeg_keys = numpy.array(Lake_LinksList)                                    # Array of all unique lake links for this local lake
-    ToSeg_vals = numpy.unique(numpy.array([FromComIDs.get(key) for key in ToSeg_keys])) # Array of all unique downstream links for all of the lake links
+    ToSeg_keys = Lake_LinksList                                                 # List of all unique lake links for this local lake
+    ToSeg_vals = {FromComIDs.get(key) for key in ToSeg_keys}                    # Set of all unique downstream links for all of the lake links
 
     # Re-gather the upstream segments for this lake
-    ups = ToSeg_keys[~numpy.in1d(ToSeg_keys, ToSeg_vals)].tolist()              # List of all 'headwater' segments for this lake
+    ups = [key for key in ToSeg_keys if key not in ToSeg_vals]                  # List of all 'headwater' segments for this lake
     del ToSeg_keys, ToSeg_vals                                                  # Free up memory
 
     # Gather all inflow segments from lake 'headwater' segments. This may not account for oCONUS contributing links
@@ -3700,50 +5411,111 @@ def get_lake_routing_info(FLWBarr, localLk, Lake_LinkDict, accum_val, FromComIDs
 
     # 2/27/2018: We can more closely replicate WRF-Hydro's TYPE=3 segments if we say inflows are all segments that flow into any lake segment that are not already accounted for
     inflows = []
+    Lake_LinksSet = set(Lake_LinksList)
     for link in Lake_LinksList:
         upsegs = FromSegs.get(link)                                             # All upstream segments for each lake link
         if upsegs is None:
             continue
-        upsegs2 = [item for item in upsegs if item not in Lake_LinksList]       # All contributing links that are not already associated with the lake
+        upsegs2 = [item for item in upsegs if item not in Lake_LinksSet]        # All contributing links that are not already associated with the lake
         inflows += upsegs2
         del upsegs, upsegs2
     inflows = numpy.array(inflows)
     return Lake_LinksList, inflows, SegVals, SegVals2, ups, newLakeLinks
 
-def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=LakeAssoc):
+def network_basins(FromComIDs):
+    '''This function will label each flowline with the terminal flowline of the
+    network that it drains to, using pointer jumping on the From:To relationship.
+    Flowlines with the same label belong to the same drainage basin, and no
+    upstream or downstream search through the network can leave a basin.
+    Inputs:
+        1) FromComIDs: Dictionary of the From:To relationship for flowlines
+    Output:
+        links: Array of flowline IDs
+        tos: Array of downstream flowline IDs
+        basins: Array of the index (into links) of the terminal flowline for each
+                flowline, or None if the network contains a loop
     '''
-    This function will assign a link type to each lake.
-            3 = Lake Inflow Link
-            2 = Internal Lake Link
-            1 = Lake Outflow Link (based on accumulated flow in the lake)
+    links = numpy.fromiter(FromComIDs.keys(), dtype=numpy.int64, count=len(FromComIDs))
+    tos = numpy.fromiter((0 if val is None else val for val in FromComIDs.values()), dtype=numpy.int64, count=len(FromComIDs))
+    if links.shape[0] == 0:
+        return links, tos, links.copy()
+    sorter = numpy.argsort(links)
+    down = sorter[numpy.searchsorted(links, tos, sorter=sorter).clip(0, links.shape[0]-1)]
+    basins = numpy.where(links[down] == tos, down, numpy.arange(links.shape[0]))   # Terminal flowlines point to themselves
+    for step in range(int(numpy.log2(links.shape[0]))+2):
+        next_basins = basins[basins]                                            # Double the distance travelled downstream
+        if numpy.array_equal(next_basins, basins):
+            return links, tos, basins
+        basins = next_basins
+    return links, tos, None                                                     # Did not converge. The network contains a loop.
+
+def lake_groups(FLWBarr, links, basins, LakeAssociation=LakeAssoc):
+    '''This function will partition the lakes in FLWBarr into groups that can be
+    classified independently. Lakes are grouped by the drainage basin of their
+    flowlines, and basins that share a lake are merged into one group.
+    Inputs:
+        1) FLWBarr: Array containing flowlines and the associated lake
+        2) links, basins: Outputs of network_basins
+    Output:
+        groups: Dictionary of group label: number of FLWBarr rows in the group
+        Lake_Group: Dictionary of lake ID: group label
+        basin_groups: Dictionary of basin label: group label
+    '''
+    sorter = numpy.argsort(links)
+    pos = sorter[numpy.searchsorted(links, FLWBarr[FLID], sorter=sorter).clip(0, max(links.shape[0]-1, 0))]
+    row_basins = numpy.where(links[pos] == FLWBarr[FLID], basins[pos], -1)      # -1 for flowlines that are not in the network
+
+    # Union-find over basins that share a lake
+    parent = {}
+    def find(item):
+        while parent.get(item, item) != item:
+            item = parent[item]
+        return item
+
+    LakeRows = lake_link_groups(FLWBarr, LakeAssociation=LakeAssociation)
+    Lake_Basins = {}
+    for lake in LakeRows:
+        lake_basins = set(row_basins[LakeRows[lake]].tolist())
+        lake_basins.discard(-1)
+        Lake_Basins[lake] = lake_basins
+        roots = {find(item) for item in lake_basins}
+        root = min(roots) if len(roots) > 0 else None
+        for item in roots:
+            parent[item] = root
+
+    groups = {}
+    Lake_Group = {}
+    for lake, rows in LakeRows.items():
+        if len(Lake_Basins[lake]) > 0:
+            label = find(next(iter(Lake_Basins[lake])))
+        else:
+            label = -2 - rows[0]                                                # Lake with no flowlines in the network
+        groups[label] = groups.get(label, 0) + rows.shape[0]
+        Lake_Group[lake] = label
+    basin_groups = {item:find(item) for item in set(row_basins.tolist()) if item != -1}
+    return groups, Lake_Group, basin_groups
 
-    This function sorts the lakes by the minimum HydrSeq of all links associated
-    with that lake. Thus, theoretically, lakes can be visited by increasing HydroSeq
-    and no downstream searching for lakes should be necessary. ...
+def classify_lakes(FLWBarr, FromComIDs, LakeIDs, LakeAssociation=LakeAssoc):
+    '''
+    This function will examine each lake in LakeIDs, in order, and assign a link
+    type to each link in the lake. See Lake_Link_Type for a description of the
+    classification. FLWBarr is altered in place when lakes are merged.
 
-    This function will examine each lake and determine the outlets based on an
-    accumulation of values through the topology of links within the lake. It will
-    identify lakes with (potentially) multiple outlets, as well as internally
-    draining lakes. Lakes with multiple outlets according to flow accumulation
-    within the lake will have the minor outlets removed.
+    This function may be called once for all lakes, or once for each independent
+    group of lakes (see lake_groups), with FLWBarr and FromComIDs subset to the
+    flowlines in that group.
 
-    2/16/2018: This function finally diagnoses all potential conflicts with WRF-Hydro.
-        In the "for LakeID in LakeSeq[FLID]:" loop, any continue statements will
-        eliminate that lake from being placed on the flow network. Conditions that
-        prevent a lake from functioning in WRF-Hydro are:
-            1) The lake has no Lake Link Type of 1 (outlet link). This seems to
-               occur when a lake has only one interior link, or when all interior
-               links flow directly to a nonexistent outlet link (endorheic).
-            2) A lake flows directly into another lake.
-            3) Multiple outlet links are defined
+    Outputs:
+        Lake_Link_Type_arr: Lake links of each lake, before secondary outlet removal
+        problem_lakes, seen, ChainedLakes, Old_New_LakeComID: As in Lake_Link_Type
+        FLWBarr: Flowline:lake association array with merged lakes
+        Remove_Association: Dictionary of lake ID: links to remove from that lake
+        Tossed_Lake_Link_Type_arr: Lake links of eliminated lakes
+        counters: Number of lakes examined and number of each lake problem
     '''
 
-    print('        Starting to gather lake link type information.')
-
     # Options and defaults
-    tic1 = time.time()                                                          # Initiate timer for this function
-    #HydroSeq = False                                                            # Switch to use HydroSeq to find the lake outlet
-    IterateList = True                                                          # Switch to iterate over lake links to find outlet(s)
+    tic2 = time.time()                                                          # Initiate timer for progressive print statements
     accum_val = 1                                                               # Values given to each segment before accumulation
     debug = False                                                               # Switch to trigger many, many print statements
 
@@ -3751,7 +5523,7 @@ def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=Lake
     problem_lakes = {}                                                          # Problem dictionary
     Old_New_LakeComID = {}                                                      # Dictionary to store the 'old Lake ComID':'new Lake ComID' mapping
     ChainedLakes = {}                                                           # Dictionary to store number of lakes chained together
-    Remove_Association = []                                                     # List used to remove a lake association from a flowline (for divergences in lakes)
+    Remove_Association = {}                                                     # Dictionary used to remove a lake association from a flowline (for divergences in lakes)
 
     # Set output array dtype and field names
     dtype1 = dict(names=(FLID, 'LINK_TYPE', LakeAssociation, 'Accum1', 'Accum2'), formats=('<i4', '<i4', '<i4', '<i4', '<i4'))
@@ -3765,45 +5537,29 @@ def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=Lake
     Lake_Link_Type_Accum2 = []                                                  # Added 2/17/2018 to keep track of lake local accumulation
 
     # Attempt to keep diagnostic information for lakes that are eliminated by this pre-processor
-    Tossed_Lake_Link_Type_arr = numpy.empty(0, dtype=dtype2)                    # Generate new empty array to store tossed lake values
+    Tossed_blocks = []                                                          # Blocks of tossed lake values, assembled into Tossed_Lake_Link_Type_arr at the end
 
     # Build a dictionary here to pass into the get_lake_routing_info function
-    Lake_LinkDict = {item[FLID]:item[LakeAssociation] for item in FLWBarr}            # Generate dictionary of link:lake associations
+    Lake_LinkDict = dict(zip(FLWBarr[FLID].tolist(), FLWBarr[LakeAssociation].tolist()))   # Generate dictionary of link:lake associations
 
-    # 1) Gather a list of all contributing segments for each segment in the system
-    tic2 = time.time()
+    # Index FLWBarr by link and by lake so that no lake requires a scan of the full array
+    Link_Row = dict(zip(FLWBarr[FLID].tolist(), range(FLWBarr.shape[0])))       # Dictionary of link:FLWBarr row
+    LakeRows = lake_link_groups(FLWBarr, LakeAssociation=LakeAssociation)       # Dictionary of lake:FLWBarr rows
+
+    def lakes_of_links(links):
+        # Current lake association of each FLWBarr row whose link is in 'links', in FLWBarr row order
+        rows = sorted({Link_Row[link] for link in links if link in Link_Row})
+        return FLWBarr[LakeAssociation][rows].tolist()
+
+    # Gather a list of all contributing segments for each segment in the system
     FromSegs = {}
     for key,val in FromComIDs.items():
         try:
             FromSegs[val] += [key]
         except KeyError:
             FromSegs[val] = [key]
-    print('        Completed FromSegs dictionary in {0:3.2f} seconds.'.format(time.time()-tic2))
 
-    # 2) Create a sorting of lakes that will start with the lake which has the lowest HydroSeq value in it's flowlines
-    # Use indexing to grab elements common to both arrays while preserving order of one of the arrays (FLWBarr)
-    tic2 = time.time()
-    commons = FLarr[numpy.in1d(FLarr[FLID], FLWBarr[FLID])]                     # An array of all of the flowlines in the flowline array that are common to the flowline-waterbody association array
-    xsorted = numpy.argsort(commons[FLID])                                      # Find the sorted order for the array that is to be sorted
-    ypos = numpy.searchsorted(commons[xsorted][FLID], FLWBarr[numpy.in1d(FLWBarr[FLID], FLarr[FLID])][FLID]) # Search only the common values between arrays
-    indices = xsorted[ypos]
-    commons2 = commons[indices]                                                 # Re-order the input array to match the comparison array order
-    del commons, xsorted, ypos, indices
-
-    # Use the group_min function to find the minimum HydroSeq value for each group of WBAREACOMID values
-    group_minDict = group_min(commons2[hydroSeq], FLWBarr[LakeAssociation])     # Find the minimum HydroSeq value for this lake
-    del commons2                                                                # Free up memory
-
-    # Construct an array to store the Lake COMID and Minimum Hydrosequence
-    dtype = dict(names=(FLID, 'minHydroSeq'), formats=('<i4', '<f8'))
-    LakeSeq = numpy.array(list(group_minDict.items()), dtype=dtype)             # Create array of minimum HydroSeq values for each lake
-    del group_minDict, dtype                                                    # Free up memory
-    LakeSeq = LakeSeq[LakeSeq[FLID]>-9998]                                      # Clip off -9999, -9998
-    LakeSeq.sort(order='minHydroSeq')                                           # Sort by minimum HydroSeq
-    LakeSeqsize = LakeSeq.shape[0]                                              # Get the number of elements in the array
-    print('        Completed sorting lakes by minimum HydroSeq in {0:3.2f} seconds.'.format(time.time()-tic2))
-
-    # 3)  Find outflow link and assign type 1 (but not if it flows into another lake)
+    # Find outflow link and assign type 1 (but not if it flows into another lake)
     counter = 0                                                                 #
     counter3 = 0                                                                # Counter to keep track of multiple outlet lakes
     counter4 = 0                                                                # Counter to keep track of headwater lakes
@@ -3811,22 +5567,19 @@ def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=Lake
     counter6 = 0                                                                # Counter to keep track of lakes immediately downstream
     counter7 = 0                                                                # Counter to keep track of lakes with outlet that drians to nowhere
     counter8 = 0                                                                # Counter to keep track of lakes with no Type=2 links
-    tic2 = time.time()                                                          # Reset the counter to provide progressive print statements
     seen = []                                                                   # Lakes in this list have been 'seen', or reviewed
-    if subset is not None:
-        LakeSeq = LakeSeq[numpy.in1d(LakeSeq[FLID], subset[FLID])]              # Subset the list of lakes to a subset array if requested
-        print('        Subsetted the lakes from {0} to {1} based on a provided subset array.'.format(LakeSeqsize, LakeSeq.shape[0]))
+    seen_set = set()                                                            # Set of the same lakes, for membership tests
 
-    for LakeID in LakeSeq[FLID]:
+    for LakeID in LakeIDs:
         if debug:
             print('          Lake {0}'.format(LakeID))
 
-        if LakeID in seen:
+        if LakeID in seen_set:
             #print('          Lake {0} has already been examined.'.format(LakeID))
             continue                                                            # This lake has already been examined
 
         # Get initial lake information, including adding looping outflows
-        Lake_LinksList, inflows, SegVals, SegVals2, ups, newLakeLinks = get_lake_routing_info(FLWBarr, LakeID, Lake_LinkDict, accum_val, FromComIDs, FromSegs, LakeAssociation=LakeAssociation)
+        Lake_LinksList, inflows, SegVals, SegVals2, ups, newLakeLinks = get_lake_routing_info(FLWBarr, LakeID, Lake_LinkDict, accum_val, FromComIDs, FromSegs, LakeAssociation=LakeAssociation, LakeRows=LakeRows)
         if debug:
             print('          Lake {0} has {1} links, {2} inflows, and {3} upstream flowlines.'.format(LakeID, len(Lake_LinksList), len(inflows), len(ups)))
             print('          Lake {0} has {1} inflows: {2}'.format(LakeID, len(inflows), inflows))
@@ -3841,7 +5594,7 @@ def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=Lake
 
         # See if any of the inflow links are on other lakes
         counter2 = 0                                                            # Counter to keep track of lakes immediately upstream for each lake
-        num_uplakes = FLWBarr[numpy.in1d(FLWBarr[FLID], inflows)][LakeAssociation].tolist()   # This will be a list of lakes that are associated with this current lake's inflows
+        num_uplakes = lakes_of_links(inflows.tolist())                          # This will be a list of lakes that are associated with this current lake's inflows
         if LakeID in num_uplakes:                                               # Check to make sure lake doesn't flow into itself
             # If the upstream lake is the same ID as the current lake, log the issue
             num_uplakes.remove(LakeID)                                          # If it does, remove that lake to elminate a flow loop
@@ -3854,12 +5607,12 @@ def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=Lake
         # This will essentially merge any lakes that flow directly into another lake, giving the ID of the most downstream lake to all chained lakes above it.
         while len(num_uplakes) > 0:
             uplake = num_uplakes[0]                                             # Look at the first lake in the list
-            if uplake in seen:                                                  # If this lake has already been examined, then skip it
+            if uplake in seen_set:                                              # If this lake has already been examined, then skip it
                 num_uplakes.remove(uplake)                                      # If this lake has been examined, remove it from this list
                 continue
             Old_New_LakeComID[uplake] = LakeID                                  # This will give the upstream lake the ID of the downstream lake it flows directly into
-            inflows2 = get_inflow_segs(FLWBarr, uplake, FromComIDs, FromSegs, LakeAssociation=LakeAssociation)   # Get all of the upstream lake's inflows and associate these flowlines with the new LakeID
-            uplakes2 = FLWBarr[numpy.in1d(FLWBarr[FLID], inflows2)][LakeAssociation].tolist() # Get all the upstream lakes for this lake
+            inflows2 = get_inflow_segs(FLWBarr, uplake, FromComIDs, FromSegs, LakeAssociation=LakeAssociation, LakeRows=LakeRows)   # Get all of the upstream lake's inflows and associate these flowlines with the new LakeID
+            uplakes2 = lakes_of_links(inflows2.tolist())                        # Get all the upstream lakes for this lake
             if uplake in uplakes2:
                 uplakes2.remove(uplake)                                         # Remove any flow loops
             num_uplakes += uplakes2                                             # Add these new upstream lakes to the list of upstream lakes
@@ -3867,6 +5620,7 @@ def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=Lake
             num_uplakes.remove(uplake)                                          # Remove this lake from the list so that iteration will stop when the list is empty
             counter2 += 1                                                       # Advance the counter
             seen.append(uplake)                                                 # Add this upstream lake to the list of examined lakes
+            seen_set.add(uplake)
             del inflows2, uplakes2                                              # Free up memory
 
         # Alter all Waterbody ComIDs at once to match the most downstream lake and regenerate lake information for the new, merged lake
@@ -3875,15 +5629,23 @@ def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=Lake
             print('        Altering {0} lake COMID value(s) to {1} from: {2}'.format(len(to_alter), LakeID, to_alter))
             for item in to_alter:
                 problem_lakes = set_problem(problem_lakes, LakeID, 'Upstream segment for {0} belongs to another lake [{1}]'.format(LakeID, item))
-            FLWBarr[LakeAssociation][numpy.in1d(FLWBarr[LakeAssociation], numpy.array(to_alter))] = LakeID  # Change all the IDs of the upstream lakes at once to the current lake ID
-            Lake_LinksList, inflows, SegVals, SegVals2, ups, newLakeLinks = get_lake_routing_info(FLWBarr, LakeID, Lake_LinkDict, accum_val, FromComIDs, FromSegs, LakeAssociation=LakeAssociation)
+            alter_rows = [LakeRows.pop(item) for item in set(to_alter) if item != LakeID and item in LakeRows]
+            if len(alter_rows) > 0:
+                alter_rows = numpy.concatenate(alter_rows)
+                FLWBarr[LakeAssociation][alter_rows] = LakeID                   # Change all the IDs of the upstream lakes at once to the current lake ID
+                LakeRows[LakeID] = numpy.sort(numpy.concatenate([LakeRows.get(LakeID, numpy.empty(0, dtype=numpy.int64)), alter_rows]))   # Merged lake keeps FLWBarr row order
+            del alter_rows
+            Lake_LinksList, inflows, SegVals, SegVals2, ups, newLakeLinks = get_lake_routing_info(FLWBarr, LakeID, Lake_LinkDict, accum_val, FromComIDs, FromSegs, LakeAssociation=LakeAssociation, LakeRows=LakeRows)
         Lake_LinksList2 = Lake_LinksList + inflows.tolist()                     # Add all lake links to all inflows
         if debug:
             print('          Lake {0} now has {1} links: {2}'.format(LakeID, len(Lake_LinksList2), Lake_LinksList2))
 
         # Assign the initial LINK_TYPE values based on local lake links and inflow links
         #Lake_Link_Type_local = [3 if item in inflows.tolist() and item not in newLakeLinks else 2 for item in Lake_LinksList2]   # Append Default LINK_TYPE (2) for all items in the Lake_LinksList
-        Lake_Link_Type_local = [3 if item in inflows.tolist() else 2 for item in Lake_LinksList2]   # Append Default LINK_TYPE (2) for all items in the Lake_LinksList
+        inflow_set = set(inflows.tolist())                                      # Set of inflow links, for membership tests
+        Lake_LinksSet = set(Lake_LinksList)                                     # Set of lake links, for membership tests
+        Lake_LinksSet2 = set(Lake_LinksList2)                                   # Set of lake and inflow links, for membership tests
+        Lake_Link_Type_local = [3 if item in inflow_set else 2 for item in Lake_LinksList2]   # Append Default LINK_TYPE (2) for all items in the Lake_LinksList
 
         # Added 12/30/2019 to avoid situations with no upstream or downstream links
         if len(ups) == 0:
@@ -3895,7 +5657,7 @@ def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=Lake
         iteration = 0                                                           # Initiate the iteration counter
         while changes > 0:
             downs = list(set([FromComIDs.get(key, 0) for key in ups]))             # Get unique list of downstream flowline ComIDs
-            downs = [item for item in downs if item in Lake_LinksList2]         # Remove downstream segments that are not associated with this lake
+            downs = [item for item in downs if item in Lake_LinksSet2]          # Remove downstream segments that are not associated with this lake
             for key in downs:
                 if key in NoDownstream:
                     # This might be where to catch an endorheic basin terminal lake
@@ -3918,12 +5680,13 @@ def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=Lake
             changes = sum([0 if item in NoDownstream else 1 for item in downs])    # Quantify the number of valid downstream links
             iteration += 1                                                      # Add one for each level
         seen.append(LakeID)                                                     # Add this lake to the list of lakes that have been seen already
+        seen_set.add(LakeID)
         if debug:
             print('        Lake_LinksList2: {0}'.format(Lake_LinksList2))
 
         # Record the routed and unrouted accumulation values
-        Accum1_local = [0 if item in inflows.tolist() else SegVals[item] for item in Lake_LinksList2]   # Added 2/17/2018 to keep track of lake local accumulation
-        Accum2_local = [0 if item in inflows.tolist() else SegVals2[item] for item in Lake_LinksList2]  # Added 2/17/2018 to keep track of lake local accumulation
+        Accum1_local = [0 if item in inflow_set else SegVals[item] for item in Lake_LinksList2]   # Added 2/17/2018 to keep track of lake local accumulation
+        Accum2_local = [0 if item in inflow_set else SegVals2[item] for item in Lake_LinksList2]  # Added 2/17/2018 to keep track of lake local accumulation
         if debug:
             print('        Accum1_local: {0}'.format(Accum1_local))
             print('        Accum2_local: {0}'.format(Accum2_local))
@@ -3953,21 +5716,23 @@ def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=Lake
             while len(ups) > 0:
                 Remove_local += ups                                             # Add the segments from the secondary outlet to the association removal list
                 #ups = [FromSegs.get(key) for key in ups if key in Lake_LinksList2] # Move upstream in the flow network, only considering the local lake links
-                ups = [FromSegs.get(key) for key in ups if key in Lake_LinksList]   # Move upstream in the flow network, only considering the local lake links (not inflows links)
+                ups = [FromSegs.get(key) for key in ups if key in Lake_LinksSet]    # Move upstream in the flow network, only considering the local lake links (not inflows links)
                 ups = [item for sublist in ups if sublist is not None for item in sublist]  # Flatten list including None values
             counter3 += len(Remove_local)                                       # Iterate counter to keep track of lake association removals
-            Remove_Association += Remove_local                                  # Add these networks that drain to a secondary lake outlet to the association removal list
+            Remove_Association[LakeID] = Remove_local                           # Add these networks that drain to a secondary lake outlet to the association removal list
 
             # Before eliminating this lake, save the information in a separate table
-            arrsize = Tossed_Lake_Link_Type_arr.shape[0]                        # Get current length of the array
-            maskList = numpy.array([True if item in Remove_local else False for item in Lake_LinksList2])   # Create a mask list to mask other lists with
-            Tossed_Lake_Link_Type_arr.resize(arrsize + maskList.sum(), refcheck=False)              # Add rows to the recarray to store new data
-            Tossed_Lake_Link_Type_arr[FLID][arrsize:] = numpy.array(Lake_LinksList2)[maskList]      # Add Lake_LinksList to the list
-            Tossed_Lake_Link_Type_arr['LINK_TYPE'][arrsize:] = numpy.array(Lake_Link_Type_local)[maskList] # Add Lake Link Types
-            Tossed_Lake_Link_Type_arr[LakeAssociation][arrsize:] = [LakeID for item in Remove_local]      # Add WBAREACOMI lake associations
-            Tossed_Lake_Link_Type_arr['Accum1'][arrsize:] = numpy.array(Accum1_local)[maskList]     # Added 2/17/2018 to keep track of lake local accumulation
-            Tossed_Lake_Link_Type_arr['Accum2'][arrsize:] = numpy.array(Accum2_local)[maskList]     # Added 2/17/2018 to keep track of lake local accumulation
-            Tossed_Lake_Link_Type_arr['Reason'][arrsize:] = 1                   # Reason: 'Potentially multiple outlets. Secondary Outlets: %s' %(outflows)
+            Remove_set = set(Remove_local)
+            maskList = numpy.array([item in Remove_set for item in Lake_LinksList2], dtype=bool)   # Create a mask list to mask other lists with
+            Tossed_block = numpy.zeros(maskList.sum(), dtype=dtype2)            # Block of rows to store new data
+            Tossed_block[FLID] = numpy.array(Lake_LinksList2)[maskList]         # Add Lake_LinksList to the list
+            Tossed_block['LINK_TYPE'] = numpy.array(Lake_Link_Type_local)[maskList] # Add Lake Link Types
+            Tossed_block[LakeAssociation] = LakeID                              # Add WBAREACOMI lake associations
+            Tossed_block['Accum1'] = numpy.array(Accum1_local)[maskList]        # Added 2/17/2018 to keep track of lake local accumulation
+            Tossed_block['Accum2'] = numpy.array(Accum2_local)[maskList]        # Added 2/17/2018 to keep track of lake local accumulation
+            Tossed_block['Reason'] = 1                                          # Reason: 'Potentially multiple outlets. Secondary Outlets: %s' %(outflows)
+            Tossed_blocks.append(Tossed_block)
+            del Remove_set, Tossed_block
 
             # Use a reverse the masklist to remove these minor network elements draining to false outlets from the rest of the data
             Lake_LinksList2 = numpy.array(Lake_LinksList2)[~maskList].tolist()              # Subset the list to exclude the networks draining to a minor outlet
@@ -3984,7 +5749,7 @@ def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=Lake
                 print('        Link with maximum flow drains to ocean or internally')
             #Lake_Link_Type_local = [1 if com==maxflow else LT for com,LT in zip(Lake_LinksList2, Lake_Link_Type_local)]    # Test to see if lakes that flow to a nodata point can be kept in WRF-Hydro
             counter7 += 1                                                       # Advance the counter
-        elif FLWBarr[FLWBarr[FLID]==FromComIDs.get(maxflow)].shape[0] > 0:      # This is a downstream lake
+        elif FromComIDs.get(maxflow) in Link_Row:                               # This is a downstream lake
             # This is a real downstream segment
             problem_lakes = set_problem(problem_lakes, LakeID, 'Downstream of outlet segment is a lake segment')
             if debug:
@@ -4002,14 +5767,15 @@ def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=Lake
             counter8 += 1                                                       # Advance the counter
 
             # Before eliminating this lake, save the information in a separate table
-            arrsize = Tossed_Lake_Link_Type_arr.shape[0]                        # Get current length of the array
-            Tossed_Lake_Link_Type_arr.resize(arrsize + len(Lake_LinksList2), refcheck=False)    # Add rows to the recarray to store new data
-            Tossed_Lake_Link_Type_arr[FLID][arrsize:] = Lake_LinksList2         # Add Lake_LinksList to the list
-            Tossed_Lake_Link_Type_arr['LINK_TYPE'][arrsize:] = Lake_Link_Type_local         # Add Lake Link Types
-            Tossed_Lake_Link_Type_arr[LakeAssociation][arrsize:] = [LakeID for item in Lake_LinksList2]         # Add WBAREACOMI lake associations
-            Tossed_Lake_Link_Type_arr['Accum1'][arrsize:] = Accum1_local        # Added 2/17/2018 to keep track of lake local accumulation
-            Tossed_Lake_Link_Type_arr['Accum2'][arrsize:] = Accum2_local        # Added 2/17/2018 to keep track of lake local accumulation
-            Tossed_Lake_Link_Type_arr['Reason'][arrsize:] = 2                   # Reason: 'This lake has no type=1 (outlet) link in it. Eliminating...'
+            Tossed_block = numpy.zeros(len(Lake_LinksList2), dtype=dtype2)      # Block of rows to store new data
+            Tossed_block[FLID] = Lake_LinksList2                                # Add Lake_LinksList to the list
+            Tossed_block['LINK_TYPE'] = Lake_Link_Type_local                    # Add Lake Link Types
+            Tossed_block[LakeAssociation] = LakeID                              # Add WBAREACOMI lake associations
+            Tossed_block['Accum1'] = Accum1_local                               # Added 2/17/2018 to keep track of lake local accumulation
+            Tossed_block['Accum2'] = Accum2_local                               # Added 2/17/2018 to keep track of lake local accumulation
+            Tossed_block['Reason'] = 2                                          # Reason: 'This lake has no type=1 (outlet) link in it. Eliminating...'
+            Tossed_blocks.append(Tossed_block)
+            del Tossed_block
             continue                                                            # Added 2/15/2018 as a test to eliminate these lakes from RouteLink
 
         # Iterate the lake counter and print a statement every so often
@@ -4026,18 +5792,168 @@ def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=Lake
         Lake_Link_Type_Accum2 += Accum2_local                                   # Added 2/17/2018 to keep track of lake local accumulation
         del Lake_Link_Type_local
 
-    # Subset Lake_Link_Type_arr to just the links in XXX
+    # Assemble the outputs
     Lake_Link_Type_arr = numpy.zeros(len(Lake_Link_Type_COMID), dtype=dtype1)
     Lake_Link_Type_arr[FLID] = Lake_Link_Type_COMID                             # Populate with lake COMIDs
     Lake_Link_Type_arr['LINK_TYPE'] = Lake_Link_Type                            # Add Lake Link Types
     Lake_Link_Type_arr[LakeAssociation] = Lake_Link_Type_WBAREACOMI                   # Add WBAREACOMI lake associations
     Lake_Link_Type_arr['Accum1'] = Lake_Link_Type_Accum1                        # Add unrouted lake accumulation
     Lake_Link_Type_arr['Accum2'] = Lake_Link_Type_Accum2                        # Add routed lake accumulation
-    del Lake_Link_Type_COMID, Lake_Link_Type, Lake_Link_Type_WBAREACOMI, dtype1, dtype2, Lake_LinkDict
+    if len(Tossed_blocks) > 0:
+        Tossed_Lake_Link_Type_arr = numpy.concatenate(Tossed_blocks)            # Assemble all tossed lake values at once
+    else:
+        Tossed_Lake_Link_Type_arr = numpy.empty(0, dtype=dtype2)                # Generate new empty array to store tossed lake values
+    counters = (counter, counter3, counter4, counter5, counter6, counter7, counter8)
+    del Lake_Link_Type_COMID, Lake_Link_Type, Lake_Link_Type_WBAREACOMI, dtype1, dtype2, Lake_LinkDict, Tossed_blocks, Link_Row, LakeRows, FromSegs
+    return Lake_Link_Type_arr, problem_lakes, seen, ChainedLakes, Old_New_LakeComID, FLWBarr, Remove_Association, Tossed_Lake_Link_Type_arr, counters
+
+def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=LakeAssoc, processes=None):
+    '''
+    This function will assign a link type to each lake.
+            3 = Lake Inflow Link
+            2 = Internal Lake Link
+            1 = Lake Outflow Link (based on accumulated flow in the lake)
+
+    This function sorts the lakes by the minimum HydrSeq of all links associated
+    with that lake. Thus, theoretically, lakes can be visited by increasing HydroSeq
+    and no downstream searching for lakes should be necessary. ...
+
+    This function will examine each lake and determine the outlets based on an
+    accumulation of values through the topology of links within the lake. It will
+    identify lakes with (potentially) multiple outlets, as well as internally
+    draining lakes. Lakes with multiple outlets according to flow accumulation
+    within the lake will have the minor outlets removed.
+
+    2/16/2018: This function finally diagnoses all potential conflicts with WRF-Hydro.
+        In the "for LakeID in LakeIDs:" loop (classify_lakes), any continue statements will
+        eliminate that lake from being placed on the flow network. Conditions that
+        prevent a lake from functioning in WRF-Hydro are:
+            1) The lake has no Lake Link Type of 1 (outlet link). This seems to
+               occur when a lake has only one interior link, or when all interior
+               links flow directly to a nonexistent outlet link (endorheic).
+            2) A lake flows directly into another lake.
+            3) Multiple outlet links are defined
+
+    Lakes are processed using indexed structures: the links of each lake are
+    looked up through a lake:rows index (lake_link_groups) that is kept in sync
+    with FLWBarr as lakes are merged, flowlines are located through a link:row
+    index, and membership tests use sets. Tossed lake links are collected in
+    blocks and assembled once at the end.
+
+    If processes > 1 (default: LakeProcesses), lakes are partitioned into groups
+    that share no part of the flow network (lake_groups), and the groups are
+    classified concurrently in a process pool (classify_lakes). Since lakes in
+    different groups can never be merged or examine each other's flowlines, the
+    results are merged back into HydroSeq order and are identical to a serial run.
+    '''
+
+    print('        Starting to gather lake link type information.')
+
+    # Options and defaults
+    tic1 = time.time()                                                          # Initiate timer for this function
+    if processes is None:
+        processes = LakeProcesses                                               # Number of processes used to classify independent groups of lakes
+
+    # 1) Create a sorting of lakes that will start with the lake which has the lowest HydroSeq value in it's flowlines
+    # Use indexing to grab elements common to both arrays while preserving order of one of the arrays (FLWBarr)
+    tic2 = time.time()
+    commons = FLarr[numpy.isin(FLarr[FLID], FLWBarr[FLID])]                     # An array of all of the flowlines in the flowline array that are common to the flowline-waterbody association array
+    xsorted = numpy.argsort(commons[FLID])                                      # Find the sorted order for the array that is to be sorted
+    ypos = numpy.searchsorted(commons[xsorted][FLID], FLWBarr[numpy.isin(FLWBarr[FLID], FLarr[FLID])][FLID]) # Search only the common values between arrays
+    indices = xsorted[ypos]
+    commons2 = commons[indices]                                                 # Re-order the input array to match the comparison array order
+    del commons, xsorted, ypos, indices
+
+    # Use the group_min function to find the minimum HydroSeq value for each group of WBAREACOMID values
+    group_minDict = group_min(commons2[hydroSeq], FLWBarr[LakeAssociation])     # Find the minimum HydroSeq value for this lake
+    del commons2                                                                # Free up memory
+
+    # Construct an array to store the Lake COMID and Minimum Hydrosequence
+    dtype = dict(names=(FLID, 'minHydroSeq'), formats=('<i4', '<f8'))
+    LakeSeq = numpy.array(list(group_minDict.items()), dtype=dtype)             # Create array of minimum HydroSeq values for each lake
+    del group_minDict, dtype                                                    # Free up memory
+    LakeSeq = LakeSeq[LakeSeq[FLID]>-9998]                                      # Clip off -9999, -9998
+    LakeSeq.sort(order='minHydroSeq')                                           # Sort by minimum HydroSeq
+    LakeSeqsize = LakeSeq.shape[0]                                              # Get the number of elements in the array
+    print('        Completed sorting lakes by minimum HydroSeq in {0:3.2f} seconds.'.format(time.time()-tic2))
+
+    if subset is not None:
+        LakeSeq = LakeSeq[numpy.isin(LakeSeq[FLID], subset[FLID])]              # Subset the list of lakes to a subset array if requested
+        print('        Subsetted the lakes from {0} to {1} based on a provided subset array.'.format(LakeSeqsize, LakeSeq.shape[0]))
+
+    LakeIDs = LakeSeq[FLID]
+
+    # 2) Classify the lakes, either in a single pass or by independent groups of lakes
+    tic2 = time.time()
+    groups = None
+    if processes > 1 and LakeIDs.shape[0] > 1:
+        links, tos, basins = network_basins(FromComIDs)
+        if basins is None:
+            print('        Flow network contains a loop. Lakes will be examined in a single process.')
+        else:
+            groups, Lake_Group, basin_groups = lake_groups(FLWBarr, links, basins, LakeAssociation=LakeAssociation)
+            print('        Partitioned {0} lakes into {1} independent groups in {2:3.2f} seconds.'.format(len(Lake_Group), len(groups), time.time()-tic2))
+            if len(groups) < 2:
+                groups = None
+
+    if groups is None:
+        results = [classify_lakes(FLWBarr, FromComIDs, LakeIDs, LakeAssociation=LakeAssociation)]
+        Lake_Link_Type_arr, problem_lakes, seen, ChainedLakes, Old_New_LakeComID, FLWBarr, Remove_Association, Tossed_Lake_Link_Type_arr, counters = results[0]
+    else:
+        # Balance the groups among the jobs, largest groups first
+        njobs = min(len(groups), processes*4)
+        job_loads = [0]*njobs
+        Group_Job = {}
+        for label in sorted(groups, key=lambda label: (-groups[label], label)):
+            job = job_loads.index(min(job_loads))
+            Group_Job[label] = job
+            job_loads[job] += groups[label]
+        Lake_Job = {lake:Group_Job[label] for lake, label in Lake_Group.items()}
+        basin_job = numpy.full(links.shape[0], -1)
+        for basin, label in basin_groups.items():
+            basin_job[basin] = Group_Job[label]
+        link_jobs = basin_job[basins]                                           # Job for every flowline in the network (-1 if no lakes)
+
+        # Subset the inputs for each job
+        row_jobs = numpy.array([Lake_Job[lake] for lake in FLWBarr[LakeAssociation].tolist()])
+        LakeID_jobs = numpy.array([Lake_Job[lake] for lake in LakeIDs.tolist()])
+        job_rows = [numpy.flatnonzero(row_jobs == job) for job in range(njobs)]
+        job_FLWBarr = [FLWBarr[rows] for rows in job_rows]
+        job_FromComIDs = [dict(zip(links[link_jobs == job].tolist(), tos[link_jobs == job].tolist())) for job in range(njobs)]
+        job_LakeIDs = [LakeIDs[LakeID_jobs == job] for job in range(njobs)]
+        del links, tos, basins, basin_job, link_jobs, Lake_Job, Lake_Group, basin_groups, Group_Job, row_jobs, LakeID_jobs
+
+        print('        Classifying {0} groups of lakes in {1} jobs using {2} processes.'.format(len(groups), njobs, processes))
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(classify_lakes, job_FLWBarr, job_FromComIDs, job_LakeIDs, [LakeAssociation]*njobs))
+        del job_FLWBarr, job_FromComIDs, job_LakeIDs
+
+        # Merge the results back into the order in which lakes would have been examined in a single pass
+        LakePos = dict(zip(LakeIDs.tolist(), range(LakeIDs.shape[0])))          # Position of each lake in the HydroSeq order
+        def lake_order(lakes):
+            return numpy.argsort(numpy.array([LakePos[lake] for lake in lakes], dtype=numpy.int64), kind='stable')
+        for rows, result in zip(job_rows, results):
+            FLWBarr[LakeAssociation][rows] = result[5][LakeAssociation]         # Merged lake IDs for this group
+        Lake_Link_Type_arr = numpy.concatenate([result[0] for result in results])
+        Lake_Link_Type_arr = Lake_Link_Type_arr[lake_order(Lake_Link_Type_arr[LakeAssociation].tolist())]
+        Tossed_Lake_Link_Type_arr = numpy.concatenate([result[7] for result in results])
+        Tossed_Lake_Link_Type_arr = Tossed_Lake_Link_Type_arr[lake_order(Tossed_Lake_Link_Type_arr[LakeAssociation].tolist())]
+        problem_lakes = dict(sorted([item for result in results for item in result[1].items()], key=lambda item: LakePos[item[0]]))
+        ChainedLakes = dict(sorted([item for result in results for item in result[3].items()], key=lambda item: LakePos[item[0]]))
+        Old_New_LakeComID = dict(sorted([item for result in results for item in result[4].items()], key=lambda item: LakePos[item[1]]))
+        Remove_Association = dict(sorted([item for result in results for item in result[6].items()], key=lambda item: LakePos[item[0]]))
+        seen = [lake for result in results for lake in result[2]]
+        seen = [seen[idx] for idx in lake_order([Old_New_LakeComID.get(lake, lake) for lake in seen])]
+        counters = numpy.array([result[8] for result in results]).sum(axis=0).tolist()
+        del job_rows, LakePos
+    counter, counter3, counter4, counter5, counter6, counter7, counter8 = counters
+    Remove_Association = [link for links in Remove_Association.values() for link in links]   # List used to remove a lake association from a flowline (for divergences in lakes)
+    print('        Completed lake classification in {0:3.2f} seconds.'.format(time.time()-tic2))
+    del results, groups, counters
 
     # Remove WBAREACOMI association for the multiple outlets (other than that with max flow)
-    FLWBarr = FLWBarr[~numpy.in1d(FLWBarr[FLID], numpy.array(Remove_Association))]   # Remove from the array any items that need the association removed
-    Lake_Link_Type_arr[LakeAssociation][numpy.in1d(Lake_Link_Type_arr[FLID], numpy.array(Remove_Association))] = 0  # Old Way (left alot of zeros) Remove WBAREACOMI lake associations
+    FLWBarr = FLWBarr[~numpy.isin(FLWBarr[FLID], numpy.array(Remove_Association))]   # Remove from the array any items that need the association removed
+    Lake_Link_Type_arr[LakeAssociation][numpy.isin(Lake_Link_Type_arr[FLID], numpy.array(Remove_Association))] = 0  # Old Way (left alot of zeros) Remove WBAREACOMI lake associations
     Lake_Link_Type_arr = Lake_Link_Type_arr[Lake_Link_Type_arr[LakeAssociation]!= 0]  # Now remove all lake associations with lake ID = 0 (added 2/14/2018)
 
     # Clean up and return
@@ -4050,12 +5966,20 @@ def Lake_Link_Type(FLWBarr, FromComIDs, FLarr, subset=None, LakeAssociation=Lake
     print('        Examined {0} lakes in {1:3.2f} seconds.'.format(len(seen), time.time()-tic1))
     return Lake_Link_Type_arr, problem_lakes, seen, ChainedLakes, Old_New_LakeComID, FLWBarr, Remove_Association, Tossed_Lake_Link_Type_arr
 
-def Waterbody_SpatialJoin(in_RL, in_Lakes, link_ID_field, lake_ID_field, quiet=True):
+def Waterbody_SpatialJoin(in_RL, in_Lakes, link_ID_field, lake_ID_field, quiet=True, lakes_layer_name=None, chunk_size=None):
     '''
     3/28/2023
     This function performs a simple intersection between the flowline midpoint
     geometry defined in RouteLink.nc and the waterbodies. The output is a dictionary
     of waterbodies that intersect each flowline midpoint.
+
+    The flowline points are loaded once into a Shapely STRtree, and the lakes are
+    queried against it in bulk. Set 'chunk_size' to a number of lakes to process
+    the lakes in chunks of that size, which bounds memory for very large
+    waterbody datasets.
+
+    If the waterbodies are a layer in a multi-layer data source (GeoPackage),
+    provide the layer name using 'lakes_layer_name'.
     '''
 
     tic1 = time.time()
@@ -4063,7 +5987,10 @@ def Waterbody_SpatialJoin(in_RL, in_Lakes, link_ID_field, lake_ID_field, quiet=T
 
     # Open the lakes file
     lakes_ds = ogr.Open(in_Lakes, 0)
-    lakes_lyr = lakes_ds.GetLayerByIndex(0)
+    if lakes_layer_name is None:
+        lakes_lyr = lakes_ds.GetLayerByIndex(0)
+    else:
+        lakes_lyr = lakes_ds.GetLayerByName(lakes_layer_name)
     lakes_srs = lakes_lyr.GetSpatialRef()
     lakes_LayerDef = lakes_lyr.GetLayerDefn()
     print('    Input lakes layer has {0} features.'.format(lakes_lyr.GetFeatureCount()))
@@ -4086,49 +6013,78 @@ def Waterbody_SpatialJoin(in_RL, in_Lakes, link_ID_field, lake_ID_field, quiet=T
         link_srs.SetAxisMappingStrategy(osgeo.osr.OAMS_TRADITIONAL_GIS_ORDER)
 
     # Check if a coordinate transformation (projection) must be performed
+    trans = False
+    link_extent = link_lyr.GetExtent()                                          # (minX, maxX, minY, maxY)
+    link_bounds = (link_extent[0], link_extent[2], link_extent[1], link_extent[3])  # (minX, minY, maxX, maxY)
     if not lakes_srs.IsSame(link_srs):
         print('    Input shapefile projection does not match requested output. Transformatin will be applied to lakes.')
         coordTrans = osr.CoordinateTransformation(lakes_srs, link_srs)
         trans = True
-
-    # Attempt using a grid layer returned by the gridder object
+        coordTrans_inv = osr.CoordinateTransformation(link_srs, lakes_srs)
+        if hasattr(coordTrans_inv, 'TransformBounds'):                          # GDAL >= 3.4
+            link_bounds = coordTrans_inv.TransformBounds(*link_bounds, 21)
+        else:
+            link_bounds = None
+        coordTrans_inv = None
+
+    # Only consider lakes within the extent of the flowlines. This uses the
+    # spatial index if one exists on the lakes layer (GeoPackage R-tree).
+    if link_bounds is not None:
+        lakes_lyr.SetSpatialFilterRect(*link_bounds)
+
+    # Read the flowline points once and build a spatial index (STRtree) on them
+    link_lyr.SetIgnoredFields([fname for fname in link_fieldNames if fname != link_ID_field])
+    link_IDs = []
+    link_xy = []
+    for link_feature in link_lyr:
+        link_IDs.append(link_feature.GetField(link_ID_field))
+        link_geom = link_feature.GetGeometryRef()
+        link_xy.append((link_geom.GetX(), link_geom.GetY()))
+        link_feature = link_geom = None
+    link_lyr.ResetReading()
+    link_IDs = numpy.array(link_IDs)
+    link_points = shapely.points(numpy.array(link_xy, dtype=numpy.float64).reshape(-1, 2))
+    link_tree = shapely.STRtree(link_points)
+    del link_xy
+
+    def join_lakes(lake_IDs, lake_wkbs):
+        # Bulk query of one set of lakes against the flowline points. The query
+        # prepares each lake geometry and returns all (lake, point) pairs where
+        # the lake contains the point, i.e. the point is within the lake.
+        lake_geoms = shapely.from_wkb(lake_wkbs)
+        if trans:
+            lake_geoms = transform_geometries(lake_geoms, coordTrans)           # Transform all lakes in the chunk at once
+        shapely.prepare(lake_geoms)
+        lake_idx, point_idx = link_tree.query(lake_geoms, predicate='contains')
+        if not quiet:
+            counts = numpy.bincount(lake_idx, minlength=len(lake_IDs))
+            for lake_id, point_counter in zip(lake_IDs, counts.tolist()):
+                print('        Found {0} points inside lake {1}'.format(point_counter, lake_id))
+        order = numpy.argsort(lake_idx, kind='stable')                          # Later lakes take precedence, as in layer order
+        for lake_num, link_id in zip(lake_idx[order].tolist(), link_IDs[point_idx[order]].tolist()):
+            WaterbodyDict[link_id] = [lake_IDs[lake_num]]
+
+    # Read the lakes, optionally in chunks to bound memory, and join each chunk
     counter = 0
     WaterbodyDict = {}
+    lake_IDs = []
+    lake_wkbs = []
     for lake_feature in lakes_lyr:
-
-        lake_id = lake_feature.GetField(lake_ID_field)
-        counter += 1
         lake_geometry = lake_feature.GetGeometryRef()
-        polygon_area = lake_geometry.GetArea()
-        if not quiet:
-            print('        Input Lake [{0}] area: {1}.'.format(lake_id, polygon_area))
-
-        if trans:
-            lake_geometry.Transform(coordTrans)
-
-        # Set spatial filter to limit how many points are considered
-        link_lyr.SetSpatialFilter(lake_geometry)
-        if not quiet:
-            print('        Input RouteLink layer has {0} features after spatial filter.'.format(link_lyr.GetFeatureCount()))
-
-        # Find intersecting geometries
-        point_counter = 0
-        for link_feature in link_lyr:
-            link_id = link_feature.GetField(link_ID_field)
-            link_geom = link_feature.GetGeometryRef()
-            if link_geom.Within(lake_geometry):
-                point_counter += 1
-                WaterbodyDict[link_id] = [lake_id]
-            link_feature = link_geom = None
-            del link_feature, link_id, link_geom
-        if not quiet:
-            print('        Found {0} points inside lake {1}'.format(point_counter, lake_id))
-
-        # Remove spatial filter for next iteration
-        link_lyr.SetSpatialFilter(None)
-        link_lyr.ResetReading()
+        if lake_geometry is None:
+            continue
+        lake_IDs.append(lake_feature.GetField(lake_ID_field))
+        lake_wkbs.append(bytes(lake_geometry.ExportToWkb()))
+        counter += 1
         lake_feature = lake_geometry = None
-        del lake_id, point_counter, polygon_area
+        if chunk_size is not None and len(lake_IDs) >= chunk_size:
+            join_lakes(lake_IDs, lake_wkbs)
+            lake_IDs = []
+            lake_wkbs = []
+    if len(lake_IDs) > 0:
+        join_lakes(lake_IDs, lake_wkbs)
+    print('    Intersected {0} lakes with {1} flowline points.'.format(counter, link_IDs.shape[0]))
+    del lake_IDs, lake_wkbs, link_IDs, link_points, link_tree
 
     # Clean up
     if trans:
@@ -4139,7 +6095,7 @@ def Waterbody_SpatialJoin(in_RL, in_Lakes, link_ID_field, lake_ID_field, quiet=T
     print('    Finished intersecting flowline network with waterbodies in {0:3.2f}s'.format(time.time()-tic1))
     return WaterbodyDict
 
-def LK_main(outDir, Flowline, Waterbody, link_ID_field, lake_ID_field, Subset_arr=None, datestr=datestr, LakeAssociation=LakeAssoc, update_RL=True, update_LK=True):
+def LK_main(outDir, Flowline, Waterbody, link_ID_field, lake_ID_field, Subset_arr=None, datestr=datestr, LakeAssociation=LakeAssoc, update_RL=True, update_LK=True, Waterbody_layer=None, incremental=False, LakeNC=None):
     '''
     This is the main lake pre-processing function, but written for open-source GIS pre-processing
 
@@ -4151,6 +6107,13 @@ def LK_main(outDir, Flowline, Waterbody, link_ID_field, lake_ID_field, Subset_ar
     Subset_arr          A numpy array with which to subset the lake list
     datestr             A string giving the current date, for file naming
     LakeAssociation     The fielname to use for ???
+    Waterbody_layer     The layer name in the Waterbody data source, if it is a multi-layer format (GeoPackage)
+    incremental         If True, Waterbody contains only lakes being added to an existing routing stack
+                        (see add_reservoirs_incremental). The lakes in Subset_arr are evaluated in the
+                        context of the existing RouteLink lake associations, along with the existing
+                        lakes immediately upstream or downstream of them so that adjacent lakes are
+                        merged. Only the affected RouteLink links and LAKEPARM lakes are changed.
+    LakeNC              The LAKEPARM file to subset. Default is LAKEPARM.nc in outDir.
     '''
 
     # Setup Logging
@@ -4160,13 +6123,36 @@ def LK_main(outDir, Flowline, Waterbody, link_ID_field, lake_ID_field, Subset_ar
     if Flowline is not None:
         # This is the normal case. The user wishes to evaluate flowline:waterbody associations for either a flowline feature class
         # which has the associations specified, or perform a spatial join between those flowlines and a Waterbody feature class.
-        WaterbodyDict = Waterbody_SpatialJoin(Flowline, Waterbody, link_ID_field, lake_ID_field, quiet=True)
+        WaterbodyDict = Waterbody_SpatialJoin(Flowline, Waterbody, link_ID_field, lake_ID_field, quiet=True, lakes_layer_name=Waterbody_layer)
     elif isinstance(Waterbody, dict):
         # This is the case where the user is only wishing to submit a dictionary of flowline:waterbody associations for evaluation
         # Thus, choose Flowline=None and Waterbody=WaterbodyDict in the main() function arguments.
         # Populate dictionary of all flowline/lake intersections
         WaterbodyDict = {item[0]:[item[1]] for item in Waterbody.items()}       # Convert to lists
 
+    # Add the existing flowline:lake associations so that new lakes are evaluated in their context
+    if incremental:
+        rootgrp = netCDF4.Dataset(Flowline, 'r')
+        RL_links = numpy.array(rootgrp.variables['link'][:])
+        RL_tos = numpy.array(rootgrp.variables['to'][:])
+        RL_lakes = numpy.array(rootgrp.variables['NHDWaterbodyComID'][:])
+        rootgrp.close()
+        existing = (RL_lakes > 0)
+        WaterbodyDict.update({link:[lake] for link,lake in zip(RL_links[existing].tolist(), RL_lakes[existing].tolist())})  # Existing lakes take precedence
+        print('        Added {0} existing flowline:lake associations.'.format(existing.sum()))
+
+        # Evaluate the existing lakes immediately downstream and upstream of the new lakes along with them,
+        # so that a new lake flowing directly into an existing lake (or vice versa) is merged.
+        new_ids = set(Subset_arr[FLID].tolist())
+        new_links = [link for link,lakes in WaterbodyDict.items() if lakes[0] in new_ids]
+        neighbors = numpy.isin(RL_links, RL_tos[numpy.isin(RL_links, new_links)])   # Links downstream of new lake links
+        neighbors |= numpy.isin(RL_tos, new_links)                              # Links upstream of new lake links
+        neighbor_ids = set(RL_lakes[neighbors & existing].tolist()) - new_ids
+        if len(neighbor_ids) > 0:
+            print('        Evaluating {0} existing lakes adjacent to new lakes: {1}'.format(len(neighbor_ids), sorted(neighbor_ids)))
+            Subset_arr = numpy.array(sorted(new_ids | neighbor_ids), dtype=Subset_arr.dtype)
+        del rootgrp, RL_links, RL_tos, RL_lakes, existing, new_ids, new_links, neighbors, neighbor_ids
+
     # Prepare inputs for the Lake_Link_Type function
     rootgrp = netCDF4.Dataset(Flowline, 'r')
     FromComIDs = {link:to for link,to in zip(rootgrp.variables['link'][:],rootgrp.variables['to'][:])}
@@ -4237,51 +6223,81 @@ def LK_main(outDir, Flowline, Waterbody, link_ID_field, lake_ID_field, Subset_ar
         # Add lake association information into RouteLink
         rootgrp_RL = netCDF4.Dataset(in_RL, 'r+')
         variables_RL = rootgrp_RL.variables
-        RL_lakes = numpy.array([WaterbodyDict.get(link, NoDataVal) for link in variables_RL['link'][:]])
+        if incremental:
+            # Only change the links of the lakes that were evaluated, and of any existing lakes merged into them
+            RL_links = variables_RL['link'][:]
+            RL_lakes = numpy.array(variables_RL['NHDWaterbodyComID'][:])
+            RL_lakes[numpy.isin(RL_lakes, Subset_arr[FLID].tolist() + list(Old_New_LakeComID.keys()))] = NoDataVal
+            update = numpy.isin(RL_links, list(WaterbodyDict.keys()))
+            RL_lakes[update] = [WaterbodyDict[link] for link in RL_links[update].tolist()]
+            print('      Updated lake association on {0} flowlines.'.format(update.sum()))
+            del RL_links, update
+        else:
+            RL_lakes = numpy.array([WaterbodyDict.get(link, NoDataVal) for link in variables_RL['link'][:]])
         rootgrp_RL.variables['NHDWaterbodyComID'][:] = RL_lakes
         rootgrp_RL.close()
         del rootgrp_RL, variables_RL, RL_lakes
 
         # Add lake association to output streams layer
-        streams_vector_file = os.path.join(outDir, streams_vector)
+        streams_vector_file, streams_lyr_name, driver_name = vector_output(outDir, streams_vector)
         print('      Updating the streams shapefile to include waterbody associations.')
         if os.path.exists(streams_vector_file):
             data_source = ogr.Open(streams_vector_file, 1)
-            lyr = data_source.GetLayer()
-            for feature in lyr:
-                flowline_id = int(feature.GetField(link_ID_field))
-                if flowline_id in WaterbodyDict:
-                    feature.SetField("LakeID", int(WaterbodyDict.get(flowline_id, NoDataVal)))
+            lyr = data_source.GetLayerByName(streams_lyr_name)
+
+            # Read only the link ID column to find the features that belong to a
+            # lake, then rewrite just those features rather than the whole layer.
+            lyrDefn = lyr.GetLayerDefn()
+            lyr.SetIgnoredFields([lyrDefn.GetFieldDefn(num).GetName() for num in range(lyrDefn.GetFieldCount())
+                                    if lyrDefn.GetFieldDefn(num).GetName() != link_ID_field] + ['OGR_GEOMETRY', 'OGR_STYLE'])
+            update_fids = [(feature.GetFID(), int(feature.GetField(link_ID_field))) for feature in lyr]
+            update_fids = [(fid, flowline_id) for fid, flowline_id in update_fids if flowline_id in WaterbodyDict]
+            lyr.SetIgnoredFields([])
+            lyr.StartTransaction()
+            for fid, flowline_id in update_fids:
+                feature = lyr.GetFeature(fid)
+                feature.SetField("LakeID", int(WaterbodyDict[flowline_id]))
                 lyr.SetFeature(feature)
                 feature = None
-            data_source = lyr = None
+            lyr.CommitTransaction()
+            print('      Updated LakeID on {0} stream features.'.format(len(update_fids)))
+            data_source = lyr = lyrDefn = None
+            del update_fids
 
     update_LK = True
     if update_LK:
         print('      Subsetting the LAKEPARM (if necessary) to include only valid waterbodies.')
-        LakeNC = os.path.join(outDir, LK_nc)
-        print('      Using LAKEPARM file from temporary directory: {0}'.format(LakeNC))
-
-        # Subset the LAKEPARM file by building a new one with a subset of the old values
-        lk_subsetList = list(set(WaterbodyDict.values()))               # List of lakes to keep in LAKEPARM
-        min_elevs, areas, max_elevs, OrificEs, cen_lats, cen_lons, WeirE_vals = obtain_LakeParameters(LakeNC,
-                                                                                                        subsetList=lk_subsetList)
-        build_LAKEPARM(LakeNC, min_elevs, areas, max_elevs, OrificEs, cen_lats, cen_lons, WeirE_vals)
-        del min_elevs, areas, max_elevs, OrificEs, cen_lats, cen_lons, WeirE_vals
-
-        out_lakes = out_lakes = os.path.join(outDir, LakesSHP)
+        if LakeNC is None:
+            LakeNC = os.path.join(outDir, LK_nc)
+        print('      Using LAKEPARM file: {0}'.format(LakeNC))
+
+        if incremental:
+            # Keep the existing lakes that were not merged, and the new lakes found on the network.
+            # The LAKEPARM file is subset in place so that existing lake parameters are preserved.
+            rootgrp_LK = netCDF4.Dataset(LakeNC, 'r')
+            LK_ids = set(rootgrp_LK.variables['lake_id'][:].tolist())
+            rootgrp_LK.close()
+            LK_ids -= set(Subset_arr[FLID].tolist()) | set(Old_New_LakeComID.keys())
+            lk_subsetList = list(LK_ids | set(WaterbodyDict.values()))  # List of lakes to keep in LAKEPARM
+            update_LAKEPARM(LakeNC, keep_ids=lk_subsetList)
+            del rootgrp_LK, LK_ids
+        else:
+            # Subset the LAKEPARM file by building a new one with a subset of the old values
+            lk_subsetList = list(set(WaterbodyDict.values()))               # List of lakes to keep in LAKEPARM
+            min_elevs, areas, max_elevs, OrificEs, cen_lats, cen_lons, WeirE_vals = obtain_LakeParameters(LakeNC,
+                                                                                                            subsetList=lk_subsetList)
+            build_LAKEPARM(LakeNC, min_elevs, areas, max_elevs, OrificEs, cen_lats, cen_lons, WeirE_vals)
+            del min_elevs, areas, max_elevs, OrificEs, cen_lats, cen_lons, WeirE_vals
+
+        out_lakes, lakes_lyr_name, driver_name = vector_output(outDir, LakesSHP)
         if os.path.exists(out_lakes):
             # Remove any lakes from the output feature class
             print('      Removing lakes from lakes shapefile that are not on the vector channel network')
             lake_ds = ogr.Open(out_lakes, 1)
-            lake_layer = lake_ds.GetLayer()
-            for feature in lake_layer:
-                idval = feature.GetField(lake_ID_field)
-                if idval not in lk_subsetList:
-                    lake_layer.DeleteFeature(feature.GetFID())
-            lake_layer.ResetReading()
-            lake_ds = lake_layer = None
-            del lk_subsetList, lake_ds, lake_layer
+            num_deleted = delete_features(lake_ds, lakes_lyr_name, lake_ID_field, lk_subsetList)
+            print('      Removed {0} lakes from {1}.'.format(num_deleted, lakes_lyr_name))
+            lake_ds = None
+            del lk_subsetList, lake_ds, num_deleted
 
     # Clean up and return
     del Subset_arr, dtype, problem_lakes, seen, ChainedLakes, Remove_Association, FLWBarr
@@ -4310,26 +6326,31 @@ def obtain_LakeParameters(in_NC, subsetList=None):
     # Assemble dictionaries
     IDs = ncVars['lake_id'][:]
 
-    # If no subset list is given, use all IDs
-    if not subsetList:
-        subsetList = IDs.tolist()
+    # If no subset list is given, use all IDs. Otherwise build a single mask over the LAKEPARM arrays.
+    if subsetList is None or len(subsetList) == 0:
+        mask = numpy.ones(IDs.shape, dtype=bool)
+    else:
+        mask = numpy.isin(IDs, numpy.asarray(list(subsetList)))
+    IDs = IDs[mask]
+    LkMxE = ncVars['LkMxE'][:][mask]
+    OrificeE = ncVars['OrificeE'][:][mask]
 
     # Must convert square kilometers in input file back to square meters before going into build_LAKEPARM function
-    areas = {key:val*float(1000000) for key,val in zip(IDs, ncVars['LkArea'][:]) if key in subsetList}
-    max_elevs = {key:val for key,val in zip(IDs, ncVars['LkMxE'][:]) if key in subsetList}
-    OrificEs = {key:val for key,val in zip(IDs, ncVars['OrificeE'][:]) if key in subsetList}
-    cen_lats = {key:val for key,val in zip(IDs, ncVars['lat'][:]) if key in subsetList}
-    cen_lons = {key:val for key,val in zip(IDs, ncVars['lon'][:]) if key in subsetList}
-    WeirE_vals = {key:val for key,val in zip(IDs, ncVars['WeirE'][:]) if key in subsetList}
+    areas = dict(zip(IDs, ncVars['LkArea'][:][mask]*float(1000000)))
+    max_elevs = dict(zip(IDs, LkMxE))
+    OrificEs = dict(zip(IDs, OrificeE))
+    cen_lats = dict(zip(IDs, ncVars['lat'][:][mask]))
+    cen_lons = dict(zip(IDs, ncVars['lon'][:][mask]))
+    WeirE_vals = dict(zip(IDs, ncVars['WeirE'][:][mask]))
 
     # min_elevs is only used for IDs, but we can reconstruct the real value using other parameters
     # Only works for lakes where WeirE or OrificeE is based on Max Elevation and Min Elevation.
-    min_elevs = {key:maxE-((maxE-OrE)*(3.0/2.0)) for key,maxE,OrE in zip(IDs, ncVars['LkMxE'][:], ncVars['OrificeE'][:]) if key in subsetList}
-    #min_elevs2 = {key:maxE-((maxE-WeirE)*10.) for key,maxE,WeirE in zip(IDs, ncVars['LkMxE'][:], ncVars['WeirE'][:]) if key in subsetList}
+    min_elevs = dict(zip(IDs, LkMxE-((LkMxE-OrificeE)*(3.0/2.0))))
+    #min_elevs2 = dict(zip(IDs, LkMxE-((LkMxE-ncVars['WeirE'][:][mask])*10.)))
 
     # Clean up and return
     rootgrp.close()
-    del IDs, ncVars, rootgrp
+    del IDs, ncVars, rootgrp, mask, LkMxE, OrificeE
     return min_elevs, areas, max_elevs, OrificEs, cen_lats, cen_lons, WeirE_vals
 
 # --- End Functions --- #